@@ -0,0 +1,76 @@
+# Content-addressed, size-bounded cache of ASR results for audio chunks
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+DEFAULT_CACHE_SIZE_MB = 256
+
+def chunk_cache_key(pcm_data, namespace):
+    """Hashes PCM bytes of a chunk together with the parameters that affect its transcription"""
+
+    key_hash = hashlib.sha256(namespace.encode('utf8'))
+    key_hash.update(b'\0')
+    key_hash.update(pcm_data)
+    return key_hash.hexdigest()
+
+class ChunkCache:
+    """SQLite store of transcription results with least-recently-used eviction"""
+
+    def __init__(self, db_path, max_size_mb=DEFAULT_CACHE_SIZE_MB):
+        cache_dir = os.path.dirname(db_path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.db_path = db_path
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS chunks (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_access REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_last_access ON chunks (last_access)")
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM chunks").fetchone()[0]
+
+    def get(self, key):
+        """Returns cached (raw transcript, punctuated transcript, word timing) or None"""
+
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM chunks WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+            self._conn.execute("UPDATE chunks SET last_access = ? WHERE key = ?", (time.time(), key))
+        return tuple(json.loads(row[0]))
+
+    def put(self, key, result):
+        """Stores a transcription result and evicts least recently used entries above size limit"""
+
+        value = json.dumps(list(result))
+        size = len(key) + len(value.encode('utf8'))
+
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM chunks WHERE key = ?", (key,)).fetchone()
+            if row:
+                self._total_bytes -= row[0]
+            self._conn.execute("INSERT OR REPLACE INTO chunks (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                               (key, value, size, time.time()))
+            self._total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+
+        evicted_keys = []
+        for key, size in self._conn.execute("SELECT key, size FROM chunks ORDER BY last_access").fetchall():
+            if self._total_bytes <= self.max_bytes:
+                break
+            evicted_keys.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM chunks WHERE key = ?", evicted_keys)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,237 @@
+# Memory-mapped, windowed access to PCM WAV audio
+
+import io
+import os
+import mmap
+import wave
+import struct
+import threading
+import subprocess
+
+UNKNOWN_CHUNK_SIZE = 0xFFFFFFFF  #written by encoders that stream their output
+WAV_CODEC = 'wav'
+FLAC_CODEC = 'flac'
+OPUS_CODEC = 'opus'
+UPLOAD_CODECS = [WAV_CODEC, FLAC_CODEC, OPUS_CODEC]
+LOSSY_CODECS = [OPUS_CODEC]
+CODEC_EXTENSIONS = {WAV_CODEC: 'wav', FLAC_CODEC: 'flac', OPUS_CODEC: 'ogg'}
+CODEC_CONTENT_TYPES = {WAV_CODEC: 'audio/wav', FLAC_CODEC: 'audio/flac', OPUS_CODEC: 'audio/ogg; codecs=opus'}
+CODEC_ENCODERS = {FLAC_CODEC: 'flac', OPUS_CODEC: 'libopus'}
+OPUS_BITRATE = '32k'  #plenty for 16 kHz mono speech
+FFMPEG_CODEC_ARGS = {FLAC_CODEC: ['-c:a', 'flac', '-compression_level', '5', '-f', 'flac'],
+                     OPUS_CODEC: ['-c:a', 'libopus', '-b:a', OPUS_BITRATE, '-application', 'voip', '-f', 'ogg']}
+FFMPEG_PCM_FORMATS = {1: 'u8', 2: 's16le', 4: 's32le'}
+
+def make_wav_header(data_size, frame_rate, sample_width, channels):
+    """Returns a canonical 44 byte PCM WAV header for sample data of given size"""
+
+    frame_width = sample_width * channels
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE', 
+                       b'fmt ', 16, 1, channels, frame_rate, frame_rate * frame_width, frame_width, sample_width * 8, 
+                       b'data', data_size)
+
+def pcm_to_wav_buffer(pcm_data, frame_rate, sample_width, channels, name):
+    """Wraps raw PCM samples with a WAV header in an in-memory buffer"""
+
+    wav_buffer = io.BytesIO()
+    with wave.open(wav_buffer, 'wb') as wf:
+        wf.setnchannels(channels)
+        wf.setsampwidth(sample_width)
+        wf.setframerate(frame_rate)
+        wf.writeframes(pcm_data)
+
+    wav_buffer.seek(0)
+    wav_buffer.name = name
+    return wav_buffer
+
+def has_ffmpeg_encoder(encoder):
+    """Checks if the installed ffmpeg can encode with given encoder"""
+
+    try:
+        output = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    except OSError:
+        return False
+    return any(line.split()[1:2] == [encoder.encode()] for line in output.splitlines())
+
+def encode_pcm_buffer(pcm_data, frame_rate, sample_width, channels, codec, name):
+    """Encodes raw PCM samples in memory with an upload codec. 
+    Returned buffer has the name and content type to upload it with"""
+
+    if codec == WAV_CODEC:
+        encoded_buffer = pcm_to_wav_buffer(pcm_data, frame_rate, sample_width, channels, name)
+    else:
+        process = subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', FFMPEG_PCM_FORMATS[sample_width], 
+                                  '-ar', str(frame_rate), '-ac', str(channels), '-i', 'pipe:0'] + FFMPEG_CODEC_ARGS[codec] + ['pipe:1'],
+                                 input=pcm_data, stdout=subprocess.PIPE, check=True)
+        encoded_buffer = io.BytesIO(process.stdout)
+        encoded_buffer.name = name
+
+    encoded_buffer.content_type = CODEC_CONTENT_TYPES[codec]
+    return encoded_buffer
+
+def find_wav_data_chunk(f):
+    """Returns byte offset and size of the sample data chunk in a RIFF/WAVE file"""
+
+    riff_header = f.read(12)
+    if len(riff_header) < 12 or riff_header[:4] != b'RIFF' or riff_header[8:12] != b'WAVE':
+        raise wave.Error("Not a RIFF/WAVE file")
+
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            raise wave.Error("No data chunk found")
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+        if chunk_id == b'data':
+            return f.tell(), chunk_size
+        f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+class WavAudioSource:
+    """Serves sample-accurate windows of a PCM WAV file as zero-copy views over a memory map"""
+
+    def __init__(self, wav_path):
+        self.wav_path = wav_path
+
+        with wave.open(wav_path, 'rb') as wf:
+            self.frame_rate = wf.getframerate()
+            self.sample_width = wf.getsampwidth()
+            self.channels = wf.getnchannels()
+        self.frame_width = self.sample_width * self.channels
+
+        self._file = open(wav_path, 'rb')
+        data_offset, data_size = find_wav_data_chunk(self._file)
+        available_size = os.fstat(self._file.fileno()).st_size - data_offset
+        if data_size == UNKNOWN_CHUNK_SIZE or data_size > available_size:
+            data_size = available_size
+        self.n_frames = data_size // self.frame_width
+
+        if self.n_frames:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._data = memoryview(self._mmap)[data_offset:data_offset + self.n_frames * self.frame_width]
+        else:
+            self._mmap = None
+            self._data = memoryview(b'')
+
+    @property
+    def duration(self):
+        """Length of the audio in seconds"""
+        return self.n_frames / self.frame_rate
+
+    def sec_to_frame(self, sec):
+        """Converts a time in seconds to the nearest frame index within the audio"""
+        return min(max(int(round(sec * self.frame_rate)), 0), self.n_frames)
+
+    def get_window(self, start_sec, end_sec):
+        """Returns PCM bytes between start and end seconds as a view (no copy is made)"""
+
+        start_frame = self.sec_to_frame(start_sec)
+        end_frame = max(self.sec_to_frame(end_sec), start_frame)
+        return self._data[start_frame * self.frame_width:end_frame * self.frame_width]
+
+    def get_wav_buffer(self, start_sec, end_sec, name):
+        """Returns the audio between start and end seconds as an in-memory WAV"""
+
+        return pcm_to_wav_buffer(self.get_window(start_sec, end_sec), self.frame_rate, self.sample_width, self.channels, name)
+
+    def get_encoded_buffer(self, start_sec, end_sec, name, codec=WAV_CODEC):
+        """Returns the audio between start and end seconds encoded in memory with an upload codec"""
+
+        return self.encode_window(self.get_window(start_sec, end_sec), name, codec)
+
+    def get_packed_window(self, intervals, gap_sec):
+        """Returns PCM bytes of several (start, end) second intervals joined with silence in between, 
+        and the second each interval starts at in them"""
+
+        silence = bytes(int(round(gap_sec * self.frame_rate)) * self.frame_width)
+        windows = [self.get_window(start_sec, end_sec) for start_sec, end_sec in intervals]
+
+        packed_starts = []
+        position = 0
+        for window in windows:
+            packed_starts.append(position / self.frame_width / self.frame_rate)
+            position += len(window) + len(silence)
+        return silence.join(windows), packed_starts
+
+    def encode_window(self, pcm_data, name, codec=WAV_CODEC):
+        """Encodes PCM bytes in the format of this audio with an upload codec"""
+
+        return encode_pcm_buffer(pcm_data, self.frame_rate, self.sample_width, self.channels, codec, name)
+
+    def export(self, start_sec, end_sec, output_path):
+        """Writes the audio between start and end seconds to a WAV file"""
+
+        with wave.open(output_path, 'wb') as wf:
+            wf.setnchannels(self.channels)
+            wf.setsampwidth(self.sample_width)
+            wf.setframerate(self.frame_rate)
+            wf.writeframes(self.get_window(start_sec, end_sec))
+
+    def close(self):
+        self._data.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+class LazyAudioSource:
+    """Defers audio conversion and mapping until a stage actually needs the audio"""
+
+    def __init__(self, audio_path, convert_func, open_func=WavAudioSource):
+        self.audio_path = audio_path
+        self._convert_func = convert_func
+        self._open_func = open_func
+        self._wav_path = None
+        self._source = None
+        self._lock = threading.Lock()
+
+    @property
+    def wav_path(self):
+        """Path of the converted WAV (converts on first access)"""
+        with self._lock:
+            if self._wav_path is None:
+                self._wav_path = self._convert_func(self.audio_path)
+            return self._wav_path
+
+    @property
+    def source(self):
+        """Memory-mapped audio source (maps on first access)"""
+        wav_path = self.wav_path
+        with self._lock:
+            if self._source is None:
+                self._source = self._open_func(wav_path)
+            return self._source
+
+    @property
+    def loaded(self):
+        return self._source is not None
+
+    @property
+    def duration(self):
+        return self.source.duration
+
+    @property
+    def frame_rate(self):
+        return self.source.frame_rate
+
+    def get_window(self, start_sec, end_sec):
+        return self.source.get_window(start_sec, end_sec)
+
+    def get_wav_buffer(self, start_sec, end_sec, name):
+        return self.source.get_wav_buffer(start_sec, end_sec, name)
+
+    def get_encoded_buffer(self, start_sec, end_sec, name, codec=WAV_CODEC):
+        return self.source.get_encoded_buffer(start_sec, end_sec, name, codec)
+
+    def get_packed_window(self, intervals, gap_sec):
+        return self.source.get_packed_window(intervals, gap_sec)
+
+    def encode_window(self, pcm_data, name, codec=WAV_CODEC):
+        return self.source.encode_window(pcm_data, name, codec)
+
+    def export(self, start_sec, end_sec, output_path):
+        return self.source.export(start_sec, end_sec, output_path)
+
+    def close(self):
+        with self._lock:
+            if self._source is not None:
+                self._source.close()
+                self._source = None
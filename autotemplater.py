@@ -10,12 +10,27 @@ import subprocess
 import tempfile
 import shutil
 import random
+import bisect
+import hashlib
+import functools
+import glob
+import threading
+import multiprocessing
+import concurrent.futures
+import cProfile
+import pstats
 import requests
-import httpx
 import validators
-from pydub import AudioSegment
+import numpy as np
 from tqdm import tqdm
-from subtools import segment_turns, speaker_turns_to_srt, get_azure_translator
+from subtools import segment_turns, get_azure_translator, DEFAULT_TRANSLATE_WORKERS
+from turns import Turn, dump_turns, load_turns
+from writers import write_turns, sec_to_timestamp, timestamp_spanner, FORMAT_WRITERS, TRANSCRIPT_FORMATS, SUBTITLE_FORMATS
+from audiosource import LazyAudioSource, WavAudioSource, make_wav_header, has_ffmpeg_encoder, WAV_CODEC, OPUS_CODEC, UPLOAD_CODECS, LOSSY_CODECS, CODEC_EXTENSIONS, CODEC_ENCODERS
+from asrcache import ChunkCache, chunk_cache_key, DEFAULT_CACHE_SIZE_MB
+from transport import Transport, RequestScheduler, AzureTokenProvider, RETRYABLE_STATUS_CODES, DEFAULT_MAX_RETRIES
+from metrics import RunMetrics, RequestMetrics
+from stages import StageManifest, get_fingerprint, get_content_hash
 
 #Constants
 API_TRANSCRIBE_URL = "http://127.0.0.1:8010/transcribe"  #default running on local
@@ -29,28 +44,65 @@ TURN_ON_FLAGS = [TURN_ON_SEGMENT_FLAG, TURN_ON_SPAN_FLAG]
 PYANNOTE_DIARIZATION_TAG = 'dia'
 PYANNOTE_SAD_TAG = 'sad'
 DEFAULT_AZURE_REGION = 'westeurope'
+AZURE_STT_PATH = "/speech/recognition/conversation/cognitiveservices/v1"
+AZURE_TOKEN_PATH = "/sts/v1.0/issueToken"
+AZURE_TRANSLATOR_URL = "https://api.cognitive.microsofttranslator.com"
 REVISION_PATH = "revision"
 DOWNLOAD_PATH = "download"
-SPEAKER_DELIMITER = ':'
+CACHE_PATH = "cache"
+CHUNK_CACHE_FILENAME = "asrchunks.sqlite"
+AUDIO_STORE_PATH = os.path.join(CACHE_PATH, "audio")
+TRANSLATION_MEMORY_FILENAME = "translationmemory.sqlite"
 SUPPORTED_ASR_SERVICE_TAGS = [ASR_API_FLAG, AZURE_ASR_FLAG]
+AUDIO_EXTENSIONS = ['wav', 'mp3', 'm4a', 'ogg', 'oga', 'opus', 'flac', 'aac', 'wma', 'amr', 'webm', 'mp4']
+BATCH_SUMMARY_FILENAME = "batch-summary.json"
+BATCH_SUMMARY_OUTPUTS = ['emptyotr', 'finalotr', 'txt', 'jsonl', 'srt', 'vtt', 'translatedsrt', 'translatedvtt', 'metrics']
+DEFAULT_OUTPUT_FORMATS = 'otr,txt,srt'
+OUTPUT_FORMAT_PATHS = {'otr': 'finalotr', 'txt': 'txt', 'jsonl': 'jsonl', 'srt': 'srt', 'vtt': 'vtt'}
+DEFAULT_PROFILE_PATH = "autotemplater.prof"
+PROFILE_PRINT_LINES = 30
 
 
 SAMPLE_COUNT = 5
 DEFAULT_MAX_TURN_LENGTH = 30.0 #(seconds) used only with span-based turns
 SEGMENT_AT_PAUSE_LENGTH = 3.0 #(seconds) used only with span-based turns
 MAX_CHARS_PER_SUBSEG = 80
+ASR_FRAME_RATE = 16000 #(Hz) sample rate audio is converted to, as used by ASR services and pyannote
+CONVERSION_BLOCK_SIZE = 1024 * 1024
+DEFAULT_SAD_SHARD_LENGTH = 600.0 #(seconds) core length of each shard in sharded SAD
+SAD_SHARD_OVERLAP = 15.0 #(seconds) context added on both sides of a shard
+SAD_SHARD_JOIN_TOLERANCE = 1e-6 #(seconds) segments closer than this at shard boundaries are joined
+DEFAULT_TRANSCRIPTION_WORKERS = 1
+PACK_MAX_TURN_LENGTH = 5.0 #(seconds) only turns shorter than this are packed together
+PACK_GAP_LENGTH = 0.5 #(seconds) silence put between packed turns
+AZURE_SDK_MAX_CHUNK_LENGTH = 15.0 #(seconds) single-shot recognition stops after this long
+AZURE_REST_MAX_CHUNK_LENGTH = 60.0 #(seconds) limit of Azure short audio REST API
+SPLIT_ENERGY_FRAME_LENGTH = 0.02 #(seconds)
+SPLIT_ENERGY_SMOOTHING = 0.2 #(seconds) energy is averaged over this long to cut at pauses rather than between phonemes
+SPLIT_MIN_PIECE_FRACTION = 0.5 #pieces of over-long turns are at least this fraction of the length limit (except the last)
+MIN_MAX_CHUNK_LENGTH = 10 * SPLIT_ENERGY_FRAME_LENGTH #(seconds) shortest --maxchunk that leaves pieces of several energy frames to cut at
 # SUB_END_BUFFER = 0.5 #seconds to wait for subtitle entry to pass
 
+AZURE_TICKS_PER_SEC = 10000000 #Azure offsets and durations are in 100 ns units
+ASR_API_DEFAULT_CODECS = [WAV_CODEC] #ASR-API instances that accept compressed uploads list them under 'codecs'
+AZURE_REST_CODECS = [WAV_CODEC, OPUS_CODEC] #Azure short audio REST API takes WAV or Ogg Opus
+AZURE_SDK_CODECS = [WAV_CODEC] #Compressed input to the speech SDK needs GStreamer
+AZURE_REST_CONTENT_TYPES = {WAV_CODEC: 'audio/wave', OPUS_CODEC: 'audio/ogg; codecs=opus'}
+
 DUMMY_TRANSCRIPTION = False  #Emulates transcription for debugging
 
 parser = argparse.ArgumentParser(description="oTranscribe template maker")
-parser.add_argument('-i', '--audio', type=str, required=True, help='Input audio path or URL')
+parser.add_argument('-i', '--audio', type=str, help='Input audio path or URL')
+parser.add_argument('-B', '--batch', type=str, help='Batch input: directory, glob pattern or manifest file listing audio paths or URLs')
+parser.add_argument('-j', '--jobs', type=int, help='Number of diarization processes in batch mode (default: number of CPUs)')
 parser.add_argument('-l', '--lang', type=str, help='Transcription language')
 parser.add_argument('-o', '--out', type=str, help='Output directory (default: input audio directory)')
 parser.add_argument('-p', '--punctoken', type=str, help='PunkProse token if sending to remote API (Not implemented)') #TODO
 parser.add_argument('-a', '--azureasrtoken', type=str, help='Azure token if sending to Azure ASR')
 parser.add_argument('-m', '--azuretranslatetoken', type=str, help='Azure token if sending to Azure ASR')
 parser.add_argument('-r', '--azureregion', type=str, help='Azure region if sending to Azure ASR (default: %s)'%DEFAULT_AZURE_REGION, default=DEFAULT_AZURE_REGION)
+parser.add_argument('--azureurl', type=str, help='Base URL of Azure speech REST and token endpoints instead of the regional ones, e.g. a local mock (needs -b)')
+parser.add_argument('--translatorurl', type=str, help='Azure translator endpoint (default: %s)'%AZURE_TRANSLATOR_URL, default=AZURE_TRANSLATOR_URL)
 parser.add_argument('-x', '--transcribe', type=str, help='Automatic transcription service %s'%(SUPPORTED_ASR_SERVICE_TAGS))
 parser.add_argument('-f', '--translate', type=str, help='Translate to language', default=None)
 parser.add_argument('-u', '--apiurl', type=str, help='ASR-API URL endpoint (default: http://127.0.0.1:8010/transcribe/short)', default=API_TRANSCRIBE_URL)
@@ -60,27 +112,33 @@ parser.add_argument('-v', '--skiprevision', action='store_true', help='Skip diar
 parser.add_argument('-n', '--spanlength', type=float, help='Maximum span length in seconds (default: 30 seconds)', default=DEFAULT_MAX_TURN_LENGTH)
 parser.add_argument('-d', '--diarize', action='store_true', help='Perform speaker diarization (default: False)')
 parser.add_argument('-b', '--bypassazuresdk', action='store_true', help='Bypass Azure SDK and use (unreliable) requests (default: False)')
+parser.add_argument('-k', '--sadprocesses', type=int, help='Number of processes for sharded speech activity detection (default: 1, no sharding)', default=1)
+parser.add_argument('--shardlength', type=float, help='Shard length in seconds for sharded speech activity detection (default: %i)'%DEFAULT_SAD_SHARD_LENGTH, default=DEFAULT_SAD_SHARD_LENGTH)
+parser.add_argument('--minspeech', type=float, help='Drop detected speech segments shorter than this many seconds (default: 0)', default=0.0)
+parser.add_argument('--mingap', type=float, help='Join detected speech segments separated by less than this many seconds (default: 0)', default=0.0)
+parser.add_argument('-e', '--formats', type=str, help='Comma separated output formats from %s (default: %s)'%(list(FORMAT_WRITERS), DEFAULT_OUTPUT_FORMATS), default=DEFAULT_OUTPUT_FORMATS)
+parser.add_argument('-c', '--cachedir', type=str, help='Directory of persistent transcription cache (default: %s)'%CACHE_PATH, default=CACHE_PATH)
+parser.add_argument('--cachesize', type=float, help='Maximum size of transcription cache in MB (default: %i)'%DEFAULT_CACHE_SIZE_MB, default=DEFAULT_CACHE_SIZE_MB)
+parser.add_argument('--nocache', action='store_true', help='Do not use the persistent transcription cache (default: False)')
+parser.add_argument('--continuous', action='store_true', help='Recognize whole audio in one Azure speech SDK session instead of turn by turn (default: False)')
+parser.add_argument('--http2', action='store_true', help='Use HTTP/2 for requests to ASR backends (needs httpx[http2]) (default: False)')
+parser.add_argument('--ratelimit', type=float, help='Maximum number of requests per second to ASR and translation services (default: no limit)')
+parser.add_argument('--retries', type=int, help='Number of retries of throttled or failed requests (default: %i)'%DEFAULT_MAX_RETRIES, default=DEFAULT_MAX_RETRIES)
+parser.add_argument('--codec', type=str, help='Codec to upload audio chunks to ASR with %s, falls back to wav if the service does not accept it (default: %s)'%(UPLOAD_CODECS, WAV_CODEC), default=WAV_CODEC)
+parser.add_argument('--pack', type=float, help='Pack consecutive short turns into requests of up to this many seconds, needs word timings from the service (default: 0, no packing)', default=0.0)
+parser.add_argument('--maxchunk', type=float, help='Cut turns longer than this many seconds at pauses before sending them to ASR (default: %i for Azure SDK, %i for Azure REST, no limit for ASR API)'%(AZURE_SDK_MAX_CHUNK_LENGTH, AZURE_REST_MAX_CHUNK_LENGTH))
+parser.add_argument('--prometheus', type=str, help='Directory to also write run metrics to as Prometheus textfiles (e.g. for node exporter textfile collector)')
+parser.add_argument('--profile', type=str, nargs='?', const=DEFAULT_PROFILE_PATH, help='Run under cProfile (main thread only) and dump stats to this path (default: %s)'%DEFAULT_PROFILE_PATH)
+parser.add_argument('-w', '--workers', type=int, help='Number of turns to transcribe concurrently (default: %i)'%DEFAULT_TRANSCRIPTION_WORKERS, default=DEFAULT_TRANSCRIPTION_WORKERS)
+parser.add_argument('--translateworkers', type=int, help='Number of translation batches to send concurrently (default: %i)'%DEFAULT_TRANSLATE_WORKERS, default=DEFAULT_TRANSLATE_WORKERS)
 
 
 
-def sec_to_timestamp(sec) -> str:
-    """Convert seconds to hh:mm:ss timestamp format"""
-    ty_res = time.gmtime(sec)
-    res = time.strftime("%H:%M:%S",ty_res)
-    return res
-
-def timestamp_spanner(sec) -> str:
-    """Creates an XML line for timestamp from seconds in audio"""
-    ty_res = time.gmtime(sec)
-    res = sec_to_timestamp(sec)
-    span_str = '<span class="timestamp" data-timestamp="%s">%s</span>'%(sec, res)
-    return span_str
-
 def get_speaker_turns(diarization_output, turn_on_segment, max_turn_length = DEFAULT_MAX_TURN_LENGTH, segment_at_pause_length = SEGMENT_AT_PAUSE_LENGTH):
     """Makes a minimal speaker turn list from diarization output. Merges segments that belong to same speaker"""
 
     speaker_turns = []
-    current_turn = {'speaker':None, 'start':0.0, 'end':0.0}
+    current_turn = Turn(0.0, 0.0)
     for i, s in enumerate(diarization_output):
         speaker_change = not s['label'] == current_turn['speaker']
         current_turn_length = current_turn['end'] - current_turn['start']
@@ -99,8 +157,7 @@ def get_speaker_turns(diarization_output, turn_on_segment, max_turn_length = DEF
                     current_turn['toolong'] = True
 
             #start new turn
-            current_turn = {'start':s['segment']['start'], 'end':s['segment']['end'],
-                            'speaker':s['label'], 'toolong': False}
+            current_turn = Turn(s['segment']['start'], s['segment']['end'], s['label'])
         else:
             current_turn['end'] = s['segment']['end']
 
@@ -115,49 +172,11 @@ def get_speaker_turns(diarization_output, turn_on_segment, max_turn_length = DEF
 
 def speaker_turns_to_otr(speaker_turns, output_path, write_speaker_id=False):
     """Creates an OTR template from speaker turn list"""
-
-    otr_text = ""
-    for t in speaker_turns:
-        if 'rawtext' in t or 'puncdtext' in t:
-            if not t['puncdtext'] and not t['rawtext']:
-                continue 
-
-        otr_text += timestamp_spanner(t['start']) + ' '
-        
-        if write_speaker_id: #and 'speaker' in t:
-            otr_text += '(' + t['speaker'] + ')' + SPEAKER_DELIMITER + " "
-        if 'puncdtext' in t and t['puncdtext']:
-            otr_text += t['puncdtext']
-        elif 'rawtext' in t and t['rawtext']:
-            otr_text += t['rawtext']
-        otr_text += '<br /><br />'
-        
-    otr_format_dict = {'text': otr_text, "media": "", "media-time":"0.0"}
-    
-    with open(output_path, 'w') as f:
-        f.write(json.dumps(otr_format_dict))
+    write_turns(speaker_turns, {'otr': output_path}, write_speaker_id)
 
 def speaker_turns_to_txt(speaker_turns, output_path, write_speaker_id=False):
     """Creates an TXT file from speaker turn list"""
-
-    out_text = ""
-    for t in speaker_turns:
-        if 'rawtext' in t or 'puncdtext' in t:
-            if not t['puncdtext'] and not t['rawtext']:
-                continue  
-            
-        out_text += sec_to_timestamp(t['start']) + ' '
-        
-        if write_speaker_id:# and 'speaker' in t:
-            out_text += '(' + t['speaker'] + ')' + SPEAKER_DELIMITER + " "
-        if 'puncdtext' in t and t['puncdtext']:
-            out_text += t['puncdtext']
-        elif 'rawtext' in t and t['rawtext']:
-            out_text += t['rawtext']
-        out_text += '\n'
-            
-    with open(output_path, 'w') as f:
-        f.write(out_text)
+    write_turns(speaker_turns, {'txt': output_path}, write_speaker_id)
 
 def print_speakers_data(diarization_dict):
     """Prints number of speakers and number of segments for each of them on the screen"""
@@ -173,76 +192,217 @@ def print_speakers_data(diarization_dict):
         print("%s: %i segments"%(s, speakers_info[s]), end=' ')
     print()
 
+pyannote_pipelines = {}
+pyannote_lock = threading.Lock()
+
+def load_pyannote_pipelines(activities, torch_threads=None):
+    """Loads pyannote pipelines for given activities (once per process)"""
+
+    import torch
+
+    if torch_threads:
+        torch.set_num_threads(torch_threads)
+
+    with pyannote_lock:
+        for activity in activities:
+            if activity not in pyannote_pipelines:
+                pyannote_pipelines[activity] = torch.hub.load('pyannote/pyannote-audio', activity) #TODO device='cpu' or 'gpu' 
+
+    return [pyannote_pipelines[activity] for activity in activities]
+
 def do_pyannote(wav_path, activity):
     """Performs pyannote diarization or speaker activity detection (SAD) on wav file and outputs its results"""
 
     from pyannote.core import Annotation, Segment
     # from pyannote.audio.features import RawAudio
-    import torch
 
     file = {'audio': wav_path}
-    pipeline = torch.hub.load('pyannote/pyannote-audio', activity) #TODO device='cpu' or 'gpu' 
-    result = pipeline(file)
+    pipeline = load_pyannote_pipelines([activity])[0]
+    #Pipelines are shared by all jobs of a server process
+    with pyannote_lock:
+        result = pipeline(file)
     
     return result
 
-def sad_result_to_diarization_dict(result):
-    """Converts speech activity detection (SAD) results to emulated diarization results (one speaker throughout)"""
-    sign = lambda p : (p[1]-p[0]>0)
-
-    segments = []
-    segment_start = 0.0
-
-    semaphore = sign(result[0])  #this says if it starts with speech or not
-    for i in result:
-        window, probs = i
-        start_s = window.start
-        end_s = window.end
-        new_semaphore = sign(probs)
-        if new_semaphore and not semaphore:
-            segment_start = start_s
-        elif semaphore and not new_semaphore:
-            segment_end = start_s
-            segment = {"segment": {"start": segment_start, "end": segment_end}, "track": "NA", "label": "NA"}
-            segments.append(segment)
-        semaphore = new_semaphore
-
-    diarization_dict = {"pyannote": "Annotation", "content": segments, "modality": "speaker"}
+def filter_speech_segments(starts, ends, min_duration=0.0, min_gap=0.0):
+    """Fills gaps shorter than min_gap between speech segments, then removes segments shorter than min_duration"""
 
-    return diarization_dict
+    if min_gap > 0.0 and len(starts) > 1:
+        keep_boundary = (starts[1:] - ends[:-1]) >= min_gap
+        starts = starts[np.concatenate(([True], keep_boundary))]
+        ends = ends[np.concatenate((keep_boundary, [True]))]
 
-def audio_convert(audio_path):
-    """Converts audio to mono wav (unless it's already or there's a converted version in the same directory)"""
+    if min_duration > 0.0:
+        long_enough = (ends - starts) >= min_duration
+        starts = starts[long_enough]
+        ends = ends[long_enough]
 
-    do_convert = False
-    if os.path.splitext(audio_path)[1][1:] == 'wav':
-        wav_path = audio_path
-        try:
-            wf = wave.open(wav_path, "rb")
-            framerate = wf.getframerate()
+    return starts, ends
 
-            if wf.getnchannels() != 1:
-                do_convert = True
-        except:
-            do_convert = True
-    else:
-        wav_path = os.path.join(os.path.dirname(audio_path), os.path.splitext(os.path.basename(audio_path))[0] + '.wav')
-        if os.path.exists(wav_path):
-            return audio_convert(wav_path)
+def segments_to_diarization_dict(starts, ends):
+    """Makes an emulated diarization dictionary (one speaker throughout) from speech segment boundaries"""
+
+    segments = [{"segment": {"start": start, "end": end}, "track": "NA", "label": "NA"} 
+                for start, end in zip(starts.tolist(), ends.tolist())]
+    return {"pyannote": "Annotation", "content": segments, "modality": "speaker"}
+
+def sad_result_to_segments(result):
+    """Finds speech segment boundaries in speech activity detection (SAD) scores"""
+
+    scores = np.asarray(result.data)
+    sliding_window = result.sliding_window
+    if not len(scores):
+        return np.empty(0), np.empty(0)
+
+    #A frame is speech if its speech score beats non-speech score
+    is_speech = np.argmax(scores, axis=1) == 1
+    frame_starts = sliding_window.start + np.arange(len(scores)) * sliding_window.step
+
+    edges = np.diff(is_speech.astype(np.int8))
+    starts = frame_starts[np.flatnonzero(edges == 1) + 1]
+    ends = frame_starts[np.flatnonzero(edges == -1) + 1]
+
+    #Speech at the very beginning starts at zero, speech at the very end closes with the last frame
+    if is_speech[0]:
+        starts = np.concatenate(([0.0], starts))
+    if is_speech[-1]:
+        ends = np.concatenate((ends, [frame_starts[-1] + sliding_window.duration]))
+
+    return starts, ends
+
+def sad_result_to_diarization_dict(result, min_duration=0.0, min_gap=0.0):
+    """Converts speech activity detection (SAD) results to emulated diarization results (one speaker throughout)"""
+
+    starts, ends = sad_result_to_segments(result)
+    starts, ends = filter_speech_segments(starts, ends, min_duration, min_gap)
+    return segments_to_diarization_dict(starts, ends)
+
+def get_sad_shards(duration, shard_length=DEFAULT_SAD_SHARD_LENGTH, overlap=SAD_SHARD_OVERLAP):
+    """Splits audio duration into shards. Each shard owns a core interval and is processed with some overlapping context on both sides.
+    Returns list of (window start, window end, core start, core end)"""
+
+    shards = []
+    core_start = 0.0
+    while core_start < duration:
+        core_end = min(core_start + shard_length, duration)
+        shards.append((max(core_start - overlap, 0.0), min(core_end + overlap, duration), core_start, core_end))
+        core_start = core_end
+    return shards
+
+def do_sad_on_shard(shard_wav_path, window_start):
+    """Performs SAD on a shard wav and returns its speech segments in time of complete audio"""
+
+    sad_result = do_pyannote(shard_wav_path, PYANNOTE_SAD_TAG)
+    starts, ends = sad_result_to_segments(sad_result)
+    return list(zip((starts + window_start).tolist(), (ends + window_start).tolist()))
+
+def stitch_sad_shards(shard_segments, shards):
+    """Clips segments of each shard to its core interval and joins segments that were cut at core boundaries. Returns segment boundaries"""
+
+    clipped = []
+    for segments, (window_start, window_end, core_start, core_end) in zip(shard_segments, shards):
+        for start, end in segments:
+            start, end = max(start, core_start), min(end, core_end)
+            if end > start:
+                clipped.append([start, end])
+    clipped.sort()
+
+    stitched = []
+    for start, end in clipped:
+        if stitched and start - stitched[-1][1] <= SAD_SHARD_JOIN_TOLERANCE:
+            stitched[-1][1] = max(stitched[-1][1], end)
         else:
-            do_convert = True
+            stitched.append([start, end])
 
-    if do_convert:
-        print("Converting audio to wav", wav_path)
-        process = subprocess.call(['ffmpeg', '-loglevel', 'quiet', '-i',
-                                        audio_path, '-ac', '1', wav_path])
+    stitched = np.array(stitched).reshape(-1, 2)
+    return stitched[:, 0], stitched[:, 1]
 
-        return wav_path
-    else:
-        print("Reading wav file", audio_path)
+def do_sharded_sad(complete_audio, processes, shard_length=DEFAULT_SAD_SHARD_LENGTH, min_duration=0.0, min_gap=0.0):
+    """Performs speech activity detection on overlapping shards of audio in parallel processes"""
+
+    shards = get_sad_shards(complete_audio.duration, shard_length)
+    print("Performing speech activity detection on %i shards with %i processes"%(len(shards), processes))
+
+    shard_dir_path = tempfile.mkdtemp()
+    try:
+        shard_paths = []
+        for i, (window_start, window_end, core_start, core_end) in enumerate(shards):
+            shard_path = os.path.join(shard_dir_path, "shard%i.wav"%i)
+            complete_audio.export(window_start, window_end, shard_path)
+            shard_paths.append(shard_path)
+
+        mp_context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(processes, len(shards)), mp_context=mp_context,
+                                                    initializer=load_pyannote_pipelines, initargs=([PYANNOTE_SAD_TAG], 1)) as executor:
+            shard_segments = list(tqdm(executor.map(do_sad_on_shard, shard_paths, [shard[0] for shard in shards]), 
+                                       total=len(shards), desc="Detecting speech"))
+    finally:
+        shutil.rmtree(shard_dir_path)
+
+    starts, ends = stitch_sad_shards(shard_segments, shards)
+    starts, ends = filter_speech_segments(starts, ends, min_duration, min_gap)
+    return segments_to_diarization_dict(starts, ends)
+
+def get_file_hash(file_path, block_size=CONVERSION_BLOCK_SIZE):
+    """Returns SHA-256 of file content"""
+
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def is_converted_wav(audio_path, frame_rate=ASR_FRAME_RATE, channels=1):
+    """Checks if audio is already a 16-bit PCM wav with target sample rate and channels"""
+
+    if os.path.splitext(audio_path)[1][1:].lower() != 'wav':
+        return False
+    try:
+        with wave.open(audio_path, 'rb') as wf:
+            return wf.getframerate() == frame_rate and wf.getnchannels() == channels and wf.getsampwidth() == 2
+    except (wave.Error, EOFError, OSError):
+        return False
+
+def audio_convert(audio_path, store_path=AUDIO_STORE_PATH, frame_rate=ASR_FRAME_RATE, channels=1):
+    """Converts audio to 16-bit PCM wav with the sample rate and channels used for ASR and diarization (unless it's already in that format).
+    ffmpeg output is streamed into an audio store where conversions are kept by source content hash and target format"""
 
+    if is_converted_wav(audio_path, frame_rate, channels):
+        print("Reading wav file", audio_path)
         return audio_path
 
+    wav_filename = "%s-%ihz-%ich.wav"%(get_file_hash(audio_path), frame_rate, channels)
+    wav_path = os.path.join(store_path, wav_filename)
+    if os.path.exists(wav_path):
+        print("Reading converted wav file", wav_path)
+        return wav_path
+
+    if not os.path.exists(store_path):
+        os.makedirs(store_path, exist_ok=True)
+
+    print("Converting audio to wav", wav_path)
+    process = subprocess.Popen(['ffmpeg', '-loglevel', 'error', '-i', audio_path, '-vn', 
+                                '-ac', str(channels), '-ar', str(frame_rate), '-acodec', 'pcm_s16le', '-f', 's16le', 'pipe:1'],
+                               stdout=subprocess.PIPE)
+
+    #Write samples as they come and fill in the header once their size is known
+    partial_wav_path = wav_path + '.part'
+    data_size = 0
+    with open(partial_wav_path, 'wb') as f:
+        f.write(make_wav_header(0, frame_rate, 2, channels))
+        for block in iter(lambda: process.stdout.read(CONVERSION_BLOCK_SIZE), b''):
+            f.write(block)
+            data_size += len(block)
+        f.seek(0)
+        f.write(make_wav_header(data_size, frame_rate, 2, channels))
+
+    if process.wait() != 0 or not data_size:
+        os.remove(partial_wav_path)
+        print("ERROR: Couldn't convert audio file", audio_path)
+        sys.exit()
+
+    os.replace(partial_wav_path, wav_path)
+    return wav_path
 
 def initialize_azure_config_sdk(subscription_id, lang_code, region):
     """Returns speech_config to run azure ASR using Azure speech SDK"""
@@ -256,9 +416,19 @@ def initialize_azure_config_sdk(subscription_id, lang_code, region):
     #TODO: Make sure lang_code is supported
     return speech_config
 
-def transcribe_with_azure_sdk(audio_path, speech_config):
-    """Does recognition with Azure on give audio using Azure speech SDK"""
-    audio_input = speechsdk.AudioConfig(filename=audio_path)
+def transcribe_with_azure_sdk(audio_buffer, speech_config):
+    """Does recognition with Azure on given in-memory WAV audio using Azure speech SDK"""
+    with wave.open(audio_buffer, 'rb') as wf:
+        stream_format = speechsdk.audio.AudioStreamFormat(samples_per_second=wf.getframerate(), 
+                                                          bits_per_sample=wf.getsampwidth() * 8, 
+                                                          channels=wf.getnchannels())
+        pcm_data = wf.readframes(wf.getnframes())
+
+    push_stream = speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
+    push_stream.write(pcm_data)
+    push_stream.close()
+
+    audio_input = speechsdk.audio.AudioConfig(stream=push_stream)
     speech_recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_input)
 
     result = speech_recognizer.recognize_once_async().get()
@@ -274,57 +444,191 @@ def transcribe_with_azure_sdk(audio_path, speech_config):
         word_timing = []
     return raw_transcript, punctuated_transcript, word_timing
 
-def initialize_azure_config_requests(subscription_id, lang_code, region):
-    """Generates necessary info to do Azure Speech ASR using requests"""
+def transcribe_with_azure_sdk_continuous(wav_path, speech_config, duration=None):
+    """Does continuous recognition of a complete wav file in a single Azure speech SDK session. 
+    Returns recognized utterances with word timings relative to the start of audio. Exits if recognition is canceled on error"""
 
-    url = "https://" + region + ".stt.speech.microsoft.com/speech/recognition/conversation/cognitiveservices/v1?language=" + lang_code + "&format=detailed"
-    fetch_token_url = 'https://westeurope.api.cognitive.microsoft.com/sts/v1.0/issueToken'
-    headers = {
-        'Ocp-Apim-Subscription-Key': subscription_id
-    }
-    response = requests.post(fetch_token_url, headers=headers)
+    audio_input = speechsdk.audio.AudioConfig(filename=wav_path)
+    speech_recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_input)
 
-    token  = str(response.text)
-    headers = {
-          'Authorization': f'Bearer {token}',
-          'Content-Type': 'audio/wave',
-          'Accept': 'application/json'
-        }
+    utterances = []
+    errors = []
+    session_done = threading.Event()
+    progress_bar = tqdm(total=round(duration) if duration else None, desc="Transcribing audio", unit='s')
+
+    def on_recognized(evt):
+        if evt.result.reason != speechsdk.ResultReason.RecognizedSpeech:
+            return
+        response_json = json.loads(evt.result.json)
+        utterances.append({'offset': response_json['Offset'], 'duration': response_json['Duration'],
+                           'rawtext': response_json['NBest'][0]['ITN'], 
+                           'puncdtext': response_json['NBest'][0]['Display'], 
+                           'wordtiming': response_json['NBest'][0].get('Words', [])})
+        if duration:
+            progress_bar.update(min(round((response_json['Offset'] + response_json['Duration']) / AZURE_TICKS_PER_SEC), progress_bar.total) - progress_bar.n)
+
+    def on_canceled(evt):
+        if evt.result.cancellation_details.reason == speechsdk.CancellationReason.Error:
+            errors.append(evt.result.cancellation_details.error_details)
+        session_done.set()
+
+    speech_recognizer.recognized.connect(on_recognized)
+    speech_recognizer.session_stopped.connect(lambda evt: session_done.set())
+    speech_recognizer.canceled.connect(on_canceled)
+
+    speech_recognizer.start_continuous_recognition()
+    session_done.wait()
+    speech_recognizer.stop_continuous_recognition()
+    progress_bar.close()
+
+    if errors:
+        #Utterances so far are only part of the audio, they must not be stored as its transcription
+        print("ERROR: Azure recognition canceled", errors[0])
+        sys.exit()
+
+    return utterances
+
+def find_turn_at(turn_starts, turn_ends, sec):
+    """Returns index of the turn containing a time, or the closest one if it falls between turns"""
+
+    i = bisect.bisect_right(turn_starts, sec) - 1
+    if i >= 0 and sec <= turn_ends[i]:
+        return i
+    if i < 0:
+        return 0
+    if i + 1 < len(turn_starts) and turn_starts[i + 1] - sec < sec - turn_ends[i]:
+        return i + 1
+    return i
+
+def assign_utterances_to_turns(utterances, speaker_turns):
+    """Places text and word timings of recognized utterances on speaker turns by timestamp. 
+    Utterances within a turn keep their punctuated text, text of utterances spanning several turns is split by the words falling in each turn"""
+
+    if not speaker_turns:
+        return speaker_turns
+
+    turn_starts = [t['start'] for t in speaker_turns]
+    turn_ends = [t['end'] for t in speaker_turns]
+    turn_raw = [[] for t in speaker_turns]
+    turn_puncd = [[] for t in speaker_turns]
+    turn_words = [[] for t in speaker_turns]
+
+    for utterance in utterances:
+        words = utterance['wordtiming']
+        if not words:
+            i = find_turn_at(turn_starts, turn_ends, (utterance['offset'] + utterance['duration'] / 2) / AZURE_TICKS_PER_SEC)
+            turn_raw[i].append(utterance['rawtext'])
+            turn_puncd[i].append(utterance['puncdtext'])
+            continue
+
+        word_turns = [find_turn_at(turn_starts, turn_ends, (w['Offset'] + w['Duration'] / 2) / AZURE_TICKS_PER_SEC) for w in words]
+        for i, w in zip(word_turns, words):
+            turn_words[i].append(dict(w, Offset=int(w['Offset'] - turn_starts[i] * AZURE_TICKS_PER_SEC)))
+
+        if len(set(word_turns)) == 1:
+            turn_raw[word_turns[0]].append(utterance['rawtext'])
+            turn_puncd[word_turns[0]].append(utterance['puncdtext'])
+        else:
+            #Split display text (with punctuation) and ITN text by the number of words falling in each turn
+            runs = []
+            for i in word_turns:
+                if runs and runs[-1][0] == i:
+                    runs[-1][1] += 1
+                else:
+                    runs.append([i, 1])
+            word_counts = [count for _, count in runs]
+            raw_groups = split_tokens_by_counts(utterance['rawtext'].split(), word_counts)
+            punctuated_groups = split_tokens_by_counts(utterance['puncdtext'].split(), word_counts)
+            for (i, _), raw, punctuated in zip(runs, raw_groups, punctuated_groups):
+                if raw:
+                    turn_raw[i].append(' '.join(raw))
+                if punctuated:
+                    turn_puncd[i].append(' '.join(punctuated))
+
+    for i, t in enumerate(speaker_turns):
+        t.set_transcription(' '.join(turn_raw[i]), ' '.join(turn_puncd[i]), turn_words[i])
+
+    return speaker_turns
+
+def select_upload_codec(codec, supported_codecs, service_name):
+    """Returns requested upload codec if the service accepts it and ffmpeg can encode it, otherwise WAV"""
+
+    if codec == WAV_CODEC:
+        return codec
+    if codec not in supported_codecs:
+        print("WARNING: %s doesn't accept %s uploads, sending wav"%(service_name, codec))
+        return WAV_CODEC
+    if not has_ffmpeg_encoder(CODEC_ENCODERS[codec]):
+        print("WARNING: ffmpeg can't encode %s (%s encoder missing), sending wav"%(codec, CODEC_ENCODERS[codec]))
+        return WAV_CODEC
+    return codec
+
+def initialize_azure_config_requests(subscription_id, lang_code, region, transport=None, codec=WAV_CODEC, endpoint=None):
+    """Generates necessary info to do Azure Speech ASR over HTTP. Tokens are refreshed before they expire.
+    Requests go to the regional endpoints unless another base URL is given in endpoint"""
+
+    if not transport:
+        transport = Transport()
+
+    stt_base_url = endpoint.rstrip('/') if endpoint else "https://" + region + ".stt.speech.microsoft.com"
+    token_base_url = endpoint.rstrip('/') if endpoint else "https://" + region + ".api.cognitive.microsoft.com"
+    url = stt_base_url + AZURE_STT_PATH + "?language=" + lang_code + "&format=detailed&wordLevelTimestamps=true"
+    fetch_token_url = token_base_url + AZURE_TOKEN_PATH
+    token_provider = AzureTokenProvider(subscription_id, fetch_token_url, transport)
+    if not token_provider.fetch():
+        return None
 
     #TODO: Make sure lang_code is supported
-    #TODO: Get word alignment info
 
-    return {'token':token, 'url':url, 'headers':headers}
+    codec = select_upload_codec(codec, AZURE_REST_CODECS, "Azure REST API")
 
-def transcribe_with_azure_requests(audio_path, speech_config):
-    """Sends a Azure API recognition request for audio and returns its transcript"""
+    return {'url':url, 'token_provider':token_provider, 'transport':transport, 'codec':codec}
+
+def transcribe_with_azure_requests(audio_buffer, speech_config):
+    """Sends a Azure API recognition request for in-memory encoded audio and returns its transcript"""
     raw_transcript = ''
     punctuated_transcript = ''
-    with open(audio_path,"rb") as payload:
-        response = requests.request("POST", speech_config['url'], headers=speech_config['headers'], data=payload)
+    word_timing = []
+    headers = {
+          'Authorization': 'Bearer ' + speech_config['token_provider'].get_token(),
+          'Content-Type': AZURE_REST_CONTENT_TYPES[speech_config['codec']],
+          'Accept': 'application/json'
+        }
+    response = speech_config['transport'].request("POST", speech_config['url'], headers=headers, content=audio_buffer.getvalue())
 
-        if response.status_code == 200:
-            response_json = response.json()
-            try:
-                raw_transcript = response_json['NBest'][0]['ITN']
-                punctuated_transcript = response_json['NBest'][0]['Display']
-                #TODO: Get word alignment info
-            except:
-                pass
-        else:
-            print("Error processing", audio_path)
-            print(response.text.encode('utf8'))
+    if response.status_code == 200:
+        response_json = response.json()
+        try:
+            raw_transcript = response_json['NBest'][0]['ITN']
+            punctuated_transcript = response_json['NBest'][0]['Display']
+            word_timing = response_json['NBest'][0].get('Words', [])
+        except:
+            pass
+    elif response.status_code in RETRYABLE_STATUS_CODES:
+        #Still throttled or failing after retries. Stop instead of losing the turn, transcription resumes from journal
+        print("ERROR: Azure keeps failing after retries for", audio_buffer.name, response.status_code)
+        print(response.text.encode('utf8'))
+        sys.exit()
+    else:
+        print("Error processing", audio_buffer.name)
+        print(response.text.encode('utf8'))
 
-    return raw_transcript, punctuated_transcript, [] #TODO: word timing info
+    return raw_transcript, punctuated_transcript, word_timing
 
-def initialize_api_config(lang, api_url, scorer='default'):
+def initialize_api_config(lang, api_url, scorer='default', transport=None, codec=WAV_CODEC):
     """Generates necessary info to do ASR with TWB-API"""
+    if not transport:
+        transport = Transport()
+
     all_good = False
+    supported_codecs = ASR_API_DEFAULT_CODECS
     try:
-        response = requests.request("GET", api_url, headers={})
+        response = transport.request("GET", api_url, headers={})
+        api_info = response.json()
 
-        if lang in response.json()['languages']:
+        if lang in api_info['languages']:
             all_good = True
+            supported_codecs = api_info.get('codecs', ASR_API_DEFAULT_CODECS)
         else:
             print("ERROR: Language %s not supported by ASR API"%lang)
     except Exception as e:
@@ -334,30 +638,37 @@ def initialize_api_config(lang, api_url, scorer='default'):
     if not all_good:
         return None
 
+    codec = select_upload_codec(codec, supported_codecs, "ASR API")
+
     api_url_endpoint = api_url + '/' + API_TRANSCRIBE_URL_ENDPOINT
-    return {'lang': lang, 'scorer':scorer, 'url': api_url_endpoint}
+    return {'lang': lang, 'scorer':scorer, 'url': api_url_endpoint, 'transport': transport, 'codec': codec}
 
-def transcribe_with_asr_api(audio_path, config):
-    """Sends a ASR-API recognition request for audio and returns its transcript"""
+def transcribe_with_asr_api(audio_buffer, config):
+    """Sends a ASR-API recognition request for in-memory encoded audio and returns its transcript"""
     url_endpoint = config['url']
     payload={'lang': config['lang']} #TODO: doesn't get the scorer in. 
     headers = {}
     
     #Send to ASR API
-    audio_filename = os.path.basename(audio_path)
+    audio_filename = audio_buffer.name
     
-    files=[('file',(audio_filename, open(audio_path,'rb'),'audio/wav'))]
+    files=[('file',(audio_filename, audio_buffer.getvalue(), audio_buffer.content_type))]
     
     try:
-        response = requests.request("POST", url_endpoint, headers=headers, data=payload, files=files)
+        response = config['transport'].request("POST", url_endpoint, headers=headers, data=payload, files=files)
     except Exception as e:
         print("ERROR: Cannot establish connection with ASR API")
         print(e)
         sys.exit()
     
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        #Still throttled or failing after retries. Stop instead of losing the turn, transcription resumes from journal
+        print("ERROR: ASR API keeps failing after retries for", audio_filename, response.status_code)
+        sys.exit()
+
     response_dict = response.json()
 
-    if response.ok:
+    if response.status_code == 200:
         transcript = response_dict["transcript"]
     else:
         print("Cannot read response for file", audio_filename)
@@ -366,224 +677,598 @@ def transcribe_with_asr_api(audio_path, config):
         
     return transcript, None, None #TODO: punctuated transcript and word timing info
 
-def dummy_transcriber(path, config):
-    return "Lorem ipsum dolor sit amet"
+def dummy_transcriber(audio_buffer, config):
+    return "lorem ipsum dolor sit amet", "Lorem ipsum dolor sit amet.", None
 
-def get_transcription_of_chunk(complete_audio, start_sec, end_sec, chunk_path, transcriber_func, speech_config=None):
-    """Transcribes an interval of audio with start and end seconds specified using ASR service"""
+def get_transcription_of_chunk(complete_audio, start_sec, end_sec, transcriber_func, speech_config=None, chunk_cache=None, cache_namespace='', codec=WAV_CODEC):
+    """Transcribes an interval of audio with start and end seconds specified using ASR service (or reads it from cache).
+    Chunk is encoded in memory with the upload codec"""
 
-    start_ms = start_sec * 1000
-    end_ms = end_sec * 1000
-    
-    audio_segment = complete_audio[start_ms:end_ms]
-    
-    audio_chunk_filename = "%.2f"%start_sec + "-" + "%.2f"%end_sec + ".wav"
-    audio_chunk_path = os.path.join(chunk_path, audio_chunk_filename)
-    
-    audio_segment.export(audio_chunk_path, format="wav")
+    if chunk_cache:
+        cache_key = chunk_cache_key(complete_audio.get_window(start_sec, end_sec), cache_namespace)
+        cached_result = chunk_cache.get(cache_key)
+        if cached_result:
+            return cached_result
+
+    audio_chunk_filename = "%.2f"%start_sec + "-" + "%.2f"%end_sec + "." + CODEC_EXTENSIONS[codec]
+    audio_chunk = complete_audio.get_encoded_buffer(start_sec, end_sec, audio_chunk_filename, codec)
     
-    raw_transcript, post_transcript, word_timing = transcriber_func(audio_chunk_path, speech_config)
+    raw_transcript, post_transcript, word_timing = transcriber_func(audio_chunk, speech_config)
+
+    #Empty results can be due to service errors, so they're not cached
+    if chunk_cache and (raw_transcript or post_transcript):
+        chunk_cache.put(cache_key, (raw_transcript, post_transcript, word_timing))
 
     #print("%.2f-%.2f: %s"%(start_sec, end_sec, transcript))
     return raw_transcript, post_transcript, word_timing
 
+def pack_turns(speaker_turns, indices, max_pack_length, max_turn_length=PACK_MAX_TURN_LENGTH, gap_length=PACK_GAP_LENGTH):
+    """Groups consecutive short turns into packs that fit in one request of at most max_pack_length seconds. 
+    Returns lists of turn indices, longer turns are left in packs of their own"""
+
+    packs = []
+    pack = []
+    pack_length = 0.0
+    for i in indices:
+        turn_length = speaker_turns[i]['end'] - speaker_turns[i]['start']
+        is_short = turn_length < max_turn_length
+        if pack and (not is_short or i != pack[-1] + 1 or pack_length + gap_length + turn_length > max_pack_length):
+            packs.append(pack)
+            pack = []
+            pack_length = 0.0
+
+        if not is_short:
+            packs.append([i])
+            continue
+
+        pack_length += turn_length + (gap_length if pack else 0.0)
+        pack.append(i)
+
+    if pack:
+        packs.append(pack)
+    return packs
+
+def split_tokens_by_counts(tokens, counts):
+    """Splits tokens into consecutive groups sized in proportion to counts (exactly by counts if they add up to the number of tokens)"""
+
+    total = sum(counts)
+    if not total:
+        return [tokens] + [[] for _ in counts[1:]]
+
+    groups = []
+    at_token = 0
+    cumulative_count = 0
+    for count in counts:
+        cumulative_count += count
+        end_token = int(round(cumulative_count * len(tokens) / total))
+        groups.append(tokens[at_token:end_token])
+        at_token = end_token
+    return groups
+
+def split_packed_transcription(raw_transcript, punctuated_transcript, word_timing, packed_starts):
+    """Splits transcription of packed audio back to each packed interval by word timings. 
+    Word offsets are made relative to the interval they fall in"""
+
+    interval_words = [[] for _ in packed_starts]
+    for w in word_timing:
+        word_middle = (w['Offset'] + w['Duration'] / 2) / AZURE_TICKS_PER_SEC
+        k = max(bisect.bisect_right(packed_starts, word_middle) - 1, 0)
+        word = dict(w)
+        word['Offset'] = max(0, int(w['Offset'] - packed_starts[k] * AZURE_TICKS_PER_SEC))
+        interval_words[k].append(word)
+
+    word_counts = [len(words) for words in interval_words]
+    raw_groups = split_tokens_by_counts((raw_transcript or '').split(), word_counts)
+    punctuated_groups = split_tokens_by_counts((punctuated_transcript or '').split(), word_counts)
+
+    return [(' '.join(raw), ' '.join(punctuated), words) for raw, punctuated, words in zip(raw_groups, punctuated_groups, interval_words)]
+
+def get_transcription_of_pack(complete_audio, intervals, transcriber_func, speech_config=None, chunk_cache=None, cache_namespace='', codec=WAV_CODEC, gap_length=PACK_GAP_LENGTH):
+    """Transcribes several intervals of audio in one request, joined with silence in between, and splits the transcription back by word timings. 
+    Returns a transcription for each interval"""
+
+    if len(intervals) == 1:
+        return [get_transcription_of_chunk(complete_audio, intervals[0][0], intervals[0][1], transcriber_func, speech_config, chunk_cache, cache_namespace, codec)]
+
+    pcm_data, packed_starts = complete_audio.get_packed_window(intervals, gap_length)
+
+    result = None
+    if chunk_cache:
+        cache_key = chunk_cache_key(pcm_data, cache_namespace)
+        result = chunk_cache.get(cache_key)
+
+    if not result:
+        audio_pack_filename = "%.2f"%intervals[0][0] + "-" + "%.2f"%intervals[-1][1] + "-pack%i"%len(intervals) + "." + CODEC_EXTENSIONS[codec]
+        result = transcriber_func(complete_audio.encode_window(pcm_data, audio_pack_filename, codec), speech_config)
+        raw_transcript, post_transcript, word_timing = result
+
+        if (raw_transcript or post_transcript) and not word_timing:
+            #No way to tell which interval the words belong to, send them one by one
+            return [get_transcription_of_chunk(complete_audio, start_sec, end_sec, transcriber_func, speech_config, chunk_cache, cache_namespace, codec)
+                    for start_sec, end_sec in intervals]
+
+        if chunk_cache and (raw_transcript or post_transcript):
+            chunk_cache.put(cache_key, result)
+
+    return split_packed_transcription(*result, packed_starts)
+
+def find_split_points(samples, frame_rate, max_length):
+    """Finds where to cut samples into pieces of at most max_length seconds, at the lowest (smoothed) energy points. 
+    Returns cut points in seconds from the start"""
+
+    frame_size = int(frame_rate * SPLIT_ENERGY_FRAME_LENGTH)
+    frame_length = frame_size / frame_rate
+    n_frames = len(samples) // frame_size
+    energy = np.mean(np.square(samples[:n_frames * frame_size].astype(np.float64).reshape(n_frames, frame_size)), axis=1)
+    smoothing_frames = max(1, int(round(SPLIT_ENERGY_SMOOTHING / frame_length)))
+    energy = np.convolve(energy, np.ones(smoothing_frames) / smoothing_frames, mode='same')
+
+    max_piece_frames = int(max_length / frame_length) - 1
+    min_piece_frames = max(1, int(max_piece_frames * SPLIT_MIN_PIECE_FRACTION))
+
+    cut_points = []
+    at_frame = 0
+    while n_frames - at_frame > max_piece_frames:
+        cut_frame = at_frame + min_piece_frames + int(np.argmin(energy[at_frame + min_piece_frames:at_frame + max_piece_frames]))
+        cut_points.append(cut_frame * frame_length)
+        at_frame = cut_frame
+    return cut_points
+
+def split_turn_intervals(complete_audio, start_sec, end_sec, max_length):
+    """Cuts an interval of audio longer than max_length seconds into pieces at its quietest points. Returns (start, end) of each piece"""
+
+    samples = np.frombuffer(complete_audio.get_window(start_sec, end_sec), dtype=np.int16)
+    cut_points = find_split_points(samples, complete_audio.frame_rate, max_length)
+    bounds = [start_sec] + [start_sec + c for c in cut_points] + [end_sec]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def stitch_piece_transcriptions(piece_results, turn_start):
+    """Joins transcriptions of the pieces of a turn, given by piece start second. Word offsets are made relative to the turn"""
+
+    results = [piece_results[piece_start] for piece_start in sorted(piece_results)]
+    raw_transcript = ' '.join(r[0] for r in results if r[0])
+    post_transcript = ' '.join(r[1] for r in results if r[1]) if any(r[1] is not None for r in results) else None
+
+    word_timing = None
+    if any(r[2] is not None for r in results):
+        word_timing = []
+        for piece_start in sorted(piece_results):
+            offset_fix = int(round((piece_start - turn_start) * AZURE_TICKS_PER_SEC))
+            for w in piece_results[piece_start][2] or []:
+                word = dict(w)
+                word['Offset'] = w['Offset'] + offset_fix
+                word_timing.append(word)
+
+    return raw_transcript, post_transcript, word_timing
+
+def read_turn_journal(journal_path, speaker_turns):
+    """Restores transcriptions recorded in a turn journal onto speaker turns. Returns indices of restored turns"""
+
+    restored = set()
+    with open(journal_path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                #Line cut short by a crash
+                continue
+
+            i = entry['index']
+            #Only accept entries that belong to the same turn segmentation
+            if i < len(speaker_turns) and speaker_turns[i]['start'] == entry['start'] and speaker_turns[i]['end'] == entry['end']:
+                speaker_turns[i].set_transcription(entry['rawtext'], entry['puncdtext'], entry['wordtiming'])
+                restored.add(i)
+    return restored
+
+def open_turn_journal(journal_path):
+    """Opens turn journal for appending, making sure a line cut short by a crash doesn't corrupt new entries"""
+
+    ends_with_newline = True
+    if os.path.exists(journal_path) and os.path.getsize(journal_path):
+        with open(journal_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            ends_with_newline = f.read(1) == b'\n'
+
+    journal = open(journal_path, 'a')
+    if not ends_with_newline:
+        journal.write('\n')
+    return journal
+
+def append_to_turn_journal(journal, index, turn):
+    """Appends a transcribed turn to journal and flushes it to disk"""
+
+    rawtext, puncdtext, wordtiming = turn.get_transcription()
+    entry = {'index': index, 'start': turn.start, 'end': turn.end, 
+             'rawtext': rawtext, 'puncdtext': puncdtext, 'wordtiming': wordtiming}
+    journal.write(json.dumps(entry) + '\n')
+    journal.flush()
+    os.fsync(journal.fileno())
+
+def transcribe_turns(complete_audio, speaker_turns, transcriber_func, speech_config=None, workers=DEFAULT_TRANSCRIPTION_WORKERS, chunk_cache=None, cache_namespace='', journal_path=None, executor=None, codec=WAV_CODEC, pack_length=0.0, max_chunk_length=None):
+    """Transcribes all speaker turns using a pool of worker threads. Results are placed back on the turns in their original order.
+    If a journal path is given, turns recorded there are not transcribed again and newly transcribed turns are appended to it.
+    An existing executor can be given to share its workers with other audio files.
+    If a pack length is given, consecutive short turns are sent together in requests of up to that many seconds. 
+    Turns longer than max_chunk_length are cut at pauses and their pieces are transcribed in parallel"""
+
+    restored = set()
+    if journal_path and os.path.exists(journal_path):
+        restored = read_turn_journal(journal_path, speaker_turns)
+        print("Resuming transcription, %i of %i turns found in journal %s"%(len(restored), len(speaker_turns), journal_path))
+
+    journal = open_turn_journal(journal_path) if journal_path else None
+
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    pending = [i for i in range(len(speaker_turns)) if i not in restored]
+    if pack_length:
+        packs = pack_turns(speaker_turns, pending, pack_length)
+        print("Packed %i turns into %i requests"%(len(pending), len(packs)))
+    else:
+        packs = [[i] for i in pending]
+
+    #Each request transcribes (turn index, interval) pairs: a pack of turns, a whole turn or a piece of an over-long turn
+    requests_to_send = []
+    piece_counts = {}
+    for pack in packs:
+        t = speaker_turns[pack[0]]
+        if len(pack) == 1 and max_chunk_length and t['end'] - t['start'] > max_chunk_length:
+            intervals = split_turn_intervals(complete_audio, t['start'], t['end'], max_chunk_length)
+            piece_counts[pack[0]] = len(intervals)
+            requests_to_send.extend(([pack[0]], [interval]) for interval in intervals)
+        else:
+            requests_to_send.append((pack, [(speaker_turns[i]['start'], speaker_turns[i]['end']) for i in pack]))
+    if piece_counts:
+        print("Cut %i over-long turns into %i pieces"%(len(piece_counts), sum(piece_counts.values())))
+
+    future_to_request = {}
+    piece_results = {}
+    try:
+        future_to_request = {executor.submit(get_transcription_of_pack, complete_audio, intervals, 
+                                             transcriber_func, speech_config, chunk_cache, cache_namespace, codec): (indices, intervals) 
+                             for indices, intervals in requests_to_send}
+
+        with tqdm(total=len(speaker_turns), initial=len(restored), desc="Transcribing segments") as progress_bar:
+            for future in concurrent.futures.as_completed(future_to_request):
+                indices, intervals = future_to_request[future]
+                for i, interval, result in zip(indices, intervals, future.result()):
+                    t = speaker_turns[i]
+                    if i in piece_counts:
+                        #Wait for all pieces of the turn
+                        piece_results.setdefault(i, {})[interval[0]] = result
+                        if len(piece_results[i]) < piece_counts[i]:
+                            continue
+                        result = stitch_piece_transcriptions(piece_results.pop(i), t['start'])
+
+                    t.set_transcription(*result)
+                    #print("%.2f-%.2f (%s): %s"%(t['start'], t['end'], t['speaker'], t['puncdtext']))
+                    if journal:
+                        append_to_turn_journal(journal, i, t)
+                    progress_bar.update(1)
+    finally:
+        #On failure, don't keep sending the turns that haven't started yet
+        for future in future_to_request:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
+        if journal:
+            journal.close()
+
+    return speaker_turns
+
 def dump_chunk(audio, start_sec, end_sec, chunk_path):
     """Cuts and places a chunk of audio to path (for revision)"""
 
-    start_ms = start_sec * 1000
-    end_ms = end_sec * 1000
-
-    audio_segment = audio[int(start_ms):int(end_ms)]
-    
     audio_chunk_filename = "%.2f"%start_sec + "-" + "%.2f"%end_sec + ".wav"
     audio_chunk_path = os.path.join(chunk_path, audio_chunk_filename)
     
-    audio_segment.export(audio_chunk_path, format="wav")
+    audio.export(start_sec, end_sec, audio_chunk_path)
     
     return audio_chunk_path
 
-def main():
+def fetch_audio(audio_input):
+    """Downloads audio if input is a URL and checks that the audio file exists. Returns local audio path"""
 
-    #Parse args
-    args = parser.parse_args()
+    #Check if input is URL
+    if validators.url(audio_input):
+        #Open download directory
+        if not os.path.exists(DOWNLOAD_PATH):
+            os.makedirs(DOWNLOAD_PATH)
+
+        audio_name = audio_input.split("/")[-1]
+        audio_path = os.path.join(DOWNLOAD_PATH, audio_name)
+
+        if not os.path.exists(audio_path):
+            print("Downloading audio given by URL")
+            #download audio
+            try:
+                response = requests.get(audio_input)
+                open(audio_path, 'wb').write(response.content)
+            except:
+                print("ERROR: Couldn't download audio file given by URL")
+                sys.exit()
+            print("Audio downloaded to", audio_path)
+        else:
+            print("Using cached audio file", audio_path)
+    else:
+        audio_path = audio_input
+        #Check audio file exists
+        if not os.path.exists(audio_path):
+            print("ERROR: File not found", audio_path)
+            sys.exit()
+
+    return audio_path
+
+def get_output_dir(audio_path, out_path):
+    """Determines (and creates) output directory of an audio file"""
+
+    if not out_path:
+        out_path = os.path.dirname(audio_path)
+    else:
+        if os.path.exists(out_path):
+            if not os.path.isdir(out_path):
+                print("ERROR: %s is a file"%out_path)
+                sys.exit()
+        else:
+            os.makedirs(out_path)
+    return out_path
+
+def get_output_paths(audio_path, out_path, translate_lang=None):
+    """Returns paths of all output files of an audio file"""
+
+    audio_id = os.path.splitext(os.path.basename(audio_path))[0]
+    paths = {'audio_id': audio_id,
+             'rawdiarization': os.path.join(out_path ,audio_id + '-rawdiarization.json'),
+             'emptyotr': os.path.join(out_path ,audio_id + '-diarization.otr'),
+             'finalotr': os.path.join(out_path ,audio_id + '-autotemplate.otr'),
+             'txt': os.path.join(out_path ,audio_id + '-transcript.txt'),
+             'jsonl': os.path.join(out_path ,audio_id + '-transcript.jsonl'),
+             'srt': os.path.join(out_path ,audio_id + '-subtitles.srt'),
+             'vtt': os.path.join(out_path ,audio_id + '-subtitles.vtt'),
+             'reviseddiarization': os.path.join(out_path ,audio_id + '-reviseddiarization.json'),
+             'mapping': os.path.join(out_path ,audio_id + '-spkrevisionmap.json'),
+             'asr': os.path.join(out_path, audio_id + '-asr.json'),
+             'asrjournal': os.path.join(out_path, audio_id + '-asrjournal.jsonl'),
+             'metrics': os.path.join(out_path, audio_id + '-metrics.json'),
+             'manifest': os.path.join(out_path, audio_id + '-manifest.json')}
+    if translate_lang:
+        paths['translatedsrt'] = os.path.join(out_path ,audio_id + '-subtitles_' + translate_lang + '.srt')
+        paths['translatedvtt'] = os.path.join(out_path ,audio_id + '-subtitles_' + translate_lang + '.vtt')
+    return paths
+
+def perform_diarization(complete_audio, diarize, out_json_path, sad_processes=1, sad_shard_length=DEFAULT_SAD_SHARD_LENGTH, min_speech=0.0, min_gap=0.0):
+    """Runs diarization or speech activity detection on audio and dumps its raw output"""
+
+    if diarize:
+        print("Performing diarization")
+        diarization_result = do_pyannote(complete_audio.wav_path, PYANNOTE_DIARIZATION_TAG)
+        diarization_dict = diarization_result.for_json()
+    elif sad_processes > 1 and complete_audio.duration > sad_shard_length:
+        diarization_dict = do_sharded_sad(complete_audio, sad_processes, sad_shard_length, min_speech, min_gap)
+    else:
+        print("Performing speech activity detection")
+        sad_result = do_pyannote(complete_audio.wav_path, PYANNOTE_SAD_TAG)
+        diarization_dict = sad_result_to_diarization_dict(sad_result, min_speech, min_gap)
+
+    #Write intermediate JSON to file
+    with open(out_json_path, 'w') as f:
+        print("Dumping raw diarization output", out_json_path)
+        f.write(json.dumps(diarization_dict))
+
+    return diarization_dict
+
+def initialize_transcription(args, scheduler=None):
+    """Determines ASR procedure to use and initializes transcription service and cache"""
 
-    audio_input = args.audio
-    out_path = args.out
     lang = args.lang
-    translate_lang = args.translate
     azure_asr_token = args.azureasrtoken
-    azure_translate_token = args.azuretranslatetoken
     azure_region = args.azureregion
     asr_service = args.transcribe
-    punctoken = args.punctoken
-    turn_on = args.turn
-    write_speaker_id = args.sid
     asr_api_url_endpoint = args.apiurl
-    skip_revision_query = args.skiprevision
-    max_turn_length = args.spanlength
-    diarize = args.diarize
     bypass_azure_sdk = args.bypassazuresdk
+    use_cache = not args.nocache
+    transcribe_func = None
+    speech_config = None
+    codec = WAV_CODEC
 
-    #Input checks
-    if not audio_input:
-        print("ERROR: Specify input audio path or URL (-i)")
-        sys.exit()
-
-    if asr_service and not lang:
-        print("ERROR: Specify audio language with -l")
-        sys.exit()
-
-    #Determine ASR procedure to use
+    #Determine ASR procedure to use (service options are checked by validate_args)
     if asr_service:
         if asr_service==AZURE_ASR_FLAG:
-            if asr_service==AZURE_ASR_FLAG and not azure_asr_token:
-                print("ERROR: Specify service token to use Azure transcription (-a)")
-                sys.exit()
-
             if not bypass_azure_sdk:
                 transcribe_func = transcribe_with_azure_sdk
-                initialize_azure_config = initialize_azure_config_sdk
             else:
                 transcribe_func = transcribe_with_azure_requests
-                initialize_azure_config = initialize_azure_config_requests
         elif asr_service == ASR_API_FLAG:
             transcribe_func = transcribe_with_asr_api
-        else:
-            print("ERROR: ASR service %s not supported. Select from %s"%(asr_service, SUPPORTED_ASR_SERVICE_TAGS))
-            sys.exit()
 
     elif DUMMY_TRANSCRIPTION:
         transcribe_func = dummy_transcriber
 
-    if turn_on == TURN_ON_SEGMENT_FLAG:
-        turn_on_segment = True
-    elif turn_on == TURN_ON_SPAN_FLAG:
-        turn_on_segment = False
-    else:
-        print("ERROR: Unknown turn flag %s. It needs to be %s"%(turn_on,' or '.join(TURN_ON_FLAGS)))
-        sys.exit()
+    #All requests to ASR and translation services go through one scheduler, so that rate and concurrency limits hold for all of them
+    #(transcription and translation don't run at the same time, so their concurrency limit is the larger of the two)
+    if scheduler is None:
+        scheduler = RequestScheduler(max(args.workers, args.translateworkers), args.ratelimit, args.retries)
+
+    #Initialize transcription service. HTTP backends share a pooled transport with a connection per worker
+    request_metrics = None
+    if asr_service in SUPPORTED_ASR_SERVICE_TAGS:
+        request_metrics = RequestMetrics(asr_service)
+        transport = Transport(pool_size=args.workers, http2=args.http2, metrics=request_metrics, scheduler=scheduler)
 
-    #Initialize transcription service
     if asr_service == ASR_API_FLAG:
-        speech_config = initialize_api_config(lang, asr_api_url_endpoint)
+        speech_config = initialize_api_config(lang, asr_api_url_endpoint, transport=transport, codec=args.codec)
         if not speech_config:
             print("Couldn't initialize ASR API. Exiting.")
             sys.exit()
+        codec = speech_config['codec']
     elif asr_service == AZURE_ASR_FLAG:
-        speech_config = initialize_azure_config(azure_asr_token, lang, azure_region)
+        if not bypass_azure_sdk:
+            speech_config = initialize_azure_config_sdk(azure_asr_token, lang, azure_region)
+            codec = select_upload_codec(args.codec, AZURE_SDK_CODECS, "Azure speech SDK")
+        else:
+            speech_config = initialize_azure_config_requests(azure_asr_token, lang, azure_region, transport=transport, codec=args.codec, endpoint=args.azureurl)
         if not speech_config:
             print("Couldn't initialize Azure ASR. Exiting.")
             sys.exit()
+        if bypass_azure_sdk:
+            codec = speech_config['codec']
     elif DUMMY_TRANSCRIPTION:
         print("Dummy transcription for debugging")
         asr_service = True
         speech_config = None
+        use_cache = False
     else:
         asr_service = None
 
-    #Check if input is URL
-    if validators.url(audio_input):
-        #Open download directory
-        if not os.path.exists(DOWNLOAD_PATH):
-            os.makedirs(DOWNLOAD_PATH)
-
-        audio_name = audio_input.split("/")[-1]
-        audio_path = os.path.join(DOWNLOAD_PATH, audio_name)
-
-        if not os.path.exists(audio_path):
-            print("Downloading audio given by URL")
-            #download audio
-            try:
-                response = requests.get(audio_input)
-                open(audio_path, 'wb').write(response.content)
-            except:
-                print("ERROR: Couldn't download audio file given by URL")
-                sys.exit()
-            print("Audio downloaded to", audio_path)
-        else:
-            print("Using cached audio file", audio_path)
+    #Longer turns are cut to what the service takes in one request
+    if args.maxchunk is not None:
+        max_chunk_length = args.maxchunk
+    elif asr_service == AZURE_ASR_FLAG:
+        max_chunk_length = AZURE_REST_MAX_CHUNK_LENGTH if bypass_azure_sdk else AZURE_SDK_MAX_CHUNK_LENGTH
     else:
-        audio_path = audio_input
-        #Check audio file exists
-        if not os.path.exists(audio_path):
-            print("ERROR: File not found", audio_path)
-            sys.exit()
+        max_chunk_length = None
+
+    #Packed turns are split back by word timings, which ASR-API doesn't give. 
+    #Azure SDK recognizes a single utterance per request, which ends at the silence after the first packed turn
+    pack_length = args.pack
+    if pack_length and asr_service == ASR_API_FLAG:
+        print("WARNING: ASR API gives no word timings, turns are not packed")
+        pack_length = 0.0
+    elif pack_length and asr_service == AZURE_ASR_FLAG and not bypass_azure_sdk:
+        print("WARNING: Azure speech SDK stops at the first pause of a request, turns are only packed with REST API (-b)")
+        pack_length = 0.0
+    elif pack_length and max_chunk_length and pack_length > max_chunk_length:
+        print("WARNING: Pack length is limited to %.1f seconds"%max_chunk_length)
+        pack_length = max_chunk_length
+
+    #Transcriptions depend on the service, language and endpoint (and lossy codec), and on how audio is cut into requests
+    asr_endpoint = None
+    if asr_service == ASR_API_FLAG:
+        asr_endpoint = asr_api_url_endpoint
+    elif asr_service == AZURE_ASR_FLAG:
+        asr_endpoint = speech_config['url'] if bypass_azure_sdk else 'sdk:' + azure_region
+    asr_params = None
+    if asr_service:
+        asr_params = {'service': asr_service, 'lang': lang, 'endpoint': asr_endpoint, 'codec': codec if codec in LOSSY_CODECS else None,
+                      'pack_length': pack_length, 'max_chunk_length': max_chunk_length,
+                      'continuous': asr_service == AZURE_ASR_FLAG and not bypass_azure_sdk and args.continuous}
+
+    #Open transcription cache. Results are reusable only for the same service, language and endpoint (and lossy codec)
+    chunk_cache = None
+    cache_namespace = ''
+    if asr_service and use_cache:
+        cache_namespace = '|'.join([asr_service, lang, asr_endpoint] + ([codec] if codec in LOSSY_CODECS else []))
+        chunk_cache = ChunkCache(os.path.join(args.cachedir, CHUNK_CACHE_FILENAME), args.cachesize)
+
+    return {'service': asr_service, 'transcribe_func': transcribe_func, 'speech_config': speech_config, 
+            'chunk_cache': chunk_cache, 'cache_namespace': cache_namespace, 'codec': codec, 'pack_length': pack_length,
+            'max_chunk_length': max_chunk_length, 'request_metrics': request_metrics, 'params': asr_params, 'scheduler': scheduler,
+            'continuous': asr_service == AZURE_ASR_FLAG and not bypass_azure_sdk and args.continuous}
+
+def process_audio(audio_path, out_path, args, transcription, executor=None, metrics=None):
+    """Runs diarization, revision, transcription and output steps on an audio file. 
+    Time and memory taken by each step are written to a metrics file, also when a step fails"""
+
+    paths = get_output_paths(audio_path, out_path, args.translate)
+    if not metrics:
+        metrics = RunMetrics()
+    metrics.audio_id = paths['audio_id']
+    if transcription.get('request_metrics'):
+        metrics.track_requests(transcription['request_metrics'])
+
+    #Ensure wav format input and map it for windowed access (deferred until a stage needs audio)
+    audio_store_path = os.path.join(args.cachedir, os.path.basename(AUDIO_STORE_PATH))
+    complete_audio = LazyAudioSource(audio_path, metrics.timed('audio_convert', functools.partial(audio_convert, store_path=audio_store_path)),
+                                     metrics.timed('audio_load', WavAudioSource))
 
-    #Determine output path
-    if not out_path:
-        out_path = os.path.dirname(audio_path)
-    else:
-        if os.path.exists(out_path):
-            if not os.path.isdir(out_path):
-                print("ERROR: %s is a file"%out_path)
-                sys.exit()
-        else:
-            os.mkdir(out_path)
+    try:
+        run_audio_stages(audio_path, paths, args, transcription, complete_audio, executor, metrics)
+    except BaseException as e:
+        metrics.error = repr(e)
+        raise
+    finally:
+        #Real-time factors are known only if the audio was needed (it isn't when all steps are read from earlier outputs)
+        metrics.audio_duration = complete_audio.duration if complete_audio.loaded else None
+        complete_audio.close()
+
+        print("Dumping run metrics", paths['metrics'])
+        metrics.write_json(paths['metrics'])
+        if args.prometheus:
+            if not os.path.exists(args.prometheus):
+                os.makedirs(args.prometheus)
+            metrics.write_prometheus(os.path.join(args.prometheus, 'autotemplater-%s.prom'%paths['audio_id']))
+
+    return paths
+
+def run_audio_stages(audio_path, paths, args, transcription, complete_audio, executor, metrics):
+    """Steps of process_audio from diarization to writing outputs"""
+
+    lang = args.lang
+    translate_lang = args.translate
+    azure_translate_token = args.azuretranslatetoken
+    turn_on_segment = args.turn == TURN_ON_SEGMENT_FLAG
+    write_speaker_id = args.sid
+    skip_revision_query = args.skiprevision
+    max_turn_length = args.spanlength
+    diarize = args.diarize
+    transcription_workers = args.workers
+    cache_dir = args.cachedir
+    use_cache = not args.nocache
+    output_formats = args.formats.split(',')
+    subtitle_formats = [f for f in SUBTITLE_FORMATS if f in output_formats]
+
+    asr_service = transcription['service']
+    transcribe_func = transcription['transcribe_func']
+    speech_config = transcription['speech_config']
+    chunk_cache = transcription['chunk_cache']
+    cache_namespace = transcription['cache_namespace']
 
     #Determine revision path (TODO: Hardwired for now)
     revision_path = REVISION_PATH
 
-    #Report on setup
-    print("ASR Service:", asr_service)
-    if asr_service == AZURE_ASR_FLAG:
-        print("Use Azure SDK", not bypass_azure_sdk)
-    print("Output path:", out_path)
-    print('Turn on segment:', turn_on_segment)
-    print("Maximum turn length: %f s"%max_turn_length)
-    print("Speaker diarization:", diarize)
-    print("Skip diarization revision:", skip_revision_query)
-
     #Output files 
-    audio_id = os.path.splitext(os.path.basename(audio_path))[0]
-    out_json_path = os.path.join(out_path ,audio_id + '-rawdiarization.json')
-    out_empty_otr_path = os.path.join(out_path ,audio_id + '-diarization.otr')
-    out_final_otr_path = os.path.join(out_path ,audio_id + '-autotemplate.otr')
-    out_txt_path = os.path.join(out_path ,audio_id + '-transcript.txt')
-    out_srt_path = os.path.join(out_path ,audio_id + '-subtitles.srt')
-    out_mapped_json_path = os.path.join(out_path ,audio_id + '-reviseddiarization.json')
-    out_mapping_path = os.path.join(out_path ,audio_id + '-spkrevisionmap.json')
-    out_asr_path = os.path.join(out_path, audio_id + '-asr.json') 
-    if translate_lang:
-        out_translated_srt_path = os.path.join(out_path ,audio_id + '-subtitles_' + translate_lang + '.srt')
-
-    #Ensure wav format input
-    wav_path = audio_convert(audio_path)
-
-    #Read audio to memory
-    complete_audio = AudioSegment.from_wav(wav_path)
+    audio_id = paths['audio_id']
+    out_json_path = paths['rawdiarization']
+    out_empty_otr_path = paths['emptyotr']
+    out_mapped_json_path = paths['reviseddiarization']
+    out_mapping_path = paths['mapping']
+    out_asr_path = paths['asr']
+    out_asr_journal_path = paths['asrjournal']
+
+    #Outputs of earlier runs are reused only if the manifest shows they were made from the same inputs and parameters
+    manifest = StageManifest(paths['manifest'])
+    diarization_inputs = get_diarization_inputs(manifest, audio_path, diarize, args.minspeech, args.mingap)
+    revision_inputs = {'diarization': get_fingerprint('diarization', diarization_inputs)}
 
     #Perform (or read) diarization
-    if os.path.exists(out_mapped_json_path):
+    if manifest.is_current('diarization', diarization_inputs, out_json_path):
         #Load diarization dictionary
+        print("Reading raw diarization output", out_json_path)
+        with open(out_json_path, 'r') as f:
+            diarization_dict_data = f.read()
+            
+        diarization_dict = json.loads(diarization_dict_data)
+    else:
+        with metrics.stage('diarization'):
+            diarization_dict = perform_diarization(complete_audio, diarize, out_json_path, args.sadprocesses, args.shardlength, 
+                                                   args.minspeech, args.mingap)
+        manifest.record('diarization', diarization_inputs, out_json_path)
+    turns_diarization_fingerprint = revision_inputs['diarization']
+
+    if manifest.is_current('revision', revision_inputs, out_mapped_json_path):
+        #Load revised diarization dictionary
         print("Reading revised diarization output", out_mapped_json_path)
         with open(out_mapped_json_path, 'r') as f:
             diarization_dict_data = f.read()
             
         diarization_dict = json.loads(diarization_dict_data)
+        #Revised diarization also depends on the speaker labels given by the user, so its content is fingerprinted for the stages after it
+        turns_diarization_fingerprint = get_fingerprint('revision', dict(revision_inputs, revised=get_content_hash(diarization_dict_data)))
         if not skip_revision_query:
             skip_revision_query = True
             print("WARNING: Skipping diarization revision since revised diarization is found")
-    elif os.path.exists(out_json_path):
-        #Load diarization dictionary
-        print("Reading raw diarization output", out_json_path)
-        with open(out_json_path, 'r') as f:
-            diarization_dict_data = f.read()
-            
-        diarization_dict = json.loads(diarization_dict_data)
-    else:
-        if diarize:
-            print("Performing diarization")
-            diarization_result = do_pyannote(wav_path, PYANNOTE_DIARIZATION_TAG)
-            diarization_dict = diarization_result.for_json()
-        else:
-            print("Performing speech activity detection")
-            sad_result = do_pyannote(wav_path, PYANNOTE_SAD_TAG)
-            diarization_dict = sad_result_to_diarization_dict(sad_result)
-
-        #Write intermediate JSON to file
-        with open(out_json_path, 'w') as f:
-            print("Dumping raw diarization output", out_json_path)
-            f.write(json.dumps(diarization_dict))
 
     #Print speakers data
     print_speakers_data(diarization_dict)
@@ -591,171 +1276,449 @@ def main():
     do_revision = False
     apply_ready_map = False
     mapped_diarization_dict = diarization_dict
-    if diarize and not skip_revision_query:
-        #Perform speaker label revision (optional)
-        perform_revision_input = input("Do you want to revise speaker labels? (y for yes) ")
-        speaker_label_map_dict = {}
-        
-        if perform_revision_input == 'y' or perform_revision_input == 'Y':
-            
-            if os.path.exists(out_mapping_path):
-                print("Found a mapping file with following info")
-                with open(out_mapping_path, 'r') as f:
-                    mapping_dict = f.read()
-                
-                speaker_label_map_dict = json.loads(mapping_dict)
-                print(mapping_dict)
-                use_savedmapping_input = input("Do you want to use it? (y for yes) ")
-                if use_savedmapping_input == 'y' or use_savedmapping_input == 'Y':
-                    apply_ready_map = True
+    with metrics.stage('revision'):
+        if diarize and not skip_revision_query:
+            #Perform speaker label revision (optional)
+            perform_revision_input = input("Do you want to revise speaker labels? (y for yes) ")
+            speaker_label_map_dict = {}
+
+            if perform_revision_input == 'y' or perform_revision_input == 'Y':
+
+                if os.path.exists(out_mapping_path):
+                    print("Found a mapping file with following info")
+                    with open(out_mapping_path, 'r') as f:
+                        mapping_dict = f.read()
+
+                    speaker_label_map_dict = json.loads(mapping_dict)
+                    print(mapping_dict)
+                    use_savedmapping_input = input("Do you want to use it? (y for yes) ")
+                    if use_savedmapping_input == 'y' or use_savedmapping_input == 'Y':
+                        apply_ready_map = True
+                    else:
+                        do_revision = True
                 else:
                     do_revision = True
-            else:
-                do_revision = True
-
-    if do_revision:
-        #Open directory for revision
-        if not os.path.exists(revision_path):
-            os.makedirs(revision_path)
-
-        #Do revision
-        speaker_segments = {}
-        for i, segment_info in enumerate(diarization_dict['content']):
-            if segment_info['label'] not in speaker_segments:
-                speaker_segments[segment_info['label']] = [i]
-            else:
-                speaker_segments[segment_info['label']].append(i)
 
-        project_revision_path = os.path.join(revision_path, audio_id)
+        if do_revision:
+            #Open directory for revision
+            if not os.path.exists(revision_path):
+                os.makedirs(revision_path)
+
+            #Do revision
+            speaker_segments = {}
+            for i, segment_info in enumerate(diarization_dict['content']):
+                if segment_info['label'] not in speaker_segments:
+                    speaker_segments[segment_info['label']] = [i]
+                else:
+                    speaker_segments[segment_info['label']].append(i)
 
-        if not os.path.exists(project_revision_path):
-            os.makedirs(project_revision_path)
+            project_revision_path = os.path.join(revision_path, audio_id)
 
-        print("Revise speaker samples from path " + project_revision_path)
+            if not os.path.exists(project_revision_path):
+                os.makedirs(project_revision_path)
 
-        for spk in speaker_segments:
-            print(spk)
-            spk_utt_ids = speaker_segments[spk]
-            pick_no = SAMPLE_COUNT if SAMPLE_COUNT < len(spk_utt_ids) else len(spk_utt_ids)
-            
-            pick = random.sample(spk_utt_ids, pick_no)
-            
-            #Open directory for spk under revision
-            spk_revision_path = os.path.join(project_revision_path, spk)
-            if not os.path.exists(spk_revision_path):
-                os.makedirs(spk_revision_path)
-            
-            #Cut and place utterances under directory
-            for utt_id in pick:
-                utt_path = dump_chunk(complete_audio, 
-                                      float(diarization_dict['content'][utt_id]['segment']['start']), 
-                                      float(diarization_dict['content'][utt_id]['segment']['end']), 
-                                      spk_revision_path)
-                print(utt_path)
-                
-            print()
-
-        print("Please specify names for each label")
-        for spk in speaker_segments:
-            mapto = input(spk + " is... ")
-            speaker_label_map_dict[spk] = mapto
-            
-        with open(out_mapping_path, 'w') as f:
-            print("Dumping mapping data", out_mapping_path)
-            f.write(json.dumps(speaker_label_map_dict))
-
-    if do_revision or apply_ready_map:
-        #From here if reading map from file
-        print("Revised speaker labels")
-
-        reversed_speaker_label_map_dict = {}
-        for org_label in speaker_label_map_dict:
-            new_label = speaker_label_map_dict[org_label]
-            if new_label in reversed_speaker_label_map_dict:
-                reversed_speaker_label_map_dict[new_label].append(org_label)
-            else:
-                reversed_speaker_label_map_dict[new_label] = [org_label]
-            
-        print(reversed_speaker_label_map_dict)
+            print("Revise speaker samples from path " + project_revision_path)
 
-        #Update diarization dict with new label set
-        mapped_diarization_dict = diarization_dict.copy()
-        for segment in mapped_diarization_dict['content']:
-            old_label = segment['label']
-            segment['label'] = speaker_label_map_dict[old_label]
+            for spk in speaker_segments:
+                print(spk)
+                spk_utt_ids = speaker_segments[spk]
+                pick_no = SAMPLE_COUNT if SAMPLE_COUNT < len(spk_utt_ids) else len(spk_utt_ids)
 
-        #Write intermediate JSON to file
-        with open(out_mapped_json_path, 'w') as f:
-            print("Dumping mapped diarization output", out_mapped_json_path)
-            f.write(json.dumps(mapped_diarization_dict))
+                pick = random.sample(spk_utt_ids, pick_no)
 
-        if do_revision:
-            #Remove revision path
-            shutil.rmtree(project_revision_path)
+                #Open directory for spk under revision
+                spk_revision_path = os.path.join(project_revision_path, spk)
+                if not os.path.exists(spk_revision_path):
+                    os.makedirs(spk_revision_path)
+
+                #Cut and place utterances under directory
+                for utt_id in pick:
+                    utt_path = dump_chunk(complete_audio, 
+                                          float(diarization_dict['content'][utt_id]['segment']['start']), 
+                                          float(diarization_dict['content'][utt_id]['segment']['end']), 
+                                          spk_revision_path)
+                    print(utt_path)
+
+                print()
+
+            print("Please specify names for each label")
+            for spk in speaker_segments:
+                mapto = input(spk + " is... ")
+                speaker_label_map_dict[spk] = mapto
+
+            with open(out_mapping_path, 'w') as f:
+                print("Dumping mapping data", out_mapping_path)
+                f.write(json.dumps(speaker_label_map_dict))
+
+        if do_revision or apply_ready_map:
+            #From here if reading map from file
+            print("Revised speaker labels")
+
+            reversed_speaker_label_map_dict = {}
+            for org_label in speaker_label_map_dict:
+                new_label = speaker_label_map_dict[org_label]
+                if new_label in reversed_speaker_label_map_dict:
+                    reversed_speaker_label_map_dict[new_label].append(org_label)
+                else:
+                    reversed_speaker_label_map_dict[new_label] = [org_label]
+
+            print(reversed_speaker_label_map_dict)
+
+            #Update diarization dict with new label set
+            mapped_diarization_dict = diarization_dict.copy()
+            for segment in mapped_diarization_dict['content']:
+                old_label = segment['label']
+                segment['label'] = speaker_label_map_dict[old_label]
+
+            #Write intermediate JSON to file
+            mapped_diarization_dict_data = json.dumps(mapped_diarization_dict)
+            with open(out_mapped_json_path, 'w') as f:
+                print("Dumping mapped diarization output", out_mapped_json_path)
+                f.write(mapped_diarization_dict_data)
+            manifest.record('revision', revision_inputs, out_mapped_json_path)
+            turns_diarization_fingerprint = get_fingerprint('revision', dict(revision_inputs, revised=get_content_hash(mapped_diarization_dict_data)))
+
+            if do_revision:
+                #Remove revision path
+                shutil.rmtree(project_revision_path)
 
     #Make empty OTR template
     print("Converting segments to turns")
-    speaker_turns = get_speaker_turns(mapped_diarization_dict['content'], turn_on_segment, max_turn_length = max_turn_length)
+    with metrics.stage('turns'):
+        speaker_turns = get_speaker_turns(mapped_diarization_dict['content'], turn_on_segment, max_turn_length = max_turn_length)
 
     #print(speaker_turns) #DEBUG
     
     #Write empty template to disk
     print("Dumping diarized template", out_empty_otr_path)
-    speaker_turns_to_otr(speaker_turns, out_empty_otr_path, write_speaker_id)
+    with metrics.stage('render'):
+        speaker_turns_to_otr(speaker_turns, out_empty_otr_path, write_speaker_id)
+
+    #Transcription depends on the turns and the ASR service. Without a service given, transcription of an earlier run is used whichever service made it
+    transcription_inputs = {'diarization': turns_diarization_fingerprint, 'turn': args.turn, 
+                            'spanlength': max_turn_length if not turn_on_segment else None,
+                            'asr': transcription['params'] if asr_service else (manifest.get_inputs('transcription') or {}).get('asr')}
+    transcription_is_current = manifest.is_current('transcription', transcription_inputs, out_asr_path)
+
     got_transcription = False
-    if asr_service and not os.path.exists(out_asr_path):
-        
-        #Create temp directory to store audio chunks
-        tmp_dir_path = tempfile.mkdtemp()
-        print("Temp dir:", tmp_dir_path) #DEBUG
-        
-        #Transcribe speaker turns
-        for t in tqdm(speaker_turns, desc="Transcribing segments"):
-            t['rawtext'], t['puncdtext'], t['wordtiming'] = get_transcription_of_chunk(complete_audio, t['start'], t['end'], tmp_dir_path, transcribe_func, speech_config)
-            #print("%.2f-%.2f (%s): %s"%(t['start'], t['end'], t['speaker'], t['puncdtext']))
-
-        #DEBUG
-        #print("----")
-        #for s in speaker_turns:
-        #    print(s)
-        #print("----")
-
-        #Write transcribed turns to a JSON file
-        with open(out_asr_path, 'w') as f:
+    with metrics.stage('transcription'):
+        if asr_service and not transcription_is_current and transcription['continuous']:
+            #Transcribe whole audio in one session and place recognized text on speaker turns by time
+            utterances = transcribe_with_azure_sdk_continuous(complete_audio.wav_path, speech_config, complete_audio.duration)
+            assign_utterances_to_turns(utterances, speaker_turns)
+
+            print("Dumping transcribed turns data", out_asr_path)
+            dump_turns(speaker_turns, out_asr_path)
+            manifest.record('transcription', transcription_inputs, out_asr_path)
+
+            got_transcription = True
+        elif asr_service and not transcription_is_current:
+            #Transcribe speaker turns (resuming from journal of an interrupted run with the same inputs if there's one)
+            if os.path.exists(out_asr_journal_path) and not manifest.is_current('transcription_journal', transcription_inputs, out_asr_journal_path):
+                os.remove(out_asr_journal_path)
+            manifest.record('transcription_journal', transcription_inputs, out_asr_journal_path)
+
+            transcribe_turns(complete_audio, speaker_turns, transcribe_func, speech_config, workers=transcription_workers, 
+                             chunk_cache=chunk_cache, cache_namespace=cache_namespace, journal_path=out_asr_journal_path, executor=executor,
+                             codec=transcription['codec'], pack_length=transcription['pack_length'],
+                             max_chunk_length=transcription['max_chunk_length'])
+
+            #DEBUG
+            #print("----")
+            #for s in speaker_turns:
+            #    print(s)
+            #print("----")
+
+            #Compact journal into transcribed turns JSON file
             print("Dumping transcribed turns data", out_asr_path)
-            f.write(json.dumps(speaker_turns))
+            dump_turns(speaker_turns, out_asr_path + '.tmp')
+            os.replace(out_asr_path + '.tmp', out_asr_path)
+            os.remove(out_asr_journal_path)
+            manifest.record('transcription', transcription_inputs, out_asr_path)
+            manifest.forget('transcription_journal')
 
-        #Remove temp directory
-        shutil.rmtree(tmp_dir_path)
-        got_transcription = True
-    elif os.path.exists(out_asr_path):
-        print("Reading transcribed JSON", out_asr_path)
-        with open(out_asr_path) as f:
-            speaker_turns = json.load(f)
-        got_transcription = True
+            got_transcription = True
+        elif transcription_is_current:
+            print("Reading transcribed JSON", out_asr_path)
+            speaker_turns = load_turns(out_asr_path)
+            got_transcription = True
 
 
     if got_transcription:
-        #Write transcribed template to disk
-        print("Dumping transcribed template", out_final_otr_path)
-        speaker_turns_to_otr(speaker_turns, out_final_otr_path, write_speaker_id)
+        #Write transcribed template and transcripts to disk in one pass over the turns
+        transcript_paths = {f: paths[OUTPUT_FORMAT_PATHS[f]] for f in TRANSCRIPT_FORMATS if f in output_formats}
+        if transcript_paths:
+            print("Dumping transcribed template and text", ' '.join(transcript_paths.values()))
+            with metrics.stage('render'):
+                write_turns(speaker_turns, transcript_paths, write_speaker_id)
+
+        if subtitle_formats:
+            if translate_lang:
+                #Translations of other endpoints (e.g. a mock) are kept out of the translation memory
+                use_memory = use_cache and args.translatorurl == AZURE_TRANSLATOR_URL
+                translation_memory_path = os.path.join(cache_dir, TRANSLATION_MEMORY_FILENAME) if use_memory else None
+                translator_request_metrics = RequestMetrics('translator')
+                metrics.track_requests(translator_request_metrics)
+                translator_transport = Transport(pool_size=args.translateworkers, http2=args.http2, metrics=translator_request_metrics,
+                                                 scheduler=transcription['scheduler'])
+                translator = get_azure_translator(lang, translate_lang, azure_translate_token, endpoint=args.translatorurl,
+                                                  memory_path=translation_memory_path, workers=args.translateworkers, transport=translator_transport)
+                translator = metrics.timed('translation', translator)
+            else:
+                translator = None
+
+            with metrics.stage('segmentation'):
+                sentence_turns, sentence_turns_translated = segment_turns(speaker_turns, translator_func=translator)
+
+            subtitle_paths = {f: paths[OUTPUT_FORMAT_PATHS[f]] for f in subtitle_formats}
+            print("Dumping subtitles", ' '.join(subtitle_paths.values()))
+            with metrics.stage('render'):
+                write_turns(sentence_turns, subtitle_paths, txttag='puncdtext')
+
+            if translate_lang:
+                translated_subtitle_paths = {f: paths['translated' + f] for f in subtitle_formats}
+                print("Dumping translated subtitles in %s"%translate_lang, ' '.join(translated_subtitle_paths.values()))
+                with metrics.stage('render'):
+                    write_turns(sentence_turns_translated, translated_subtitle_paths, txttag='translated')
+
+def get_diarization_inputs(manifest, audio_path, diarize, min_speech=0.0, min_gap=0.0):
+    """Inputs and parameters diarization output depends on. 
+    Sharding of speech activity detection is left out as it gives the same segments"""
+
+    inputs = {'audio': manifest.get_audio_fingerprint(audio_path, get_file_hash), 
+              'activity': PYANNOTE_DIARIZATION_TAG if diarize else PYANNOTE_SAD_TAG}
+    if not diarize:
+        inputs.update({'minspeech': min_speech, 'mingap': min_gap})
+    return inputs
+
+def has_diarization_output(audio_path, out_path, diarize, min_speech=0.0, min_gap=0.0):
+    """Checks if an audio file has raw diarization output made with the same inputs"""
+
+    paths = get_output_paths(audio_path, out_path)
+    manifest = StageManifest(paths['manifest'])
+    return manifest.is_current('diarization', get_diarization_inputs(manifest, audio_path, diarize, min_speech, min_gap), paths['rawdiarization'])
+
+def diarize_batch_item(audio_path, out_path, diarize, min_speech=0.0, min_gap=0.0, audio_store_path=AUDIO_STORE_PATH):
+    """Batch worker step: makes sure raw diarization of an audio file exists on disk and is recorded in its manifest"""
+
+    paths = get_output_paths(audio_path, out_path)
+    manifest = StageManifest(paths['manifest'])
+    diarization_inputs = get_diarization_inputs(manifest, audio_path, diarize, min_speech, min_gap)
+    if manifest.is_current('diarization', diarization_inputs, paths['rawdiarization']):
+        return
+
+    complete_audio = LazyAudioSource(audio_path, functools.partial(audio_convert, store_path=audio_store_path))
+    perform_diarization(complete_audio, diarize, paths['rawdiarization'], min_speech=min_speech, min_gap=min_gap)
+    manifest.record('diarization', diarization_inputs, paths['rawdiarization'])
+    complete_audio.close()
+
+def get_batch_audio_paths(batch_input):
+    """Lists audio inputs given by a directory, a glob pattern or a manifest file (one path or URL per line)"""
+
+    if os.path.isdir(batch_input):
+        candidates = sorted(os.path.join(batch_input, f) for f in os.listdir(batch_input)
+                            if os.path.splitext(f)[1][1:].lower() in AUDIO_EXTENSIONS)
+
+        #Converted wavs placed next to their source are not separate inputs
+        sources = {}
+        for audio_path in candidates:
+            stem = os.path.splitext(audio_path)[0]
+            if stem not in sources or sources[stem].lower().endswith('.wav'):
+                sources[stem] = audio_path
+        return sorted(sources.values())
+    elif glob.has_magic(batch_input):
+        return sorted(glob.glob(batch_input))
+    elif os.path.isfile(batch_input):
+        with open(batch_input, 'r') as f:
+            return [l.strip() for l in f if l.strip() and not l.strip().startswith('#')]
+    else:
+        print("ERROR: Batch input %s is not a directory, glob pattern or manifest file"%batch_input)
+        sys.exit()
 
-        print("Dumping transcribed text", out_txt_path)
-        speaker_turns_to_txt(speaker_turns, out_txt_path, write_speaker_id)
+def process_batch(args, transcription):
+    """Processes several audio files. Diarization runs on a process pool where each worker loads pyannote pipelines once.
+    Files are transcribed at the same time (up to one per transcription worker), sharing one pool of transcription workers"""
 
-        if translate_lang:
-            translator = get_azure_translator(lang, translate_lang, azure_translate_token)
-        else:
-            translator = None
+    audio_inputs = get_batch_audio_paths(args.batch)
+    print("Batch of %i audio files"%len(audio_inputs))
+
+    if args.diarize and not args.skiprevision:
+        print("WARNING: Skipping diarization revision in batch mode")
+    args.skiprevision = True
 
-        sentence_turns, sentence_turns_translated = segment_turns(speaker_turns, translator_func=translator)
+    status = {audio_input: {'audio': audio_input, 'status': 'pending'} for audio_input in audio_inputs}
 
-        print("Dumping SRT subtitles", out_srt_path)
-        speaker_turns_to_srt(sentence_turns, out_srt_path, txttag='puncdtext')
+    #Fetch audio and determine output locations
+    batch_items = {}
+    for audio_input in audio_inputs:
+        try:
+            audio_path = fetch_audio(audio_input)
+            batch_items[audio_input] = (audio_path, get_output_dir(audio_path, args.out))
+        except SystemExit:
+            status[audio_input].update({'status': 'failed', 'error': 'Audio not found or not downloadable'})
+
+    #Only files without diarization output need a diarization process
+    to_diarize = [audio_input for audio_input, (audio_path, out_path) in batch_items.items() 
+                  if not has_diarization_output(audio_path, out_path, args.diarize, args.minspeech, args.mingap)]
+    jobs = min(args.jobs or os.cpu_count(), len(to_diarize)) or 1
+    print("Diarization processes:", jobs if to_diarize else 0)
+
+    def process_batch_item(diarization_future, audio_input):
+        audio_path, out_path = batch_items[audio_input]
+        print("Processing", audio_path)
+        start_time = time.time()
+        try:
+            diarization_future.result()
+            paths = process_audio(audio_path, out_path, args, transcription, executor=transcription_pool)
+            status[audio_input].update({'status': 'done', 'outputs': [paths[k] for k in BATCH_SUMMARY_OUTPUTS if k in paths and os.path.exists(paths[k])]})
+        except (Exception, SystemExit) as e:
+            print("ERROR: Processing %s failed"%audio_path, e)
+            status[audio_input].update({'status': 'failed', 'error': repr(e)})
+        status[audio_input]['seconds'] = time.time() - start_time
+
+    #Each file in progress has a driver thread that feeds its turns to the shared transcription pool, 
+    #so that short files don't leave workers idle. More files than workers would only wait for them
+    drivers = max(1, min(args.workers, len(batch_items)))
+
+    activity = PYANNOTE_DIARIZATION_TAG if args.diarize else PYANNOTE_SAD_TAG
+    mp_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context, 
+                                                initializer=load_pyannote_pipelines, initargs=([activity], 1)) as diarization_pool, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as transcription_pool, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=drivers) as driver_pool:
+
+        future_to_input = {}
+        for audio_input, (audio_path, out_path) in batch_items.items():
+            if audio_input in to_diarize:
+                future = diarization_pool.submit(diarize_batch_item, audio_path, out_path, args.diarize, args.minspeech, args.mingap,
+                                                 os.path.join(args.cachedir, os.path.basename(AUDIO_STORE_PATH)))
+            else:
+                future = concurrent.futures.Future()
+                future.set_result(None)
+            future_to_input[future] = audio_input
 
-        if translate_lang:
-            print("Dumping translated SRT subtitles in %s"%translate_lang, out_translated_srt_path)
-            speaker_turns_to_srt(sentence_turns_translated, out_translated_srt_path, txttag='translated')
+        #Transcribe and write outputs of each file as soon as its diarization is ready
+        driver_futures = [driver_pool.submit(process_batch_item, future, future_to_input[future])
+                          for future in concurrent.futures.as_completed(future_to_input)]
+        concurrent.futures.wait(driver_futures)
+
+    summary_path = os.path.join(args.out or '.', BATCH_SUMMARY_FILENAME)
+    with open(summary_path, 'w') as f:
+        print("Dumping batch summary", summary_path)
+        f.write(json.dumps([status[audio_input] for audio_input in audio_inputs], indent=1))
+
+    done_count = sum(1 for s in status.values() if s['status'] == 'done')
+    print("%i of %i audio files processed"%(done_count, len(audio_inputs)))
+
+def validate_args(args):
+    """Checks parsed arguments of a run (or server job) for what the parser can't. Raises ValueError on invalid arguments"""
+
+    if not args.audio and not args.batch:
+        raise ValueError("Specify input audio path or URL (-i) or batch input (-B)")
+
+    if args.audio and args.batch:
+        raise ValueError("Specify either a single input (-i) or batch input (-B)")
+
+    if args.transcribe and args.transcribe not in SUPPORTED_ASR_SERVICE_TAGS:
+        raise ValueError("ASR service %s not supported. Select from %s"%(args.transcribe, SUPPORTED_ASR_SERVICE_TAGS))
+
+    if args.transcribe and not args.lang:
+        raise ValueError("Specify audio language with -l")
+
+    if args.transcribe == AZURE_ASR_FLAG and not args.azureasrtoken:
+        raise ValueError("Specify service token to use Azure transcription (-a)")
+
+    if args.azureurl and (args.transcribe != AZURE_ASR_FLAG or not args.bypassazuresdk):
+        raise ValueError("Azure endpoint URL can only be used with REST API (-b)")
+
+    if args.continuous and (args.transcribe != AZURE_ASR_FLAG or args.bypassazuresdk):
+        raise ValueError("Continuous recognition (--continuous) is only available with Azure speech SDK")
+
+    if args.codec not in UPLOAD_CODECS:
+        raise ValueError("Upload codec %s not supported. Select from %s"%(args.codec, UPLOAD_CODECS))
+
+    if args.workers < 1 or args.translateworkers < 1:
+        raise ValueError("Number of workers (-w, --translateworkers) needs to be at least 1")
+
+    if args.turn not in TURN_ON_FLAGS:
+        raise ValueError("Unknown turn flag %s. It needs to be %s"%(args.turn,' or '.join(TURN_ON_FLAGS)))
+
+    if args.maxchunk is not None and args.maxchunk != 0 and args.maxchunk < MIN_MAX_CHUNK_LENGTH:
+        raise ValueError("Maximum chunk length (--maxchunk) needs to be 0 (no limit) or at least %.1f seconds"%MIN_MAX_CHUNK_LENGTH)
+
+    unknown_formats = [f for f in args.formats.split(',') if f not in FORMAT_WRITERS]
+    if unknown_formats:
+        raise ValueError("Output formats %s not supported. Select from %s"%(unknown_formats, list(FORMAT_WRITERS)))
+
+def main():
+
+    #Server mode keeps pipelines loaded and takes jobs over a local API
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        import server
+        server.main(sys.argv[2:])
+        return
+
+    #Parse args
+    args = parser.parse_args()
+
+    #Input checks
+    try:
+        validate_args(args)
+    except ValueError as e:
+        print("ERROR:", e)
+        sys.exit()
+
+    if args.profile:
+        run_profiled(run, args, args.profile)
+    else:
+        run(args)
+
+def run_profiled(func, args, profile_path):
+    """Runs func(args) under cProfile, dumps stats to profile_path and prints the most expensive calls. 
+    Only the calling thread is profiled, not transcription workers or diarization processes"""
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        func(args)
+    finally:
+        profiler.disable()
+        print("Dumping profile", profile_path)
+        profiler.dump_stats(profile_path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_PRINT_LINES)
+
+def run(args):
+    """Processes the audio (or batch) given in arguments"""
+
+    transcription = initialize_transcription(args)
+    asr_service = transcription['service']
+
+    if not args.batch:
+        metrics = RunMetrics()
+        with metrics.stage('download'):
+            audio_path = fetch_audio(args.audio)
+        out_path = get_output_dir(audio_path, args.out)
+    else:
+        out_path = args.out
+
+    #Report on setup
+    print("ASR Service:", asr_service)
+    if asr_service == AZURE_ASR_FLAG:
+        print("Use Azure SDK", not args.bypassazuresdk)
+        print("Continuous recognition", transcription['continuous'])
+    print("Output path:", out_path)
+    print('Turn on segment:', args.turn == TURN_ON_SEGMENT_FLAG)
+    print("Maximum turn length: %f s"%args.spanlength)
+    print("Speaker diarization:", args.diarize)
+    print("Skip diarization revision:", args.skiprevision)
+    if asr_service:
+        print("Transcription workers:", args.workers)
+        print("Transcription cache:", transcription['chunk_cache'].db_path if transcription['chunk_cache'] else None)
+
+    if args.batch:
+        process_batch(args, transcription)
+    else:
+        process_audio(audio_path, out_path, args, transcription, metrics=metrics)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,67 @@
+# Benchmark of SAD score to speech segment conversion on synthetic multi-hour score matrices
+#
+# Compares the vectorized sad_result_to_diarization_dict with the frame-by-frame loop it replaced
+# and checks that both give the same segments. Usage:
+#   python benchmarks/bench_sad.py --hours 1 4 10
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from autotemplater import sad_result_to_diarization_dict
+from synthetic import make_sad_scores
+
+def loop_sad_result_to_diarization_dict(result):
+    """Frame by frame conversion that sad_result_to_diarization_dict used before vectorization"""
+    sign = lambda p : (p[1]-p[0]>0)
+
+    segments = []
+    segment_start = 0.0
+
+    semaphore = sign(result[0])
+    for i in result:
+        window, probs = i
+        start_s = window.start
+        end_s = window.end
+        new_semaphore = sign(probs)
+        if new_semaphore and not semaphore:
+            segment_start = start_s
+        elif semaphore and not new_semaphore:
+            segment_end = start_s
+            segment = {"segment": {"start": segment_start, "end": segment_end}, "track": "NA", "label": "NA"}
+            segments.append(segment)
+        semaphore = new_semaphore
+
+    if semaphore:
+        segment = {"segment": {"start": segment_start, "end": end_s}, "track": "NA", "label": "NA"}
+        segments.append(segment)
+
+    return {"pyannote": "Annotation", "content": segments, "modality": "speaker"}
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="SAD to segments conversion benchmark")
+    parser.add_argument('--hours', type=float, nargs='+', default=[1.0, 4.0], help='Audio lengths to benchmark in hours')
+    parser.add_argument('--skiploop', action='store_true', help='Only time the vectorized conversion')
+    args = parser.parse_args()
+
+    for hours in args.hours:
+        result = make_sad_scores(hours * 3600)
+        vectorized_dict, vectorized_time = timed(sad_result_to_diarization_dict, result)
+        line = "%5.1f h %9i frames %7i segments  vectorized %8.3f s"%(hours, len(result.data), len(vectorized_dict['content']), vectorized_time)
+
+        if not args.skiploop:
+            loop_dict, loop_time = timed(loop_sad_result_to_diarization_dict, result)
+            assert loop_dict == vectorized_dict, "Vectorized segments differ from loop segments"
+            line += "  loop %8.3f s  speedup %6.1fx"%(loop_time, loop_time / vectorized_time)
+
+        print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Regression check and benchmark of sentence segmentation for subtitles on large synthetic transcripts
+#
+# Compares subtools.segment_turns with the split-per-sentence implementation it replaced: both must give
+# the same sentence turns and the same SRT (and translated SRT) output. Usage:
+#   python benchmarks/bench_segmentation.py --turns 1000 --words 50 200 1000
+
+import argparse
+import filecmp
+import os
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from subtools import segment_turns, SENTENDPUNCS, MAX_CHARS_PER_SUBSEG
+from turns import Turn, TICKS_PER_SEC
+from writers import write_turns
+from synthetic import make_long_turns
+
+def fake_translator(strings):
+    return [s.upper() for s in strings]
+
+#Segmentation as it was before tokenize-once rewrite
+
+def legacy_get_sentend_pos(string):
+    return [pos for pos, word in enumerate(string.split()) if word[-1] in SENTENDPUNCS]
+
+def legacy_fix_word_offsets(wt, fix_by_sec):
+    return wt.shifted(fix_by_sec)
+
+def legacy_optimal_split_text(text, max_char):
+    split_segments = []
+    current_segment = ""
+    tokens = text.split()
+    for w in tokens:
+        if w[-1] in string.punctuation and len(current_segment + " " + w) > max_char*0.7:
+            current_segment += w
+            split_segments.append(current_segment)
+            current_segment = ""
+        elif len(current_segment + " " + w) < max_char:
+            current_segment += w + " "
+            continue
+        else:
+            split_segments.append(current_segment[:-1])
+            current_segment = w + " "
+    if current_segment:
+        split_segments.append(current_segment)
+    return split_segments
+
+def legacy_split_long_turn(turn, texttag, max_chars=MAX_CHARS_PER_SUBSEG):
+    newturns = []
+    text_segments = legacy_optimal_split_text(turn[texttag], max_chars)
+    fullcharlen=len(turn[texttag])
+    start = turn['start']
+    at_token = 0
+    for seg in text_segments:
+        no_tokens = len(seg.split())
+        segcharlen = len(seg)
+        duration = turn['end'] - turn['start']
+        respective_duration = duration * segcharlen / fullcharlen
+        end = start + respective_duration
+        end_token = at_token+no_tokens
+        splitturn = Turn(start, start + respective_duration, turn['speaker'])
+        splitturn[texttag] = seg
+        start = end
+        at_token = end_token
+        newturns.append(splitturn)
+    return newturns
+
+def legacy_segment_turns(turns, max_chars=MAX_CHARS_PER_SUBSEG, translator_func=None):
+    sentence_list = []
+    for turn in turns:
+        turnstart = turn['start']
+        sentends = legacy_get_sentend_pos(turn['puncdtext'])
+        prevsentendindex = 0
+        for sentendindex in sentends:
+            puncdtext = ' '.join(turn['puncdtext'].split()[prevsentendindex:sentendindex+1])
+            rawtext = ' '.join(turn['rawtext'].split()[prevsentendindex:sentendindex+1])
+            sentstart = turnstart + turn.wordtiming.offsets[prevsentendindex]/TICKS_PER_SEC
+            sentend = turnstart + turn.wordtiming.offsets[sentendindex]/TICKS_PER_SEC + turn.wordtiming.durations[sentendindex]/TICKS_PER_SEC
+            fix_by_sec = sentstart - turnstart
+            wordtiming = legacy_fix_word_offsets(turn['wordtiming'][prevsentendindex:sentendindex+1], fix_by_sec)
+            sentence_list.append(Turn(sentstart, sentend, turn.speaker, None, rawtext, puncdtext, wordtiming))
+            prevsentendindex = sentendindex+1
+
+    if translator_func:
+        translations = translator_func([sentturn['puncdtext'] for sentturn in sentence_list])
+        for sentturn, translated in zip(sentence_list, translations):
+            sentturn['translated'] = translated
+
+    sentturns = []
+    sentturns_translated = []
+    for sentturn in sentence_list:
+        if translator_func:
+            sentturns_translated.extend(legacy_split_long_turn(sentturn, 'translated', max_chars))
+        sentturns.extend(legacy_split_long_turn(sentturn, 'puncdtext', max_chars))
+
+    return sentturns, sentturns_translated
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def check_same_output(result, legacy_result, tmp_dir):
+    """Asserts that both segmentations give the same SRT files"""
+
+    for name, txttag, sentturns, legacy_sentturns in [('srt', 'puncdtext', result[0], legacy_result[0]),
+                                                       ('translated', 'translated', result[1], legacy_result[1])]:
+        assert len(sentturns) == len(legacy_sentturns), "Different number of %s subtitles"%name
+        path = os.path.join(tmp_dir, name + '.srt')
+        legacy_path = os.path.join(tmp_dir, name + '-legacy.srt')
+        write_turns(sentturns, {'srt': path}, txttag=txttag)
+        write_turns(legacy_sentturns, {'srt': legacy_path}, txttag=txttag)
+        assert filecmp.cmp(path, legacy_path, shallow=False), "Segmented %s subtitles differ from legacy segmentation"%name
+
+def main():
+    parser = argparse.ArgumentParser(description="Sentence segmentation regression check and benchmark")
+    parser.add_argument('--turns', type=int, default=1000, help='Number of turns in synthetic transcripts')
+    parser.add_argument('--words', type=int, nargs='+', default=[50, 200, 1000], help='Maximum words per turn of each synthetic transcript')
+    parser.add_argument('--skiplegacy', action='store_true', help='Only time the current segmentation')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for words_per_turn in args.words:
+            turns = make_long_turns(args.turns, words_per_turn)
+            n_words = sum(len(t.wordtiming) for t in turns)
+            result, segment_time = timed(segment_turns, turns, translator_func=fake_translator)
+            line = "%6i words/turn %9i words %8i subtitles  segment_turns %8.3f s"%(words_per_turn, n_words, len(result[0]), segment_time)
+
+            if not args.skiplegacy:
+                legacy_result, legacy_time = timed(legacy_segment_turns, turns, translator_func=fake_translator)
+                check_same_output(result, legacy_result, tmp_dir)
+                line += "  legacy %8.3f s  speedup %6.1fx"%(legacy_time, legacy_time / segment_time)
+
+            print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+# Benchmark suite of the pipeline stages on synthetic inputs from minutes to hours of audio
+#
+# Each benchmark runs for each audio length in a fresh process so that peak memory is its own.
+# Reports wall and CPU time, throughput (seconds of audio per second), peak resident memory and how
+# time scales with audio length. Results are stored as JSON to compare runs before upgrades. Usage:
+#   python benchmarks/run_benchmarks.py --minutes 5 60 600 --output results.json
+#   python benchmarks/run_benchmarks.py --compare baseline.json --output results.json
+
+import argparse
+import contextlib
+import concurrent.futures
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCHMARK_DIR, '..')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+import numpy as np
+from autotemplater import get_speaker_turns, sad_result_to_diarization_dict, audio_convert
+from subtools import segment_turns
+from writers import write_turns
+from audiosource import WavAudioSource
+from synthetic import make_diarization, make_sad_scores, make_turns, make_wav
+
+DEFAULT_MINUTES = [5, 30, 120, 600]
+DEFAULT_AUDIO_MINUTES = [5, 30, 60] #audio benchmarks write the synthetic WAV to disk first
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 1.2 #wall time this many times the baseline counts as a regression
+SOURCE_FRAME_RATE = 44100 #audio_convert input is CD quality stereo
+SOURCE_CHANNELS = 2
+
+#Setups make the synthetic input of a benchmark (not timed), runs do the timed work and return the number of items handled
+
+def setup_diarization(duration, tmp_dir):
+    return make_diarization(duration)['content']
+
+def run_speaker_turns_segment(diarization_content):
+    get_speaker_turns(diarization_content, True)
+    return len(diarization_content)
+
+def run_speaker_turns_span(diarization_content):
+    get_speaker_turns(diarization_content, False)
+    return len(diarization_content)
+
+def setup_sad_scores(duration, tmp_dir):
+    return make_sad_scores(duration)
+
+def run_sad_to_diarization(sad_result):
+    sad_result_to_diarization_dict(sad_result)
+    return len(sad_result.data)
+
+def setup_turns(duration, tmp_dir):
+    return make_turns(duration)
+
+def run_segment_turns(turns):
+    segment_turns(turns)
+    return sum(len(t.wordtiming) for t in turns)
+
+def setup_transcript_writing(duration, tmp_dir):
+    paths = {format_name: os.path.join(tmp_dir, 'transcript.' + format_name) for format_name in ['otr', 'txt', 'jsonl']}
+    return setup_turns(duration, tmp_dir), paths
+
+def setup_subtitle_writing(duration, tmp_dir):
+    paths = {format_name: os.path.join(tmp_dir, 'subtitles.' + format_name) for format_name in ['srt', 'vtt']}
+    return segment_turns(setup_turns(duration, tmp_dir))[0], paths
+
+def run_write_turns(state):
+    turns, paths = state
+    write_turns(turns, paths, write_speaker_id=True)
+    return len(turns)
+
+def setup_audio_convert(duration, tmp_dir):
+    return make_wav(os.path.join(tmp_dir, 'source.wav'), duration, SOURCE_FRAME_RATE, SOURCE_CHANNELS), os.path.join(tmp_dir, 'store')
+
+def run_audio_convert(state):
+    source_path, store_path = state
+    #Start from an empty store each time, otherwise the stored conversion is reused
+    shutil.rmtree(store_path, ignore_errors=True)
+    audio_convert(source_path, store_path)
+    return 1
+
+def setup_chunk_slicing(duration, tmp_dir):
+    wav_path = make_wav(os.path.join(tmp_dir, 'audio.wav'), duration)
+    return WavAudioSource(wav_path), get_speaker_turns(make_diarization(duration)['content'], False)
+
+def run_chunk_slicing(state):
+    complete_audio, speaker_turns = state
+    for i, turn in enumerate(speaker_turns):
+        complete_audio.get_wav_buffer(turn.start, turn.end, 'chunk%i.wav'%i).getvalue()
+    return len(speaker_turns)
+
+#name: (setup, run, unit of items, is audio benchmark)
+BENCHMARKS = {
+    'speaker_turns_segment': (setup_diarization, run_speaker_turns_segment, 'segments', False),
+    'speaker_turns_span': (setup_diarization, run_speaker_turns_span, 'segments', False),
+    'sad_to_diarization': (setup_sad_scores, run_sad_to_diarization, 'frames', False),
+    'segment_turns': (setup_turns, run_segment_turns, 'words', False),
+    'write_transcripts': (setup_transcript_writing, run_write_turns, 'turns', False),
+    'write_subtitles': (setup_subtitle_writing, run_write_turns, 'subtitles', False),
+    'audio_convert': (setup_audio_convert, run_audio_convert, 'files', True),
+    'chunk_slicing': (setup_chunk_slicing, run_chunk_slicing, 'chunks', True),
+}
+
+def get_peak_rss_mb():
+    """Peak resident memory of this process in MB (ru_maxrss is in kilobytes on Linux, bytes on macOS)"""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+
+def run_case(name, duration, repeat):
+    """Sets up and runs one benchmark on duration seconds of audio. Runs in its own process"""
+
+    setup, run, unit, _ = BENCHMARKS[name]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        state = setup(duration, tmp_dir)
+        setup_peak_rss = get_peak_rss_mb()
+
+        wall_times = []
+        cpu_times = []
+        for _ in range(repeat):
+            start_wall = time.perf_counter()
+            start_cpu = time.process_time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                n_items = run(state)
+            wall_times.append(time.perf_counter() - start_wall)
+            cpu_times.append(time.process_time() - start_cpu)
+        del state
+
+    wall_time = min(wall_times)
+    return {'benchmark': name, 'audio_seconds': duration, 'items': n_items, 'item_unit': unit, 'repeat': repeat,
+            'wall_time': wall_time, 'cpu_time': min(cpu_times),
+            'audio_seconds_per_sec': duration / wall_time if wall_time else None,
+            'items_per_sec': n_items / wall_time if wall_time else None,
+            'setup_peak_rss_mb': setup_peak_rss, 'peak_rss_mb': get_peak_rss_mb()}
+
+def run_case_in_subprocess(name, duration, repeat):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_case, name, duration, repeat).result()
+
+def get_scaling_exponents(results):
+    """Least squares slope of log wall time over log audio length for each benchmark.
+    1.0 is linear scaling, above that time grows faster than the audio"""
+
+    exponents = {}
+    for name in BENCHMARKS:
+        points = [(math.log(r['audio_seconds']), math.log(r['wall_time'])) for r in results if r['benchmark'] == name and r['wall_time'] > 0]
+        if len(points) < 2:
+            continue
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        var_x = sum((x - mean_x) ** 2 for x, _ in points)
+        if var_x:
+            exponents[name] = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+    return exponents
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_metadata():
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'git_commit': get_git_commit(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+
+def print_result(result):
+    print("%-22s %8.1f min %10.3f s wall %10.3f s cpu %10.1fx realtime %12.0f %s/s %9.1f MB peak (%.1f MB after setup)"%(
+        result['benchmark'], result['audio_seconds'] / 60, result['wall_time'], result['cpu_time'],
+        result['audio_seconds_per_sec'] or float('inf'), result['items_per_sec'] or float('inf'), result['item_unit'],
+        result['peak_rss_mb'], result['setup_peak_rss_mb']))
+
+def compare_results(results, baseline_path, tolerance):
+    """Prints wall time and peak memory against a baseline run. Returns number of cases slower than tolerance allows"""
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    baseline_results = {(r['benchmark'], r['audio_seconds']): r for r in baseline['results']}
+
+    print("\nCompared to %s (commit %s)"%(baseline_path, baseline['metadata'].get('git_commit')))
+    regressions = 0
+    for result in results:
+        old = baseline_results.get((result['benchmark'], result['audio_seconds']))
+        if not old:
+            continue
+        time_ratio = result['wall_time'] / old['wall_time'] if old['wall_time'] else float('inf')
+        memory_ratio = result['peak_rss_mb'] / old['peak_rss_mb'] if old['peak_rss_mb'] else float('inf')
+        flag = ''
+        if time_ratio > tolerance:
+            flag = 'REGRESSION'
+            regressions += 1
+        print("%-22s %8.1f min  time %6.2fx  memory %6.2fx  %s"%(result['benchmark'], result['audio_seconds'] / 60, time_ratio, memory_ratio, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of pipeline stages on synthetic audio of growing length")
+    parser.add_argument('--minutes', type=float, nargs='+', default=DEFAULT_MINUTES, help='Audio lengths (minutes) to run benchmarks on')
+    parser.add_argument('--audiominutes', type=float, nargs='+', default=DEFAULT_AUDIO_MINUTES, help='Audio lengths (minutes) for benchmarks that need a WAV file')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='Run only these benchmarks')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Runs per case, fastest is reported')
+    parser.add_argument('--output', help='Path to write results JSON')
+    parser.add_argument('--compare', help='Results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Slowdown against the earlier run that counts as a regression')
+    args = parser.parse_args()
+
+    if args.compare and not os.path.exists(args.compare):
+        print("ERROR: Can't find results to compare against", args.compare)
+        sys.exit(1)
+
+    results = []
+    for name in args.only or BENCHMARKS:
+        minutes = args.audiominutes if BENCHMARKS[name][3] else args.minutes
+        for duration in sorted(m * 60 for m in minutes):
+            result = run_case_in_subprocess(name, duration, args.repeat)
+            print_result(result)
+            results.append(result)
+
+    exponents = get_scaling_exponents(results)
+    if exponents:
+        print("\nScaling of wall time with audio length (1.0 is linear)")
+        for name, exponent in exponents.items():
+            print("%-22s %5.2f"%(name, exponent))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'metadata': get_metadata(), 'results': results, 'scaling_exponents': exponents}, f, indent=2)
+        print("\nResults written to", args.output)
+
+    if args.compare and compare_results(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
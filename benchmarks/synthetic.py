@@ -0,0 +1,146 @@
+# Synthetic inputs for benchmarks: diarization output, SAD scores, transcribed turns and audio of any length
+
+import os
+import sys
+import wave
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from subtools import SENTENDPUNCS
+from turns import Turn, WordTiming, TICKS_PER_SEC
+
+SAD_FRAME_STEP = 0.016875  #(seconds) frame step of pyannote SAD models
+SAD_FRAME_DURATION = 0.016875
+SEGMENT_LENGTH_RANGE = (0.5, 8.0) #(seconds) length of diarization segments
+SEGMENT_GAP_RANGE = (0.0, 1.5) #(seconds) pause between diarization segments
+WORD_STEP = 0.35 #(seconds) between word starts in synthetic turns
+WORD_DURATION = 0.3 #(seconds)
+SENTENCE_LENGTH_RANGE = (3, 30) #(words)
+VOCABULARY = ['word%i'%i for i in range(500)] + ['längere', 'überall', 'a', 'supercalifragilistic']
+WAV_BLOCK_LENGTH = 60 #(seconds) synthetic audio is written a block at a time
+
+class SyntheticWindow:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+class SyntheticSlidingWindow:
+    """Mimics pyannote.core.SlidingWindow indexing"""
+
+    def __init__(self, start, duration, step):
+        self.start = start
+        self.duration = duration
+        self.step = step
+
+    def __getitem__(self, i):
+        start = self.start + i * self.step
+        return SyntheticWindow(start, start + self.duration)
+
+class SyntheticSADResult:
+    """Mimics pyannote.core.SlidingWindowFeature holding SAD scores (non-speech, speech) per frame"""
+
+    def __init__(self, data, sliding_window):
+        self.data = data
+        self.sliding_window = sliding_window
+
+    def __getitem__(self, i):
+        return self.data[i]
+
+    def __iter__(self):
+        for i, row in enumerate(self.data):
+            yield self.sliding_window[i], row
+
+def make_sad_scores(duration, seed=0):
+    """Makes log-probability-like scores alternating speech and non-speech regions of random length for duration seconds of audio"""
+
+    rng = np.random.default_rng(seed)
+    n_frames = int(duration / SAD_FRAME_STEP)
+    region_lengths = rng.integers(5, 600, size=n_frames // 5 + 1)
+    region_labels = np.arange(len(region_lengths)) % 2
+    is_speech = np.repeat(region_labels, region_lengths)[:n_frames].astype(bool)
+
+    speech_scores = np.where(is_speech, rng.uniform(-0.5, 0.0, n_frames), rng.uniform(-5.0, -1.0, n_frames))
+    scores = np.stack([np.log1p(-np.exp(speech_scores) + 1e-9), speech_scores], axis=1)
+    return SyntheticSADResult(scores, SyntheticSlidingWindow(0.0, SAD_FRAME_DURATION, SAD_FRAME_STEP))
+
+def make_diarization(duration, n_speakers=3, seed=0):
+    """Makes a pyannote style diarization dictionary covering duration seconds"""
+
+    rng = np.random.default_rng(seed)
+    segments = []
+    start = float(rng.uniform(*SEGMENT_GAP_RANGE))
+    speaker = 0
+    while True:
+        end = start + float(rng.uniform(*SEGMENT_LENGTH_RANGE))
+        if end > duration:
+            break
+        #Speakers often keep talking over several segments
+        if rng.random() < 0.4:
+            speaker = int(rng.integers(0, n_speakers))
+        segments.append({"segment": {"start": start, "end": end}, "track": "NA", "label": "SPEAKER_%02i"%speaker})
+        start = end + float(rng.uniform(*SEGMENT_GAP_RANGE))
+    return {"pyannote": "Annotation", "content": segments, "modality": "speaker"}
+
+def make_turn_text(n_words, rng):
+    """Makes raw and punctuated texts of n_words words, with sentence ends every few words and some commas"""
+
+    raw_tokens = [VOCABULARY[k] for k in rng.integers(0, len(VOCABULARY), n_words)]
+    punctuated_tokens = []
+    until_sentence_end = int(rng.integers(*SENTENCE_LENGTH_RANGE))
+    for i, w in enumerate(raw_tokens):
+        until_sentence_end -= 1
+        if until_sentence_end == 0 or i == n_words - 1:
+            w += SENTENDPUNCS[int(rng.integers(0, len(SENTENDPUNCS)))]
+            until_sentence_end = int(rng.integers(*SENTENCE_LENGTH_RANGE))
+        elif rng.random() < 0.1:
+            w += ','
+        punctuated_tokens.append(w)
+    return raw_tokens, punctuated_tokens
+
+def make_transcribed_turn(start, end, speaker, rng, n_words=None):
+    """Makes a turn with texts and word timings filling it at a steady speaking rate"""
+
+    if n_words is None:
+        n_words = max(1, int((end - start) / WORD_STEP))
+    raw_tokens, punctuated_tokens = make_turn_text(n_words, rng)
+    offsets = (np.arange(n_words) * WORD_STEP * TICKS_PER_SEC).astype(np.int64)
+    durations = np.full(n_words, int(WORD_DURATION * TICKS_PER_SEC), dtype=np.int64)
+    return Turn(start, end, speaker, False, ' '.join(raw_tokens), ' '.join(punctuated_tokens), WordTiming(raw_tokens, offsets, durations))
+
+def make_turns(duration, seed=0):
+    """Makes transcribed speaker turns with word timings covering duration seconds"""
+
+    rng = np.random.default_rng(seed)
+    return [make_transcribed_turn(s['segment']['start'], s['segment']['end'], s['label'], rng)
+            for s in make_diarization(duration, seed=seed)['content']]
+
+def make_long_turns(n_turns, words_per_turn, seed=0):
+    """Makes n_turns turns of up to words_per_turn words each (long monologues)"""
+
+    rng = np.random.default_rng(seed)
+    turns = []
+    turn_start = 0.0
+    for _ in range(n_turns):
+        n_words = int(rng.integers(max(1, words_per_turn // 2), words_per_turn + 1))
+        turn_end = turn_start + n_words * WORD_STEP
+        turns.append(make_transcribed_turn(turn_start, turn_end, 'SPEAKER_%02i'%int(rng.integers(0, 4)), rng, n_words))
+        turn_start = turn_end + float(rng.uniform(0.2, 2.0))
+    return turns
+
+def make_wav(path, duration, frame_rate=16000, channels=1, seed=0):
+    """Writes duration seconds of 16-bit PCM noise bursts separated by near silence to a WAV file"""
+
+    rng = np.random.default_rng(seed)
+    block_frames = WAV_BLOCK_LENGTH * frame_rate
+    with wave.open(path, 'wb') as wf:
+        wf.setnchannels(channels)
+        wf.setsampwidth(2)
+        wf.setframerate(frame_rate)
+        frames_left = int(duration * frame_rate)
+        while frames_left > 0:
+            n_frames = min(block_frames, frames_left)
+            envelope = np.repeat(rng.uniform(0.01, 1.0, n_frames // frame_rate + 1) > 0.3, frame_rate)[:n_frames] * 0.9 + 0.01
+            samples = rng.standard_normal((n_frames, channels)) * 3000 * envelope[:, None]
+            wf.writeframes(samples.astype('<i2').tobytes())
+            frames_left -= n_frames
+    return path
@@ -0,0 +1,231 @@
+# Per-stage timing and per-request metrics of a run, written as JSON and optionally as a Prometheus textfile
+
+import os
+import sys
+import time
+import json
+import resource
+import threading
+import contextlib
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0] #(seconds) upper bounds of request latency histogram
+PROMETHEUS_PREFIX = 'autotemplater'
+
+def get_peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Peak resident memory in MB of this process (or of its waited-for child processes)"""
+    peak_rss = resource.getrusage(who).ru_maxrss
+    return peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+
+def get_cpu_time():
+    """CPU time of this process and its finished child processes (e.g. diarization workers)"""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+def get_payload_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf8'))
+    try:
+        return len(body)
+    except TypeError:
+        return 0 #streamed body
+
+class RequestMetrics:
+    """Latency histogram, statuses, payload bytes and retries of requests to one service.
+    Latency is counted per attempt, retries and bytes per request"""
+
+    def __init__(self, service):
+        self.service = service
+        self.requests = 0
+        self.attempts = 0
+        self.retries = 0
+        self.failures = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def record_attempt(self, latency, response):
+        status = str(response.status_code) if response is not None else 'error'
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if latency <= bound), len(LATENCY_BUCKETS))
+        with self._lock:
+            self.attempts += 1
+            self.latency_sum += latency
+            self.latency_counts[bucket] += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def record_request(self, retries, response, healthy):
+        if response is not None:
+            #requests keeps the sent body in body, httpx in content
+            request = response.request
+            bytes_sent = get_payload_size(request.body if hasattr(request, 'body') else request.content)
+            bytes_received = len(response.content)
+        else:
+            bytes_sent = bytes_received = 0
+        with self._lock:
+            self.requests += 1
+            self.retries += retries
+            self.failures += 0 if healthy else 1
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+
+    def to_dict(self):
+        with self._lock:
+            return {'service': self.service, 'requests': self.requests, 'attempts': self.attempts, 'retries': self.retries,
+                    'failures': self.failures, 'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                    'latency_sum': self.latency_sum, 'latency_buckets': LATENCY_BUCKETS + ['+Inf'],
+                    'latency_counts': list(self.latency_counts), 'statuses': dict(self.statuses)}
+
+def subtract_request_metrics(current, baseline):
+    """Request metrics dictionary of what happened since baseline (both from RequestMetrics.to_dict)"""
+
+    if not baseline:
+        return current
+    diff = dict(current)
+    for key in ['requests', 'attempts', 'retries', 'failures', 'bytes_sent', 'bytes_received', 'latency_sum']:
+        diff[key] = current[key] - baseline[key]
+    diff['latency_counts'] = [c - b for c, b in zip(current['latency_counts'], baseline['latency_counts'])]
+    diff['statuses'] = {s: n - baseline['statuses'].get(s, 0) for s, n in current['statuses'].items() if n - baseline['statuses'].get(s, 0)}
+    return diff
+
+class RunMetrics:
+    """Wall time, CPU time and peak memory of each pipeline stage of an audio file, with requests made to services.
+    Stages can nest, time of a nested stage is also counted in the stage around it. 
+    A run that fails keeps the innermost stage it failed in and the error"""
+
+    def __init__(self, audio_id=None):
+        self.audio_id = audio_id
+        self.audio_duration = None
+        self.error = None
+        self.failed_stage = None
+        self.stages = {}
+        self._stage_order = []
+        self._request_metrics = {}
+        self._request_baselines = {}
+        self._started_at = time.time()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = get_cpu_time()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measures the code run within as a stage. A stage run several times adds up"""
+
+        stack = self._local.__dict__.setdefault('stack', [])
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        start_wall = time.perf_counter()
+        start_cpu = get_cpu_time()
+        try:
+            yield
+        except BaseException:
+            if self.failed_stage is None:
+                self.failed_stage = name
+            raise
+        finally:
+            stack.pop()
+            wall_time = time.perf_counter() - start_wall
+            cpu_time = get_cpu_time() - start_cpu
+            with self._lock:
+                if name not in self.stages:
+                    self.stages[name] = {'stage': name, 'parent': parent, 'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0}
+                    self._stage_order.append(name)
+                stage = self.stages[name]
+                stage['calls'] += 1
+                stage['wall_time'] += wall_time
+                stage['cpu_time'] += cpu_time
+                stage['peak_rss_mb'] = get_peak_rss_mb()
+                stage['children_peak_rss_mb'] = get_peak_rss_mb(resource.RUSAGE_CHILDREN)
+
+    def timed(self, name, func):
+        """Wraps a function so that each call is measured as a stage"""
+
+        def timed_func(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return timed_func
+
+    def track_requests(self, request_metrics):
+        """Includes requests to a service from now on (request metrics can be shared with other runs)"""
+        self._request_metrics[request_metrics.service] = request_metrics
+        self._request_baselines[request_metrics.service] = request_metrics.to_dict()
+
+    def to_dict(self):
+        wall_time = time.perf_counter() - self._start_wall
+        stages = []
+        for name in self._stage_order:
+            stage = dict(self.stages[name])
+            #Real-time factor is processing time per second of audio
+            stage['realtime_factor'] = stage['wall_time'] / self.audio_duration if self.audio_duration else None
+            stages.append(stage)
+
+        return {'audio_id': self.audio_id, 'audio_duration': self.audio_duration, 'started': self._started_at,
+                'failed': self.error is not None, 'failed_stage': self.failed_stage, 'error': self.error,
+                'wall_time': wall_time, 'cpu_time': get_cpu_time() - self._start_cpu,
+                'realtime_factor': wall_time / self.audio_duration if self.audio_duration else None,
+                'peak_rss_mb': get_peak_rss_mb(), 'children_peak_rss_mb': get_peak_rss_mb(resource.RUSAGE_CHILDREN),
+                'stages': stages,
+                'requests': [subtract_request_metrics(m.to_dict(), self._request_baselines.get(service))
+                             for service, m in self._request_metrics.items()]}
+
+    def write_json(self, output_path):
+        with open(output_path, 'w') as f:
+            f.write(json.dumps(self.to_dict(), indent=1))
+
+    def write_prometheus(self, output_path):
+        """Writes metrics in Prometheus text format, e.g. for node exporter's textfile collector.
+        The file is replaced at once so the collector never reads it half written"""
+
+        metrics = self.to_dict()
+        audio_label = 'audio="%s"'%escape_label(metrics['audio_id'] or '')
+        lines = []
+
+        def add(name, metric_type, help_text, samples):
+            lines.append('# HELP %s_%s %s'%(PROMETHEUS_PREFIX, name, help_text))
+            lines.append('# TYPE %s_%s %s'%(PROMETHEUS_PREFIX, name, metric_type))
+            for suffix, labels, value in samples:
+                if value is not None:
+                    lines.append('%s_%s%s{%s} %s'%(PROMETHEUS_PREFIX, name, suffix, ','.join([audio_label] + labels), repr(float(value))))
+
+        add('audio_duration_seconds', 'gauge', 'Duration of the audio', [('', [], metrics['audio_duration'])])
+        add('run_wall_seconds', 'gauge', 'Wall time of the run', [('', [], metrics['wall_time'])])
+        add('run_cpu_seconds', 'gauge', 'CPU time of the run', [('', [], metrics['cpu_time'])])
+        add('run_failed', 'gauge', 'Whether the run failed, in the stage given', 
+            [('', ['stage="%s"'%escape_label(metrics['failed_stage'] or '')] if metrics['failed'] else [], int(metrics['failed']))])
+        add('peak_rss_bytes', 'gauge', 'Peak resident memory of the process', [('', [], metrics['peak_rss_mb'] * 1024 * 1024)])
+
+        stage_labels = lambda s: ['stage="%s"'%escape_label(s['stage'])]
+        add('stage_wall_seconds', 'gauge', 'Wall time of pipeline stage', [('', stage_labels(s), s['wall_time']) for s in metrics['stages']])
+        add('stage_cpu_seconds', 'gauge', 'CPU time of pipeline stage', [('', stage_labels(s), s['cpu_time']) for s in metrics['stages']])
+        add('stage_realtime_factor', 'gauge', 'Wall time of pipeline stage per second of audio', [('', stage_labels(s), s['realtime_factor']) for s in metrics['stages']])
+        add('stage_peak_rss_bytes', 'gauge', 'Peak resident memory of the process by the end of pipeline stage', [('', stage_labels(s), s['peak_rss_mb'] * 1024 * 1024) for s in metrics['stages']])
+
+        latency_samples = []
+        for r in metrics['requests']:
+            service_label = 'service="%s"'%escape_label(r['service'])
+            cumulative_count = 0
+            for bound, count in zip(r['latency_buckets'], r['latency_counts']):
+                cumulative_count += count
+                latency_samples.append(('_bucket', [service_label, 'le="%s"'%bound], cumulative_count))
+            latency_samples.append(('_sum', [service_label], r['latency_sum']))
+            latency_samples.append(('_count', [service_label], r['attempts']))
+        add('request_latency_seconds', 'histogram', 'Latency of each request attempt to service', latency_samples)
+
+        service_labels = lambda r: ['service="%s"'%escape_label(r['service'])]
+        for key, help_text in [('requests', 'Requests to service'), ('retries', 'Retried attempts of requests to service'),
+                               ('failures', 'Requests to service that failed after retries'), ('bytes_sent', 'Payload bytes sent to service'),
+                               ('bytes_received', 'Payload bytes received from service')]:
+            add('request_%s_total'%key if key != 'requests' else 'requests_total', 'counter', help_text,
+                [('', service_labels(r), r[key]) for r in metrics['requests']])
+
+        partial_path = output_path + '.tmp'
+        with open(partial_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(partial_path, output_path)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,293 @@
+# Local stand-in for ASR-API, Azure speech REST and Azure translator endpoints for offline end-to-end load testing
+#
+# Gives fake transcripts with word timings spread over the audio, after a configurable latency,
+# failing or throttling a configurable fraction of requests. Usage:
+#   python mockasr.py --latency 0.3 --rtf 0.1 --errorrate 0.01 --throttlerate 0.05 --capacity 20
+#   python autotemplater.py -i audio.wav -x api -l en -w 8
+#   python autotemplater.py -i audio.wav -x azure -l en-US -a any -b --azureurl http://127.0.0.1:8010 -f es -m any --translatorurl http://127.0.0.1:8010
+
+import argparse
+import sys
+import io
+import json
+import math
+import time
+import wave
+import zlib
+import random
+import threading
+import email.parser
+import email.policy
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8010 #where autotemplater looks for ASR-API by default
+ASR_API_PATH = '/transcribe'
+ASR_API_SHORT_PATH = '/transcribe/short'
+AZURE_STT_PATH = '/speech/recognition/conversation/cognitiveservices/v1'
+AZURE_TOKEN_PATH = '/sts/v1.0/issueToken'
+TRANSLATOR_PATH = '/translate'
+LATENCY_DISTRIBUTIONS = ['constant', 'uniform', 'exponential', 'lognormal']
+DEFAULT_LANGUAGES = 'ca,en,es,fr,de,it,pt,ar,sw,en-US,es-ES,ca-ES'
+DEFAULT_CODECS = 'wav,flac,opus'
+TICKS_PER_SEC = 10000000
+WORDS_PER_SEC = 2.5 #speaking rate of fake transcripts
+WORD_DURATION_FRACTION = 0.8 #of the time between word starts
+SENTENCE_LENGTH_RANGE = (4, 15) #(words)
+BYTES_PER_SEC = {'audio/flac': 20000, 'audio/ogg': 4000} #to guess duration of compressed uploads, otherwise taken as 16 kHz 16-bit mono PCM
+PCM_BYTES_PER_SEC = 32000
+VOCABULARY = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor',
+              'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'enim', 'ad', 'minim', 'veniam', 'quis', 'nostrud']
+
+mock_parser = argparse.ArgumentParser(description="Mock ASR-API, Azure speech and translator server for load testing")
+mock_parser.add_argument('--host', type=str, help='Host to listen on (default: %s)'%DEFAULT_HOST, default=DEFAULT_HOST)
+mock_parser.add_argument('--port', type=int, help='Port to listen on (default: %i)'%DEFAULT_PORT, default=DEFAULT_PORT)
+mock_parser.add_argument('--latency', type=float, help='Mean response latency in seconds (default: 0)', default=0.0)
+mock_parser.add_argument('--latencydist', type=str, help='Latency distribution %s (default: constant)'%LATENCY_DISTRIBUTIONS, default='constant')
+mock_parser.add_argument('--latencysigma', type=float, help='Spread (sigma of log latency) of lognormal latency (default: 0.5)', default=0.5)
+mock_parser.add_argument('--rtf', type=float, help='Extra latency of speech requests per second of audio (real-time factor, default: 0)', default=0.0)
+mock_parser.add_argument('--errorrate', type=float, help='Fraction of requests that fail with 500 (default: 0)', default=0.0)
+mock_parser.add_argument('--throttlerate', type=float, help='Fraction of requests throttled with 429 (default: 0)', default=0.0)
+mock_parser.add_argument('--retryafter', type=float, help='Retry-After seconds sent with 429 responses, negative to send none (default: 1)', default=1.0)
+mock_parser.add_argument('--capacity', type=int, help='Requests processed at once, more are throttled with 429 (default: no limit)')
+mock_parser.add_argument('--languages', type=str, help='Comma separated languages ASR-API lists (default: %s)'%DEFAULT_LANGUAGES, default=DEFAULT_LANGUAGES)
+mock_parser.add_argument('--codecs', type=str, help='Comma separated upload codecs ASR-API lists (default: %s)'%DEFAULT_CODECS, default=DEFAULT_CODECS)
+mock_parser.add_argument('--seed', type=int, help='Random seed of latencies and failures (default: random)')
+
+class MockBehavior:
+    """Draws latencies and injected failures, and keeps request statistics"""
+
+    def __init__(self, latency=0.0, distribution='constant', sigma=0.5, rtf=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1.0, capacity=None, seed=None):
+        self.latency = latency
+        self.distribution = distribution
+        self.sigma = sigma
+        self.rtf = rtf
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.capacity = capacity
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'statuses': {}, 'endpoints': {}, 'max_in_flight': 0, 'audio_seconds': 0.0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw_latency(self, audio_duration=0.0):
+        with self._lock:
+            if self.distribution == 'uniform':
+                latency = self._random.uniform(0.0, 2 * self.latency)
+            elif self.distribution == 'exponential':
+                latency = self._random.expovariate(1.0 / self.latency) if self.latency else 0.0
+            elif self.distribution == 'lognormal':
+                #Mean of the lognormal stays at the given latency
+                latency = self._random.lognormvariate(math.log(self.latency) - self.sigma ** 2 / 2, self.sigma) if self.latency else 0.0
+            else:
+                latency = self.latency
+        return latency + self.rtf * audio_duration
+
+    def admit(self, endpoint):
+        """Counts a request in. Returns status code to fail it with, or None to process it"""
+
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['endpoints'][endpoint] = self.stats['endpoints'].get(endpoint, 0) + 1
+            if self.capacity and self.in_flight >= self.capacity:
+                return 429
+            if self._random.random() < self.throttle_rate:
+                return 429
+            self.in_flight += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.in_flight)
+            return 500 if self._random.random() < self.error_rate else None
+
+    def release(self, audio_duration=0.0):
+        with self._lock:
+            self.in_flight -= 1
+            self.stats['audio_seconds'] += audio_duration
+
+    def count_status(self, status_code):
+        with self._lock:
+            self.stats['statuses'][str(status_code)] = self.stats['statuses'].get(str(status_code), 0) + 1
+
+def get_audio_duration(audio_data, content_type):
+    """Reads duration of WAV audio from its header, guesses it from size for compressed audio"""
+
+    if audio_data[:4] == b'RIFF':
+        try:
+            with wave.open(io.BytesIO(audio_data), 'rb') as wf:
+                return wf.getnframes() / wf.getframerate()
+        except (wave.Error, EOFError):
+            pass
+    bytes_per_sec = BYTES_PER_SEC.get((content_type or '').split(';')[0].strip(), PCM_BYTES_PER_SEC)
+    return len(audio_data) / bytes_per_sec
+
+def make_fake_transcription(audio_data, duration):
+    """Makes a transcript of words spoken at a steady rate over the audio. Same audio gets the same transcript.
+    Returns raw transcript, punctuated transcript and word timings in Azure format"""
+
+    rng = random.Random(zlib.crc32(audio_data))
+    n_words = int(duration * WORDS_PER_SEC)
+    if not n_words:
+        return '', '', []
+
+    step = duration / n_words
+    raw_tokens = []
+    punctuated_tokens = []
+    word_timing = []
+    until_sentence_end = rng.randint(*SENTENCE_LENGTH_RANGE)
+    for i in range(n_words):
+        word = rng.choice(VOCABULARY)
+        raw_tokens.append(word)
+
+        punctuated = word.capitalize() if not punctuated_tokens or punctuated_tokens[-1][-1] == '.' else word
+        until_sentence_end -= 1
+        if until_sentence_end == 0 or i == n_words - 1:
+            punctuated += '.'
+            until_sentence_end = rng.randint(*SENTENCE_LENGTH_RANGE)
+        punctuated_tokens.append(punctuated)
+
+        word_timing.append({'Word': word, 'Offset': int(i * step * TICKS_PER_SEC), 'Duration': int(step * WORD_DURATION_FRACTION * TICKS_PER_SEC)})
+
+    return ' '.join(raw_tokens), ' '.join(punctuated_tokens), word_timing
+
+def get_multipart_fields(body, content_type):
+    """Returns form fields of a multipart/form-data body as name: (content type, bytes)"""
+
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+    return {part.get_param('name', header='content-disposition'): (part.get_content_type(), part.get_payload(decode=True))
+            for part in message.iter_parts()}
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    """Mock endpoints:
+    GET  /transcribe                  ASR-API languages and codecs
+    POST /transcribe/short            ASR-API transcription of a multipart uploaded file
+    POST /sts/v1.0/issueToken         Azure access token
+    POST /speech/recognition/conversation/cognitiveservices/v1   Azure short audio recognition (detailed format)
+    POST /translate                   Azure translator, translations are the texts tagged with target language
+    GET  /stats                       request statistics"""
+
+    behavior = None
+    languages = []
+    codecs = []
+    protocol_version = 'HTTP/1.1' #keep-alive, as the real services
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status_code, body, content_type='application/json', headers=None):
+        self.behavior.count_status(status_code)
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status_code, data, headers=None):
+        self.send_body(status_code, json.dumps(data).encode('utf8'), headers=headers)
+
+    def send_failure(self, status_code):
+        headers = {'Retry-After': '%g'%self.behavior.retry_after} if status_code == 429 and self.behavior.retry_after >= 0 else None
+        self.send_json(status_code, {'error': 'Too many requests' if status_code == 429 else 'Internal server error'}, headers)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        path = urlsplit(self.path).path.rstrip('/')
+        if path == ASR_API_PATH:
+            self.send_json(200, {'languages': self.languages, 'codecs': self.codecs})
+        elif path == '/stats':
+            self.send_json(200, self.behavior.stats)
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        query = parse_qs(url.query)
+        body = self.read_body()
+
+        if path == ASR_API_SHORT_PATH:
+            fields = get_multipart_fields(body, self.headers.get('Content-Type', ''))
+            if 'file' not in fields:
+                self.send_json(400, {'error': 'No file uploaded'})
+                return
+            if fields.get('lang', (None, b''))[1].decode('utf8') not in self.languages:
+                self.send_json(400, {'error': 'Language not supported'})
+                return
+            self.respond_to_speech(path, *fields['file'], lambda raw, punctuated, words, duration: {'transcript': raw})
+        elif path == AZURE_STT_PATH:
+            if not self.headers.get('Authorization', '').startswith('Bearer '):
+                self.send_json(401, {'error': 'Missing access token'})
+                return
+            self.respond_to_speech(path, self.headers.get('Content-Type'), body, get_azure_response)
+        elif path == AZURE_TOKEN_PATH:
+            if not self.headers.get('Ocp-Apim-Subscription-Key'):
+                self.send_json(401, {'error': 'Missing subscription key'})
+                return
+            self.send_body(200, b'mock-access-token', 'text/plain')
+        elif path == TRANSLATOR_PATH:
+            target_lang = query.get('to', [''])[0]
+            self.respond(path, lambda: [{'translations': [{'text': '[%s] %s'%(target_lang, t['text']), 'to': target_lang}]} for t in json.loads(body)])
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def respond(self, endpoint, make_response, audio_duration=0.0):
+        """Waits for the drawn latency and sends the response, unless the request is throttled or failed"""
+
+        failure = self.behavior.admit(endpoint)
+        if failure == 429:
+            self.send_failure(429)
+            return
+
+        try:
+            time.sleep(self.behavior.draw_latency(audio_duration))
+            if failure:
+                self.send_failure(failure)
+            else:
+                self.send_json(200, make_response())
+        finally:
+            self.behavior.release(audio_duration if not failure else 0.0)
+
+    def respond_to_speech(self, endpoint, content_type, audio_data, make_response):
+        duration = get_audio_duration(audio_data, content_type)
+        self.respond(endpoint, lambda: make_response(*make_fake_transcription(audio_data, duration), duration), duration)
+
+def get_azure_response(raw_transcript, punctuated_transcript, word_timing, duration):
+    """Azure short audio recognition result in detailed format"""
+
+    if not word_timing:
+        return {'RecognitionStatus': 'NoMatch', 'Offset': 0, 'Duration': int(duration * TICKS_PER_SEC)}
+    offset = word_timing[0]['Offset']
+    return {'RecognitionStatus': 'Success', 'Offset': offset, 'Duration': word_timing[-1]['Offset'] + word_timing[-1]['Duration'] - offset,
+            'DisplayText': punctuated_transcript,
+            'NBest': [{'Confidence': 0.9, 'Lexical': raw_transcript, 'ITN': raw_transcript, 'MaskedITN': raw_transcript,
+                       'Display': punctuated_transcript, 'Words': word_timing}]}
+
+def main(argv=None):
+    args = mock_parser.parse_args(argv)
+
+    if args.latencydist not in LATENCY_DISTRIBUTIONS:
+        print("ERROR: Latency distribution %s not supported. Select from %s"%(args.latencydist, LATENCY_DISTRIBUTIONS))
+        sys.exit()
+
+    MockRequestHandler.behavior = MockBehavior(args.latency, args.latencydist, args.latencysigma, args.rtf, args.errorrate,
+                                               args.throttlerate, args.retryafter, args.capacity, args.seed)
+    MockRequestHandler.languages = args.languages.split(',')
+    MockRequestHandler.codecs = args.codecs.split(',')
+
+    httpd = ThreadingHTTPServer((args.host, args.port), MockRequestHandler)
+    httpd.daemon_threads = True
+    print("Mock ASR listening on http://%s:%i"%(args.host, args.port))
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        print(json.dumps(MockRequestHandler.behavior.stats))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+# Long-running autotemplater job server that keeps pyannote pipelines loaded between jobs
+
+import argparse
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import socket
+import socketserver
+import threading
+import traceback
+import concurrent.futures
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import autotemplater
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8020
+DEFAULT_JOB_CONCURRENCY = 1
+JOBS_PATH = "jobs"
+JOB_ARTIFACTS = {'otr': 'finalotr', 'diarizationotr': 'emptyotr', 'txt': 'txt', 'jsonl': 'jsonl', 'srt': 'srt', 'vtt': 'vtt',
+                 'translatedsrt': 'translatedsrt', 'translatedvtt': 'translatedvtt', 'asr': 'asr', 'metrics': 'metrics'}
+ARTIFACT_CONTENT_TYPES = {'otr': 'application/json', 'diarizationotr': 'application/json', 'asr': 'application/json', 'metrics': 'application/json', 
+                          'jsonl': 'application/x-ndjson', 'vtt': 'text/vtt; charset=utf-8'}
+
+server_parser = argparse.ArgumentParser(description="oTranscribe template maker server")
+server_parser.add_argument('--host', type=str, help='Host to listen on (default: %s)'%DEFAULT_HOST, default=DEFAULT_HOST)
+server_parser.add_argument('--port', type=int, help='Port to listen on (default: %i)'%DEFAULT_PORT, default=DEFAULT_PORT)
+server_parser.add_argument('--socket', type=str, help='Listen on a Unix socket path instead of host and port')
+server_parser.add_argument('--concurrency', type=int, help='Number of jobs processed at the same time (default: %i)'%DEFAULT_JOB_CONCURRENCY, default=DEFAULT_JOB_CONCURRENCY)
+server_parser.add_argument('-w', '--workers', type=int, help='Number of turns transcribed concurrently across all jobs (default: %i)'%autotemplater.DEFAULT_TRANSCRIPTION_WORKERS, default=autotemplater.DEFAULT_TRANSCRIPTION_WORKERS)
+server_parser.add_argument('--ratelimit', type=float, help='Maximum number of requests per second to ASR and translation services across all jobs (default: no limit)')
+server_parser.add_argument('--retries', type=int, help='Number of retries of throttled or failed requests (default: %i)'%autotemplater.DEFAULT_MAX_RETRIES, default=autotemplater.DEFAULT_MAX_RETRIES)
+server_parser.add_argument('--jobsdir', type=str, help='Directory for outputs of jobs that specify no output path (default: %s)'%JOBS_PATH, default=JOBS_PATH)
+server_parser.add_argument('--nopreload', action='store_true', help='Load pyannote pipelines on first use instead of on startup (default: False)')
+
+def options_to_argv(options):
+    """Converts a dictionary of CLI options (long names without dashes) to an argument list"""
+
+    argv = []
+    for key, value in options.items():
+        if value is None or value is False:
+            continue
+        argv.append('--' + key)
+        if value is not True:
+            argv.append(str(value))
+    return argv
+
+class JobManager:
+    """Queues jobs and processes them with a fixed number of job threads that share a transcription pool 
+    and a request scheduler, so that rate and concurrency limits hold across jobs"""
+
+    def __init__(self, concurrency, transcription_workers, jobs_path, rate_limit=None, max_retries=autotemplater.DEFAULT_MAX_RETRIES):
+        self.jobs_path = jobs_path
+        self.transcription_workers = transcription_workers
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._transcription_pool = concurrent.futures.ThreadPoolExecutor(max_workers=transcription_workers)
+        self._scheduler = autotemplater.RequestScheduler(max(transcription_workers, autotemplater.DEFAULT_TRANSLATE_WORKERS), rate_limit, max_retries)
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(concurrency)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, options):
+        """Validates job options with the CLI parser and queues the job. Raises ValueError on invalid options"""
+
+        if 'batch' in options:
+            raise ValueError("Batch input is not supported for jobs, submit one job per audio")
+        if not options.get('audio'):
+            raise ValueError("Specify input audio path or URL (audio)")
+
+        try:
+            args = autotemplater.parser.parse_args(options_to_argv(options))
+        except SystemExit:
+            raise ValueError("Invalid job options")
+        autotemplater.validate_args(args)
+
+        job_id = uuid.uuid4().hex
+        job = {'id': job_id, 'status': 'queued', 'options': options, 'created': time.time(), 'outputs': {}}
+        with self._lock:
+            self.jobs[job_id] = job
+        self._queue.put((job, args))
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self.jobs.values())
+
+    def _work(self):
+        while True:
+            job, args = self._queue.get()
+            job['status'] = 'running'
+            job['started'] = time.time()
+            try:
+                self._run(job, args)
+                job['status'] = 'done'
+            except (Exception, SystemExit) as e:
+                traceback.print_exc()
+                job['status'] = 'failed'
+                job['error'] = repr(e)
+            job['finished'] = time.time()
+            self._queue.task_done()
+
+    def _run(self, job, args):
+        #Jobs can't be asked questions
+        args.skiprevision = True
+        #Requests of a job are scheduled up to the size of the shared transcription pool, not the CLI default of -w
+        args.workers = self.transcription_workers
+
+        if not args.out:
+            args.out = os.path.join(self.jobs_path, job['id'])
+
+        transcription = autotemplater.initialize_transcription(args, scheduler=self._scheduler)
+        metrics = autotemplater.RunMetrics()
+        with metrics.stage('download'):
+            audio_path = autotemplater.fetch_audio(args.audio)
+        out_path = autotemplater.get_output_dir(audio_path, args.out)
+        paths = autotemplater.process_audio(audio_path, out_path, args, transcription, executor=self._transcription_pool, metrics=metrics)
+
+        job['outputs'] = {artifact: paths[key] for artifact, key in JOB_ARTIFACTS.items()
+                          if key in paths and os.path.exists(paths[key])}
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """Local job API:
+    POST /jobs                   queue a job, body is a JSON object of CLI options e.g. {"audio": "a.wav", "transcribe": "api", "lang": "en"}
+    GET  /jobs                   list jobs
+    GET  /jobs/<id>              job status
+    GET  /jobs/<id>/<artifact>   job output (otr, diarizationotr, txt, jsonl, srt, vtt, translatedsrt, translatedvtt, asr, metrics)"""
+
+    job_manager = None
+
+    def send_json(self, status_code, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            options = json.loads(self.rfile.read(content_length) or b'{}')
+            job = self.job_manager.submit(options)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+
+        self.send_json(201, job)
+
+    def do_GET(self):
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+
+        if parts == ['jobs']:
+            self.send_json(200, self.job_manager.list())
+            return
+
+        if len(parts) not in (2, 3) or parts[0] != 'jobs':
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        job = self.job_manager.get(parts[1])
+        if not job:
+            self.send_json(404, {'error': 'Job not found'})
+            return
+
+        if len(parts) == 2:
+            self.send_json(200, job)
+            return
+
+        artifact = parts[2]
+        if artifact not in job['outputs']:
+            self.send_json(404, {'error': 'Artifact %s not available for job in status %s'%(artifact, job['status'])})
+            return
+
+        with open(job['outputs'][artifact], 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', ARTIFACT_CONTENT_TYPES.get(artifact, 'text/plain; charset=utf-8'))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        #Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+def main(argv=None):
+    args = server_parser.parse_args(argv)
+
+    if args.concurrency < 1 or args.workers < 1:
+        print("ERROR: Job concurrency and number of workers need to be at least 1")
+        sys.exit()
+
+    if not args.nopreload:
+        print("Loading pyannote pipelines")
+        autotemplater.load_pyannote_pipelines([autotemplater.PYANNOTE_SAD_TAG, autotemplater.PYANNOTE_DIARIZATION_TAG])
+
+    JobRequestHandler.job_manager = JobManager(args.concurrency, args.workers, args.jobsdir, args.ratelimit, args.retries)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        httpd = UnixHTTPServer(args.socket, JobRequestHandler)
+        print("Listening on", args.socket)
+    else:
+        httpd = ThreadingHTTPServer((args.host, args.port), JobRequestHandler)
+        print("Listening on http://%s:%i"%(args.host, args.port))
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+if __name__ == "__main__":
+    main()
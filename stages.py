@@ -0,0 +1,87 @@
+# Fingerprinted pipeline stages. Each stage output of an audio file is recorded in a manifest together with a
+# fingerprint of the inputs and parameters it was made from, so that a rerun only recomputes stages whose fingerprint changed
+
+import os
+import json
+import time
+import hashlib
+
+MANIFEST_VERSION = 1
+#Bump the version of a stage when a code change alters its output, so that outputs of earlier versions are recomputed
+STAGE_VERSIONS = {'diarization': 1, 'revision': 1, 'transcription': 1, 'transcription_journal': 1}
+
+def get_fingerprint(stage, inputs):
+    """Fingerprint of a stage run on inputs, a JSON serializable dictionary of upstream fingerprints and parameters"""
+    key = json.dumps([stage, STAGE_VERSIONS[stage], inputs], sort_keys=True)
+    return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+def get_content_hash(text):
+    """Hash of a stage output's content, for outputs that depend on more than their recorded inputs (e.g. user answers)"""
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+class StageManifest:
+    """Fingerprints of the stage outputs of an audio file, kept in a JSON file next to the outputs.
+    Outputs of earlier runs that have no manifest entry are adopted as they are"""
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.audio = {}
+        self.stages = {}
+
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, 'r') as f:
+                    manifest = json.load(f)
+                if manifest.get('version') == MANIFEST_VERSION:
+                    self.audio = manifest.get('audio', {})
+                    self.stages = manifest.get('stages', {})
+            except ValueError:
+                print("WARNING: Ignoring unreadable manifest", manifest_path)
+
+    def save(self):
+        partial_path = self.manifest_path + '.tmp'
+        with open(partial_path, 'w') as f:
+            f.write(json.dumps({'version': MANIFEST_VERSION, 'audio': self.audio, 'stages': self.stages}, indent=1))
+        os.replace(partial_path, self.manifest_path)
+
+    def get_audio_fingerprint(self, audio_path, hash_func):
+        """Content hash of the audio file, only computed again if the file's size or modification time changed"""
+
+        stat = os.stat(audio_path)
+        if not self.audio.get('hash') or self.audio.get('size') != stat.st_size or self.audio.get('mtime_ns') != stat.st_mtime_ns:
+            self.audio = {'path': audio_path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': hash_func(audio_path)}
+            self.save()
+        return self.audio['hash']
+
+    def get_inputs(self, stage):
+        """Inputs recorded for a stage output (or None)"""
+        entry = self.stages.get(stage)
+        return entry['inputs'] if entry else None
+
+    def is_current(self, stage, inputs, output_path):
+        """Checks if the output of a stage exists and was made from the same inputs"""
+
+        if not os.path.exists(output_path):
+            return False
+
+        entry = self.stages.get(stage)
+        if entry is None:
+            print("WARNING: Adopting %s of an earlier run as it is, its parameters can't be checked. Delete it to recompute"%output_path)
+            self.record(stage, inputs, output_path)
+            return True
+
+        if entry['fingerprint'] != get_fingerprint(stage, inputs):
+            print("Inputs or parameters of %s changed since %s was made, not reusing it"%(stage, output_path))
+            return False
+        return True
+
+    def record(self, stage, inputs, output_path):
+        """Records that a stage output was made from inputs"""
+        self.stages[stage] = {'fingerprint': get_fingerprint(stage, inputs), 'inputs': inputs,
+                              'output': os.path.basename(output_path), 'time': time.time()}
+        self.save()
+
+    def forget(self, stage):
+        if stage in self.stages:
+            del self.stages[stage]
+            self.save()
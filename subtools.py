@@ -1,14 +1,68 @@
-import time
-import copy
+import os
+import uuid
 import string
-import json
-import requests, uuid, json
+import sqlite3
+import threading
+import concurrent.futures
+import numpy as np
+from transport import Transport
+from writers import write_turns, sec_to_srt_timestamp, SUB_END_BUFFER
+from turns import Turn, TICKS_PER_SEC
 
 SENTENDPUNCS = ['.', '?', '!']
 MAX_CHARS_PER_SUBSEG = 80
-SUB_END_BUFFER = 0.5
-
-def get_azure_translator(src, trg, subscription_key, endpoint = "https://api.cognitive.microsofttranslator.com", location = "westeurope"):
+MAX_TRANSLATE_ITEMS_PER_REQUEST = 1000  #Azure translator limits per request
+MAX_TRANSLATE_CHARS_PER_REQUEST = 50000
+DEFAULT_TRANSLATE_WORKERS = 4
+
+class TranslationMemory:
+    """On-disk store of translations keyed by source text and language pair"""
+
+    def __init__(self, db_path):
+        memory_dir = os.path.dirname(db_path)
+        if memory_dir and not os.path.exists(memory_dir):
+            os.makedirs(memory_dir)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS translations (src TEXT, trg TEXT, text TEXT, translation TEXT, PRIMARY KEY (src, trg, text))")
+
+    def lookup(self, texts, src, trg):
+        """Returns a dictionary of stored translations for given texts"""
+        found = {}
+        with self._lock:
+            for text in texts:
+                row = self._conn.execute("SELECT translation FROM translations WHERE src = ? AND trg = ? AND text = ?", (src, trg, text)).fetchone()
+                if row:
+                    found[text] = row[0]
+        return found
+
+    def store(self, translations, src, trg):
+        """Stores a dictionary of translations"""
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO translations (src, trg, text, translation) VALUES (?, ?, ?, ?)",
+                                   [(src, trg, text, translations[text]) for text in translations])
+            self._conn.commit()
+
+def batch_texts(texts, max_items=MAX_TRANSLATE_ITEMS_PER_REQUEST, max_chars=MAX_TRANSLATE_CHARS_PER_REQUEST):
+    """Groups texts into batches within per-request item and character limits"""
+    batches = []
+    batch = []
+    batch_chars = 0
+    for text in texts:
+        if batch and (len(batch) == max_items or batch_chars + len(text) > max_chars):
+            batches.append(batch)
+            batch = []
+            batch_chars = 0
+        batch.append(text)
+        batch_chars += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def get_azure_translator(src, trg, subscription_key, endpoint = "https://api.cognitive.microsofttranslator.com", location = "westeurope", memory_path=None, workers=DEFAULT_TRANSLATE_WORKERS, transport=None):
+    """Returns a function that translates a list of strings with Azure translator. 
+    Strings are sent in batches over a pooled transport and translations are kept in a translation memory if a path is given"""
     path = '/translate'
     constructed_url = endpoint + path
 
@@ -31,172 +85,149 @@ def get_azure_translator(src, trg, subscription_key, endpoint = "https://api.cog
         'X-ClientTraceId': str(uuid.uuid4())
     }
 
-    # request = requests.post(constructed_url, params=params, headers=headers, json=body)
-    # response = request.json()
+    #Keep-alive connections for each concurrent request, throttled requests are retried
+    if not transport:
+        transport = Transport(pool_size=workers)
+
+    memory = TranslationMemory(memory_path) if memory_path else None
 
-    def translate(string):
-        request = requests.post(constructed_url, params=params, headers=headers, json=[{'text': string}])
+    def translate_batch(strings):
+        try:
+            request = transport.request("POST", constructed_url, params=params, headers=headers, json=[{'text': s} for s in strings])
+        except Exception as e:
+            print("Cannot establish connection to translator")
+            print(e)
+            return {}
         response = request.json()
         if request.status_code == 200:
-            return response[0]['translations'][0]['text']
+            return {s: r['translations'][0]['text'] for s, r in zip(strings, response)}
         else:
             print("Cannot establish connection to translator")
             print(response)
-            return '~'+string+'~'
+            return {}
+
+    def translate(strings):
+        translations = memory.lookup(set(strings), src, trg) if memory else {}
+        pending = [s for s in dict.fromkeys(strings) if s not in translations]
 
-    return lambda x: translate(x)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch_translations in executor.map(translate_batch, batch_texts(pending)):
+                translations.update(batch_translations)
+                if memory:
+                    memory.store(batch_translations, src, trg)
 
-def sec_to_srt_timestamp(sec) -> str:
-    """Convert seconds to hh:mm:ss timestamp format"""
-    ty_res = time.gmtime(sec)
-    time_in_ms = sec * 1000
-    res = time.strftime("%H:%M:%S", ty_res) + ",%03.0f"%(time_in_ms%1000)
-    return res
+        return [translations.get(s, '~'+s+'~') for s in strings]
 
+    return translate
 
 def speaker_turns_to_srt(speaker_turns, output_path, write_speaker_id=False, txttag='rawtxt'):
     """Creates an SRT subtitle from speaker turn list"""
-
-    out_text = ""
-    for i, t in enumerate(speaker_turns):
-        if not t.get(txttag):
-            continue 
-                
-        start_time = t['start']
-                
-        #subtitles can stay on the screen longer than the actual end timestamp
-        next_t = None
-        if i+1 < len(speaker_turns):
-            next_t = speaker_turns[i+1]
-
-        if next_t and t['end'] + SUB_END_BUFFER < next_t['start']:
-            end_time = t['end'] + SUB_END_BUFFER
-        elif next_t:
-            #end_time = next_t['start']
-            end_time = t['end']
-        else:
-            end_time = t['end'] + SUB_END_BUFFER
-
-        out_text += str(i+1) + '\n'
-        out_text += sec_to_srt_timestamp(start_time) + ' --> ' + sec_to_srt_timestamp(end_time) + '\n'
-        
-        if write_speaker_id:# and 'speaker' in t:
-            out_text += '(' + t['speaker'] + ')' + SPEAKER_DELIMITER + " "
-        
-        out_text += t[txttag]
-        out_text += '\n\n'
-            
-    with open(output_path, 'w', encoding='utf8') as f:
-        f.write(out_text)
+    write_turns(speaker_turns, {'srt': output_path}, write_speaker_id, txttag)
 
 def get_sentend_pos(string):
     return [pos for pos, word in enumerate(string.split()) if word[-1] in SENTENDPUNCS]
 
 def fix_word_offsets(wt, fix_by_sec):
-    fixed = copy.deepcopy(wt)
-    for w in fixed:
-        newval = int(w['Offset'] - fix_by_sec * 10000000)
-        w['Offset'] = newval
-    return fixed
+    return wt.shifted(fix_by_sec)
+
+def split_token_ranges(tokens, max_char):
+    """Splits a token list into segments of at most max_char characters, preferring to end them at punctuation. 
+    Returns (first token, end token, segment text) of each segment. Each token is measured and joined once"""
+    segments = []
+    segment_start = 0
+    segment_length = 0  #length of segment text with a space after each token
+    for i, w in enumerate(tokens):
+        if w[-1] in string.punctuation and segment_length + 1 + len(w) > max_char*0.7:
+            segments.append((segment_start, i + 1, ' '.join(tokens[segment_start:i + 1])))
+            segment_start = i + 1
+            segment_length = 0
+        elif segment_length + 1 + len(w) < max_char:
+            segment_length += len(w) + 1
+        else:
+            segments.append((segment_start, i, ' '.join(tokens[segment_start:i])))
+            segment_start = i
+            segment_length = len(w) + 1
+    if segment_length:
+        #Last segment keeps its trailing space
+        segments.append((segment_start, len(tokens), ' '.join(tokens[segment_start:]) + ' '))
+    return segments
 
 def optimal_split_text(text, max_char):
-    split_segments = []
-    current_segment = ""
-    tokens = text.split()
-    for w in tokens:
-        if w[-1] in string.punctuation and len(current_segment + " " + w) > max_char*0.7:
-            current_segment += w
-            split_segments.append(current_segment)
-            current_segment = ""
-        elif len(current_segment + " " + w) < max_char:
-            current_segment += w + " "
-            continue
-        else:
-            split_segments.append(current_segment[:-1])
-            current_segment = w + " "
-    if current_segment:
-        split_segments.append(current_segment)
-    return split_segments
+    return [segment for _, _, segment in split_token_ranges(text.split(), max_char)]
 
 def split_long_turn(turn, texttag, max_chars=MAX_CHARS_PER_SUBSEG, debug=False):
     newturns = []
     if debug: print("split_long_turn:", texttag, turn[texttag])
-    text_segments = optimal_split_text(turn[texttag], max_chars)
-    if debug: print("split_long_turn:text_segments", text_segments)
-    fullcharlen=len(turn[texttag])
+    text_segments = split_token_ranges(turn[texttag].split(), max_chars)
+    fullcharlen = len(turn[texttag])
+    duration = turn['end'] - turn['start']
     start = turn['start']
-    at_token = 0
-    for seg in text_segments:
+    for _, _, seg in text_segments:
         if debug: print(">>", seg)
-        no_tokens = len(seg.split())
         segcharlen = len(seg)
-        duration = turn['end'] - turn['start']
-        ratio = segcharlen / fullcharlen
 
         respective_duration = duration * segcharlen / fullcharlen
         end = start + respective_duration
-        end_token = at_token+no_tokens
-
-    #     fix_by_sec = 0 #TODO if necessary
-    #     wordtiming = fix_word_offsets(turn['wordtiming'][at_token:end_token], fix_by_sec)
 
-        splitturn = {'start': start, 
-                     'end': start + respective_duration, 
-                     'speaker': turn['speaker']}
-        
+        splitturn = Turn(start, start + respective_duration, turn['speaker'])
         splitturn[texttag] = seg
         
         if debug: print(">>", splitturn['start'], splitturn['end'])
 
         start = end
-        at_token = end_token
-
         newturns.append(splitturn)
     return newturns
 
 def segment_turns(turns, max_chars=MAX_CHARS_PER_SUBSEG, translator_func=None, debug=False):
-    sentturns = []
-    sentturns_translated = []
+    """Splits turns into sentence turns for subtitling. translator_func translates a list of strings in one go.
+    Turn texts are tokenized once and sentences are cut by token index ranges of the texts and word timing arrays.
+    Turns without punctuated text (e.g. from ASR API) are subtitled a turn at a time from their raw text, 
+    turns without word timings are timed in proportion to the characters of each sentence"""
+    sentence_list = []
     for turn in turns:
-        turnstart = turn['start']
-        if debug: print(">>>", turnstart)
-        if debug: print(turn['puncdtext'])
-        sentends = get_sentend_pos(turn['puncdtext'])
+        if debug: print(">>>", turn.start)
+        puncd_tokens = (turn['puncdtext'] if turn['puncdtext'] is not None else turn['rawtext'] or '').split()
+        raw_tokens = (turn['rawtext'] or '').split()
+        sentends = [pos for pos, word in enumerate(puncd_tokens) if word[-1] in SENTENDPUNCS]
+        if turn['puncdtext'] is None and puncd_tokens and (not sentends or sentends[-1] != len(puncd_tokens) - 1):
+            sentends.append(len(puncd_tokens) - 1)
         if debug: print(sentends)
-        prevsentendindex = 0
-        for sentendindex in sentends:
-            if debug: print("from", prevsentendindex, "to", sentendindex)
-            puncdtext = ' '.join(turn['puncdtext'].split()[prevsentendindex:sentendindex+1])
-            rawtext = ' '.join(turn['rawtext'].split()[prevsentendindex:sentendindex+1])
-            
-            sentstart = turnstart + turn['wordtiming'][prevsentendindex]['Offset']/10000000
-            sentend = turnstart + turn['wordtiming'][sentendindex]['Offset']/10000000 + turn['wordtiming'][sentendindex]['Duration']/10000000
-            
-            fix_by_sec = sentstart - turnstart
-            wordtiming = fix_word_offsets(turn['wordtiming'][prevsentendindex:sentendindex+1], fix_by_sec)
-            #wordtiming = turn['wordtiming'][prevsentendindex:sentendindex+1]
-            
-            sentturn = {'start': sentstart, 
-                 'end': sentend, 
-                 'speaker': turn['speaker'], 
-                 'toolong':None, 
-                 'rawtext': rawtext, 
-                 'puncdtext': puncdtext,
-                 'wordtiming': wordtiming } 
-            
-            if debug: print(sentturn['start'], sentturn['end'])
-            if debug: print(sentturn['puncdtext'])
+        if not sentends:
+            continue
+
+        wordtiming = turn.wordtiming
+        sentstarts = [0] + [sentendindex + 1 for sentendindex in sentends[:-1]]
+        if wordtiming is not None and len(wordtiming) > sentends[-1]:
+            sentstart_secs = (turn.start + wordtiming.offsets[sentstarts]/TICKS_PER_SEC).tolist()
+            sentend_secs = (turn.start + wordtiming.offsets[sentends]/TICKS_PER_SEC + wordtiming.durations[sentends]/TICKS_PER_SEC).tolist()
+        else:
+            wordtiming = None
+            char_ends = np.cumsum([len(w) + 1 for w in puncd_tokens])
+            duration = turn.end - turn.start
+            sentstart_secs = (turn.start + duration * np.concatenate(([0], char_ends))[sentstarts] / char_ends[-1]).tolist()
+            sentend_secs = (turn.start + duration * char_ends[sentends] / char_ends[-1]).tolist()
+
+        for sentstartindex, sentendindex, sentstart, sentend in zip(sentstarts, sentends, sentstart_secs, sentend_secs):
+            sentturn = Turn(sentstart, sentend, turn.speaker, None, 
+                            ' '.join(raw_tokens[sentstartindex:sentendindex+1]), 
+                            ' '.join(puncd_tokens[sentstartindex:sentendindex+1]),
+                            fix_word_offsets(wordtiming[sentstartindex:sentendindex+1], sentstart - turn.start) if wordtiming is not None else None)
             
-            if translator_func:
-                translated = translator_func(puncdtext)
-
-                sentturn['translated'] = translated
-                if debug: print(sentturn['translated'])
-
-                sentturns_translated.extend(split_long_turn(sentturn, 'translated', max_chars, debug))
-                
-            sentturns.extend(split_long_turn(sentturn, 'puncdtext', max_chars))
-                
-            prevsentendindex = sentendindex+1
-            if debug: print()
+            if debug: print(sentturn['start'], sentturn['end'], sentturn['puncdtext'])
+            sentence_list.append(sentturn)
+
+    #Translate all sentences at once so that they can be batched
+    if translator_func:
+        translations = translator_func([sentturn['puncdtext'] for sentturn in sentence_list])
+        for sentturn, translated in zip(sentence_list, translations):
+            sentturn['translated'] = translated
+            if debug: print(sentturn['translated'])
+
+    sentturns = []
+    sentturns_translated = []
+    for sentturn in sentence_list:
+        if translator_func:
+            sentturns_translated.extend(split_long_turn(sentturn, 'translated', max_chars, debug))
+        sentturns.extend(split_long_turn(sentturn, 'puncdtext', max_chars))
+
     return sentturns, sentturns_translated
@@ -0,0 +1,37 @@
+# Tests of sentence segmentation for subtitles
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from subtools import segment_turns
+from turns import Turn, WordTiming, TICKS_PER_SEC
+
+def test_segment_turns_without_punctuation_or_word_timing():
+    #ASR API gives raw text only, with no punctuated text or word timings
+    turns = [Turn(10.0, 14.0, 'A', False, 'hello there how are you', None, None),
+             Turn(14.0, 16.0, 'B', False, None, None, None)]
+
+    sentturns, translated = segment_turns(turns, translator_func=lambda strings: [s.upper() for s in strings])
+
+    assert [t['puncdtext'].strip() for t in sentturns] == ['hello there how are you']
+    assert sentturns[0]['start'] == 10.0
+    assert [t['translated'].strip() for t in translated] == ['HELLO THERE HOW ARE YOU']
+
+def test_segment_turns_times_sentences_by_characters_without_word_timing():
+    turns = [Turn(0.0, 3.0, 'A', False, 'one two three four', 'One two. Three four.', None)]
+
+    sentturns, _ = segment_turns(turns)
+
+    assert [t['puncdtext'].strip() for t in sentturns] == ['One two.', 'Three four.']
+    #"One two. " is 9 of the 21 characters (with a space after each word) of the turn
+    assert [t['start'] for t in sentturns] == [0.0, 3.0 * 9 / 21]
+
+def test_segment_turns_with_word_timing():
+    words = [{'Word': w, 'Offset': i * TICKS_PER_SEC, 'Duration': TICKS_PER_SEC // 2} for i, w in enumerate(['one', 'two', 'three'])]
+    turns = [Turn(5.0, 8.0, 'A', False, 'one two three', 'One two. Three.', WordTiming.from_list(words))]
+
+    sentturns, _ = segment_turns(turns)
+
+    assert [t['puncdtext'].strip() for t in sentturns] == ['One two.', 'Three.']
+    assert [t['start'] for t in sentturns] == [5.0, 7.0]
@@ -0,0 +1,230 @@
+# Shared HTTP transport for ASR and translation backends
+
+import time
+import random
+import threading
+import email.utils
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 120.0 #(seconds)
+DEFAULT_MAX_RETRIES = 5
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+THROTTLING_STATUS_CODES = [429, 503]
+BACKOFF_BASE = 0.5 #(seconds) first retry waits up to this long, doubling with each retry
+BACKOFF_MAX = 60.0 #(seconds)
+CONNECTION_ERRORS = (requests.RequestException,) #errors of sending that are retried (httpx errors are added with HTTP/2)
+AZURE_TOKEN_LIFETIME = 600.0 #(seconds) Azure access tokens are valid for 10 minutes
+AZURE_TOKEN_REFRESH_MARGIN = 120.0 #(seconds) refresh this long before token expires
+
+class TokenBucket:
+    """Rate limit of requests per second allowing short bursts"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request can be sent"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class AdaptiveConcurrencyLimit:
+    """Limit on requests in flight that halves when the service pushes back (throttling, Retry-After or connection errors)
+    and grows by one after a full window of successful responses, up to the maximum it starts at (AIMD).
+    Latency is not a signal, as it grows with the audio length of each request"""
+
+    def __init__(self, max_limit, initial_limit=None):
+        self.max_limit = max_limit
+        self.limit = initial_limit or max_limit
+        self.in_flight = 0
+        self._healthy_count = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, healthy, back_off):
+        with self._condition:
+            self.in_flight -= 1
+
+            if back_off:
+                self.limit = max(1, self.limit // 2)
+                self._healthy_count = 0
+            elif healthy:
+                self._healthy_count += 1
+                if self._healthy_count >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self._healthy_count = 0
+
+            self._condition.notify_all()
+
+def get_retry_after(response):
+    """Returns seconds to wait as told by the Retry-After header of a response (or None)"""
+
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RequestScheduler:
+    """Sends requests within a rate limit and an adaptive concurrency limit. 
+    Throttled, failed and connection-error requests are retried with jittered exponential backoff, respecting Retry-After.
+    One scheduler can be shared by several transports so that all requests of a process stay within the same limits"""
+
+    def __init__(self, max_concurrency=DEFAULT_POOL_SIZE, rate_limit=None, max_retries=DEFAULT_MAX_RETRIES):
+        self.max_retries = max_retries
+        self.rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.concurrency_limiter = AdaptiveConcurrencyLimit(max_concurrency)
+
+    def send(self, send_func, connection_errors=CONNECTION_ERRORS, metrics=None):
+        """Calls send_func until it returns a non-retryable response or retries run out. 
+        Returns last response, or raises last connection error if no response was received. Attempts and requests are recorded in metrics if given"""
+
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            self.concurrency_limiter.acquire()
+
+            response = None
+            healthy = back_off = False
+            try:
+                start_time = time.monotonic()
+                try:
+                    response = send_func()
+                except connection_errors as e:
+                    error = e
+                latency = time.monotonic() - start_time
+                if metrics:
+                    metrics.record_attempt(latency, response)
+
+                healthy = response is not None and response.status_code not in RETRYABLE_STATUS_CODES
+                delay = get_retry_after(response)
+                #Server errors are retried without backing off, they don't tell the service is overloaded
+                back_off = not healthy and (response is None or response.status_code in THROTTLING_STATUS_CODES or delay is not None)
+            finally:
+                #The slot is given back even if sending raised something else than a connection error
+                self.concurrency_limiter.release(healthy, back_off)
+
+            if healthy:
+                if metrics:
+                    metrics.record_request(attempt, response, True)
+                return response
+            if attempt == self.max_retries:
+                break
+
+            if delay is None:
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+            time.sleep(delay)
+
+        if metrics:
+            metrics.record_request(attempt, response, False)
+        if response is None:
+            raise error
+        return response
+
+class Transport:
+    """Keep-alive HTTP client with a connection pool, shared by all requests to backends.
+    Uses httpx with HTTP/2 if asked for (and h2 is installed), otherwise requests. Requests go through a request scheduler,
+    shared with other transports if given, and are recorded in metrics if given"""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, http2=False, timeout=DEFAULT_TIMEOUT, rate_limit=None, max_retries=DEFAULT_MAX_RETRIES, metrics=None, scheduler=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.http2 = False
+        self.metrics = metrics
+        self.scheduler = scheduler or RequestScheduler(pool_size, rate_limit, max_retries)
+
+        self.connection_errors = CONNECTION_ERRORS
+
+        if http2:
+            try:
+                global httpx
+                import httpx
+                import h2
+                self.http2 = True
+            except ImportError:
+                print("WARNING: HTTP/2 needs httpx and h2 packages (pip install httpx[http2]), using HTTP/1.1")
+
+        if self.http2:
+            self.connection_errors = CONNECTION_ERRORS + (httpx.HTTPError,)
+            limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            self._client = httpx.Client(http2=True, limits=limits, timeout=timeout)
+        else:
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+
+    def request(self, method, url, params=None, headers=None, data=None, content=None, files=None, json=None):
+        """Sends a request (retrying if needed). Form fields go in data, raw body bytes in content"""
+
+        if self.http2:
+            send_func = lambda: self._client.request(method, url, params=params, headers=headers, data=data, content=content,
+                                                     files=files, json=json)
+        else:
+            send_func = lambda: self._session.request(method, url, params=params, headers=headers, data=data if content is None else content,
+                                                      files=files, json=json, timeout=self.timeout)
+        return self.scheduler.send(send_func, self.connection_errors, self.metrics)
+
+    def close(self):
+        if self.http2:
+            self._client.close()
+        else:
+            self._session.close()
+
+class AzureTokenProvider:
+    """Fetches Azure bearer tokens and refreshes them before they expire"""
+
+    def __init__(self, subscription_key, fetch_token_url, transport, lifetime=AZURE_TOKEN_LIFETIME, refresh_margin=AZURE_TOKEN_REFRESH_MARGIN):
+        self.fetch_token_url = fetch_token_url
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self._subscription_key = subscription_key
+        self._transport = transport
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def fetch(self):
+        """Fetches a new token. Returns False if the token service refused"""
+
+        fetched_at = time.monotonic()
+        response = self._transport.request("POST", self.fetch_token_url, headers={'Ocp-Apim-Subscription-Key': self._subscription_key})
+        if response.status_code != 200:
+            print("ERROR: Cannot fetch Azure token", response.status_code, response.text)
+            return False
+
+        self._token = str(response.text)
+        self._expires_at = fetched_at + self.lifetime
+        return True
+
+    def get_token(self):
+        """Returns a valid token, refreshing it if it's about to expire"""
+
+        with self._lock:
+            if self._token is None or time.monotonic() >= self._expires_at - self.refresh_margin:
+                self.fetch()
+            return self._token
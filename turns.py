@@ -0,0 +1,110 @@
+# Compact speaker turn and word timing representation
+
+import json
+import numpy as np
+
+TICKS_PER_SEC = 10000000 #Word offsets and durations are in 100 ns units as given by Azure
+
+class WordTiming:
+    """Word timings of a turn held as arrays of offsets and durations (in ticks from turn start).
+    Slices share the offset and duration arrays"""
+
+    __slots__ = ('words', 'offsets', 'durations')
+
+    def __init__(self, words, offsets, durations):
+        self.words = words
+        self.offsets = offsets
+        self.durations = durations
+
+    @classmethod
+    def from_list(cls, word_list):
+        """Makes word timings from a list of {'Word', 'Offset', 'Duration'} dictionaries as returned by Azure"""
+        return cls([w['Word'] for w in word_list],
+                   np.fromiter((w['Offset'] for w in word_list), dtype=np.int64, count=len(word_list)),
+                   np.fromiter((w['Duration'] for w in word_list), dtype=np.int64, count=len(word_list)))
+
+    def to_list(self):
+        """Converts word timings back to a list of {'Word', 'Offset', 'Duration'} dictionaries"""
+        return [{'Word': w, 'Offset': o, 'Duration': d} for w, o, d in zip(self.words, self.offsets.tolist(), self.durations.tolist())]
+
+    def shifted(self, sec):
+        """Returns word timings with offsets moved back by sec seconds"""
+        return WordTiming(self.words, (self.offsets - sec * TICKS_PER_SEC).astype(np.int64), self.durations)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return WordTiming(self.words[key], self.offsets[key], self.durations[key])
+        return {'Word': self.words[key], 'Offset': int(self.offsets[key]), 'Duration': int(self.durations[key])}
+
+class Turn:
+    """Speaker turn. Fields can also be read and set by key like the dictionaries turns used to be,
+    a field that is not set (None) counts as missing"""
+
+    __slots__ = ('start', 'end', 'speaker', 'toolong', 'rawtext', 'puncdtext', 'wordtiming', 'translated')
+
+    def __init__(self, start, end, speaker=None, toolong=False, rawtext=None, puncdtext=None, wordtiming=None, translated=None):
+        self.start = start
+        self.end = end
+        self.speaker = speaker
+        self.toolong = toolong
+        self.rawtext = rawtext
+        self.puncdtext = puncdtext
+        self.wordtiming = wordtiming
+        self.translated = translated
+
+    def set_transcription(self, rawtext, puncdtext, word_list):
+        """Places a transcription result (raw transcript, punctuated transcript, word timing list) on the turn"""
+        self.rawtext = rawtext
+        self.puncdtext = puncdtext
+        self.wordtiming = WordTiming.from_list(word_list) if word_list is not None else None
+
+    def get_transcription(self):
+        """Returns transcription of the turn in the form transcribers give it"""
+        return self.rawtext, self.puncdtext, self.wordtiming.to_list() if self.wordtiming is not None else None
+
+    def to_dict(self):
+        #Transcription keys are written even when empty (null), as in -asr.json files of earlier versions
+        turn_dict = {'start': self.start, 'end': self.end, 'speaker': self.speaker, 'toolong': self.toolong,
+                     'rawtext': self.rawtext, 'puncdtext': self.puncdtext,
+                     'wordtiming': self.wordtiming.to_list() if self.wordtiming is not None else None}
+        if self.translated is not None:
+            turn_dict['translated'] = self.translated
+        return turn_dict
+
+    @classmethod
+    def from_dict(cls, turn_dict):
+        turn = cls(turn_dict['start'], turn_dict['end'], turn_dict.get('speaker'), turn_dict.get('toolong', False),
+                   turn_dict.get('rawtext'), turn_dict.get('puncdtext'), translated=turn_dict.get('translated'))
+        if turn_dict.get('wordtiming') is not None:
+            turn.wordtiming = WordTiming.from_list(turn_dict['wordtiming'])
+        return turn
+
+    def __getitem__(self, key):
+        if key not in Turn.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in Turn.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in Turn.__slots__ and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key) if key in Turn.__slots__ else None
+        return value if value is not None else default
+
+def dump_turns(speaker_turns, output_path):
+    """Writes speaker turns to a JSON file"""
+    with open(output_path, 'w') as f:
+        f.write(json.dumps([t.to_dict() for t in speaker_turns]))
+
+def load_turns(input_path):
+    """Reads speaker turns from a JSON file"""
+    with open(input_path) as f:
+        return [Turn.from_dict(turn_dict) for turn_dict in json.load(f)]
@@ -0,0 +1,174 @@
+# Single-pass, streaming writers of speaker turns to transcript and subtitle formats
+
+import time
+import json
+import itertools
+from turns import WordTiming
+
+SPEAKER_DELIMITER = ':'
+SUB_END_BUFFER = 0.5 #(seconds) subtitles stay on screen this long after turn ends (if next turn allows)
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+def sec_to_timestamp(sec) -> str:
+    """Convert seconds to hh:mm:ss timestamp format"""
+    ty_res = time.gmtime(sec)
+    res = time.strftime("%H:%M:%S",ty_res)
+    return res
+
+def timestamp_spanner(sec) -> str:
+    """Creates an XML line for timestamp from seconds in audio"""
+    res = sec_to_timestamp(sec)
+    span_str = '<span class="timestamp" data-timestamp="%s">%s</span>'%(sec, res)
+    return span_str
+
+def sec_to_srt_timestamp(sec) -> str:
+    """Convert seconds to hh:mm:ss,mmm timestamp format"""
+    ty_res = time.gmtime(sec)
+    time_in_ms = sec * 1000
+    res = time.strftime("%H:%M:%S", ty_res) + ",%03.0f"%(time_in_ms%1000)
+    return res
+
+def sec_to_vtt_timestamp(sec) -> str:
+    """Convert seconds to hh:mm:ss.mmm timestamp format"""
+    total_ms = int(round(sec * 1000))
+    return "%02i:%02i:%02i.%03i"%(total_ms // 3600000, total_ms // 60000 % 60, total_ms // 1000 % 60, total_ms % 1000)
+
+def get_turn_text(turn):
+    """Returns punctuated text of a turn if there's one, otherwise raw text"""
+    return turn.get('puncdtext') or turn.get('rawtext') or ''
+
+def is_untranscribed(turn):
+    """Turns that went through transcription but got no text are left out of transcripts"""
+    return ('rawtext' in turn or 'puncdtext' in turn) and not get_turn_text(turn)
+
+def get_subtitle_end(turn, next_turn):
+    """Subtitles can stay on the screen longer than the actual end timestamp unless the next one starts"""
+
+    if next_turn and turn['end'] + SUB_END_BUFFER < next_turn['start']:
+        return turn['end'] + SUB_END_BUFFER
+    elif next_turn:
+        return turn['end']
+    else:
+        return turn['end'] + SUB_END_BUFFER
+
+class TurnWriter:
+    """Base of format writers. Gets each turn (with the one after it) in order and writes it to an open file"""
+
+    def __init__(self, f, write_speaker_id=False, txttag=None):
+        self.f = f
+        self.write_speaker_id = write_speaker_id
+        self.txttag = txttag
+
+    def get_text(self, turn):
+        return turn.get(self.txttag) if self.txttag else get_turn_text(turn)
+
+    def begin(self):
+        pass
+
+    def write_turn(self, index, turn, next_turn):
+        raise NotImplementedError
+
+    def end(self):
+        pass
+
+class OTRWriter(TurnWriter):
+    """oTranscribe template. The JSON text field is streamed piece by piece"""
+
+    def begin(self):
+        self.f.write('{"text": "')
+
+    def write_turn(self, index, turn, next_turn):
+        if is_untranscribed(turn):
+            return
+
+        line = timestamp_spanner(turn['start']) + ' '
+        if self.write_speaker_id:
+            line += '(' + turn['speaker'] + ')' + SPEAKER_DELIMITER + " "
+        line += get_turn_text(turn) + '<br /><br />'
+        self.f.write(json.dumps(line)[1:-1])
+
+    def end(self):
+        self.f.write('", "media": "", "media-time": "0.0"}')
+
+class TXTWriter(TurnWriter):
+    """Plain text transcript with a timestamp on each turn"""
+
+    def write_turn(self, index, turn, next_turn):
+        if is_untranscribed(turn):
+            return
+
+        line = sec_to_timestamp(turn['start']) + ' '
+        if self.write_speaker_id:
+            line += '(' + turn['speaker'] + ')' + SPEAKER_DELIMITER + " "
+        self.f.write(line + get_turn_text(turn) + '\n')
+
+class JSONLWriter(TurnWriter):
+    """One JSON object per transcribed turn"""
+
+    def write_turn(self, index, turn, next_turn):
+        if is_untranscribed(turn):
+            return
+
+        entry = {'index': index, 'start': turn['start'], 'end': turn['end'], 'speaker': turn['speaker'], 'text': self.get_text(turn)}
+        if turn.get('wordtiming'):
+            entry['wordtiming'] = turn['wordtiming'].to_list() if isinstance(turn['wordtiming'], WordTiming) else turn['wordtiming']
+        self.f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+class SRTWriter(TurnWriter):
+    """SubRip subtitles"""
+
+    def write_turn(self, index, turn, next_turn):
+        text = self.get_text(turn)
+        if not text:
+            return
+
+        cue = str(index + 1) + '\n'
+        cue += sec_to_srt_timestamp(turn['start']) + ' --> ' + sec_to_srt_timestamp(get_subtitle_end(turn, next_turn)) + '\n'
+        if self.write_speaker_id:
+            cue += '(' + turn['speaker'] + ')' + SPEAKER_DELIMITER + " "
+        self.f.write(cue + text + '\n\n')
+
+class VTTWriter(TurnWriter):
+    """WebVTT subtitles. Speakers are marked with voice tags"""
+
+    def begin(self):
+        self.f.write('WEBVTT\n\n')
+
+    def write_turn(self, index, turn, next_turn):
+        text = self.get_text(turn)
+        if not text:
+            return
+
+        cue = str(index + 1) + '\n'
+        cue += sec_to_vtt_timestamp(turn['start']) + ' --> ' + sec_to_vtt_timestamp(get_subtitle_end(turn, next_turn)) + '\n'
+        if self.write_speaker_id:
+            cue += '<v ' + turn['speaker'] + '>'
+        self.f.write(cue + text + '\n\n')
+
+#Format backends by name. Subtitle formats are written from sentence turns, the others from speaker turns
+FORMAT_WRITERS = {'otr': OTRWriter, 'txt': TXTWriter, 'jsonl': JSONLWriter, 'srt': SRTWriter, 'vtt': VTTWriter}
+TRANSCRIPT_FORMATS = ['otr', 'txt', 'jsonl']
+SUBTITLE_FORMATS = ['srt', 'vtt']
+
+def write_turns(speaker_turns, output_paths, write_speaker_id=False, txttag=None):
+    """Writes speaker turns to several formats in a single pass over the turns.
+    output_paths maps format names in FORMAT_WRITERS to paths of files to write"""
+
+    files = []
+    try:
+        writers = []
+        for format_name, output_path in output_paths.items():
+            f = open(output_path, 'w', encoding='utf8', buffering=WRITE_BUFFER_SIZE)
+            files.append(f)
+            writers.append(FORMAT_WRITERS[format_name](f, write_speaker_id, txttag))
+
+        for writer in writers:
+            writer.begin()
+        for i, (turn, next_turn) in enumerate(itertools.zip_longest(speaker_turns, itertools.islice(speaker_turns, 1, None))):
+            for writer in writers:
+                writer.write_turn(i, turn, next_turn)
+        for writer in writers:
+            writer.end()
+    finally:
+        for f in files:
+            f.close()